@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from . import models
+
+
+# ===================================================================
+# Columnar Archives
+# ===================================================================
+# Records are archived in compressed NumPy .npz files with one array per column, in ascending order of update_dtm:
+#     update_dtm: datetime64[s] in UTC
+#     city: name_en of the city
+#     station: name_cn of the station, only in archives of station records
+#     one float64 array per pollutant field, NaN for missing values
+#
+# Read an archive with numpy.load(file), e.g. numpy.load(file)['pm2_5'].
+
+# Columns of each kind of record besides pollutant fields, as (array name, lookup) pairs
+KEY_COLUMNS = {
+    'city': [('update_dtm', 'update_dtm'), ('city', 'city')],
+    'station': [('update_dtm', 'update_dtm'), ('city', 'city'), ('station', 'station__name_cn')],
+}
+
+
+def get_record_kind(queryset):
+    if issubclass(queryset.model, models.StationRecord):
+        return 'station'
+    return 'city'
+
+
+def to_arrays(rows, names):
+    """
+    Convert a list of rows of values_list() to one array per column.
+
+    :param rows: a list of tuples
+    :param names: array names of columns of rows. update_dtm and pollutant fields are converted, the others are
+        kept as strings.
+    :return: a dict mapping array names to arrays
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    arrays = {}
+    for name, column in zip(names, columns):
+        if name == 'update_dtm':
+            arrays[name] = np.array([int(dtm.timestamp()) for dtm in column], dtype='datetime64[s]')
+        elif name in models.DECIMAL_FIELDS:
+            arrays[name] = np.array([np.nan if value is None else float(value) for value in column],
+                                    dtype=np.float64)
+        else:
+            arrays[name] = np.array(column, dtype=np.str_)
+    return arrays
+
+
+def write_archive(queryset, file, fields=None, chunk_size=5000):
+    """
+    Write records in queryset to file as a compressed .npz archive.
+
+    Rows are read with keyset pagination in chunks of values, so no model instance is created and every chunk
+    is a cheap query no matter how large the queryset is. Only the arrays are kept in memory.
+
+    :param queryset: a queryset of CityRecord or StationRecord
+    :param file: a file name or a writable file object
+    :param fields: a list of pollutant fields to export, defaults to models.DECIMAL_FIELDS
+    :param chunk_size: number of rows read at once
+    :return: number of records written
+    """
+    if fields is None:
+        fields = models.DECIMAL_FIELDS
+    key_columns = KEY_COLUMNS[get_record_kind(queryset)]
+    names = [name for name, _ in key_columns] + list(fields)
+    lookups = [lookup for _, lookup in key_columns] + list(fields)
+
+    chunks = {name: [] for name in names}
+    count = 0
+    for rows in queryset.scan(*lookups, chunk_size=chunk_size):
+        # scan() appends pk to the values
+        for name, array in to_arrays([row[:len(names)] for row in rows], names).items():
+            chunks[name].append(array)
+        count += len(rows)
+
+    arrays = {
+        name: np.concatenate(arrays) if arrays else to_arrays([], [name])[name]
+        for name, arrays in chunks.items()
+    }
+    np.savez_compressed(file, **arrays)
+    return count
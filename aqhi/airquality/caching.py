@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import datetime
+import threading
+
+import pytz
+from django.core.cache import cache
+
+
+# ===================================================================
+# Updated-at Timestamps
+# ===================================================================
+# Cached API responses are keyed by the timestamps of the last changes of the models they show,
+# so changing a model is enough to invalidate all of them.
+#
+# Records have timestamps scoped by city and by update hour besides the global one, so that a response
+# showing records of some cities or of an hour is only invalidated when those records change.
+SCOPED_UPDATE_NAMES = {'cityrecord', 'stationrecord'}
+
+
+def get_updated_at_key(update_name, scope=None):
+    if scope is None:
+        return '{}_updated_at_timestamp'.format(update_name)
+    return '{}_{}_updated_at_timestamp'.format(update_name, scope)
+
+
+def city_scope(city):
+    return 'city_{}'.format(city)
+
+
+def hour_scope(dtm):
+    return 'hour_{}'.format(dtm.astimezone(pytz.utc).strftime('%Y%m%d%H'))
+
+
+def get_updated_at(update_name, scope=None):
+    key = get_updated_at_key(update_name, scope)
+    value = cache.get(key, None)
+    if not value:
+        value = datetime.datetime.utcnow()
+        # Never expire, or all responses would be invalidated with it
+        cache.set(key, value, None)
+    return value
+
+
+def touch(*update_names, cities=(), dtms=()):
+    """
+    Mark models, by their model names, as changed now, along with their timestamps scoped by the cities
+    and update datetimes of changed records. In batch mode, this is deferred to the end of the batch.
+    """
+    keys = set()
+    for name in update_names:
+        keys.add(get_updated_at_key(name))
+        keys.update(get_updated_at_key(name, city_scope(city)) for city in cities)
+        keys.update(get_updated_at_key(name, hour_scope(dtm)) for dtm in dtms)
+
+    with _batch_lock:
+        if _batch_keys is not None:
+            _batch_keys.update(keys)
+            return
+    _set_keys(keys)
+
+
+# Batch Mode
+# -------------------------------------------------------------------
+# A crawl saves hundreds of records in minutes, so timestamps are set once at its end.
+_batch_lock = threading.Lock()
+_batch_keys = None
+
+
+def begin_batch():
+    global _batch_keys
+    with _batch_lock:
+        if _batch_keys is None:
+            _batch_keys = set()
+
+
+def end_batch():
+    """Set all timestamps touched since begin_batch at once, and leave batch mode."""
+    global _batch_keys
+    with _batch_lock:
+        keys, _batch_keys = _batch_keys, None
+    if keys:
+        _set_keys(keys)
+
+
+@contextlib.contextmanager
+def batch():
+    begin_batch()
+    try:
+        yield
+    finally:
+        end_batch()
+
+
+def _set_keys(keys):
+    now = datetime.datetime.utcnow()
+    cache.set_many({key: now for key in keys}, None)
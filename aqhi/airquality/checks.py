@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core import checks
+from django.db import DatabaseError, connection
+from django.db.migrations.recorder import MigrationRecorder
+
+
+COMPACT_MIGRATION = ('airquality', '0008_compact_pollutants')
+
+
+def get_compact_pollutants_in_db():
+    """
+    Return whether pollutant columns of records are stored as scaled integers in the database, or None if it is
+    unknown because migration 0008, which decides it by AIRQUALITY_COMPACT_POLLUTANTS, is not applied yet.
+    """
+    recorder = MigrationRecorder(connection)
+    with connection.cursor() as cursor:
+        tables = connection.introspection.table_names(cursor)
+        if recorder.Migration._meta.db_table not in tables or 'airquality_cityrecord' not in tables:
+            return None
+        if not recorder.migration_qs.filter(app=COMPACT_MIGRATION[0], name=COMPACT_MIGRATION[1]).exists():
+            return None
+        description = connection.introspection.get_table_description(cursor, 'airquality_cityrecord')
+    for column in description:
+        if column.name == 'aqhi':
+            return connection.introspection.get_field_type(column.type_code, column) == 'IntegerField'
+    return None
+
+
+@checks.register()
+def check_compact_pollutants(app_configs, **kwargs):
+    """
+    Reject an AIRQUALITY_COMPACT_POLLUTANTS different from the one migration 0008 was applied with, which would
+    read and write pollutant columns in the wrong representation. Like other checks, it runs before management
+    commands including migrate and makemigrations, whose output also depends on the setting.
+    """
+    try:
+        compact = get_compact_pollutants_in_db()
+    except DatabaseError:
+        # Checks also run without a database, e.g. for collectstatic
+        return []
+    if compact is None or compact == settings.AIRQUALITY_COMPACT_POLLUTANTS:
+        return []
+    return [checks.Error(
+        'AIRQUALITY_COMPACT_POLLUTANTS is {} but pollutant columns of records are stored as {}.'.format(
+            settings.AIRQUALITY_COMPACT_POLLUTANTS, 'scaled integers' if compact else 'decimals'
+        ),
+        hint='Set it back to {}, migrate airquality back to 0007, then change it and migrate again.'.format(compact),
+        id='airquality.E001',
+    )]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# Define here the downloader middlewares
+#
+# See documentation in:
+# http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from twisted.internet import reactor, task
+
+
+class BackoffRetryMiddleware(RetryMiddleware):
+    """
+    Retry failed requests at most `RETRY_TIMES` times like RetryMiddleware, but only after a delay doubled on every
+    retry, from `RETRY_BACKOFF_BASE` to `RETRY_BACKOFF_MAX` seconds, so that a throttling or degraded upstream is
+    not hit again at once by every failed request.
+
+    Any request with a positive 'retry_times' in its meta is delayed. A delayed request waits before entering its
+    download slot, so it still counts towards `CONCURRENT_REQUESTS`.
+
+    Retries are counted in the crawl stats by reason, and requests given up in 'retry/max_reached'.
+    """
+
+    def __init__(self, settings, stats):
+        super(BackoffRetryMiddleware, self).__init__(settings)
+        self.stats = stats
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE', 5)
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX', 120)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
+
+    def get_backoff(self, retries):
+        return min(self.backoff_base * 2 ** (retries - 1), self.backoff_max)
+
+    def process_request(self, request, spider):
+        retries = request.meta.get('retry_times', 0)
+        if retries > 0:
+            return task.deferLater(reactor, self.get_backoff(retries), lambda: None)
+
+    def _retry(self, request, reason, spider):
+        retry_request = super(BackoffRetryMiddleware, self)._retry(request, reason, spider)
+        if retry_request is None:
+            self.stats.inc_value('retry/max_reached', spider=spider)
+        else:
+            if isinstance(reason, Exception):
+                reason = reason.__class__.__name__
+            self.stats.inc_value('retry/count', spider=spider)
+            self.stats.inc_value('retry/reason_count/{}'.format(reason), spider=spider)
+        return retry_request
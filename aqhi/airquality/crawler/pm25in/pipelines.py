@@ -6,12 +6,54 @@
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 import os
 
+from django.db import close_old_connections
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
+
 from .items import PageItem
 from aqhi.airquality import utils
 from aqhi.airquality import models
+from aqhi.airquality import caching
 
 
 class SavePagePipeline(object):
+    """
+    Parse pages, save their records and back them up in a pool of `SAVE_PAGE_THREADS` threads, so that parsing and
+    database queries never block downloads on the reactor thread.
+
+    process_item returns a Deferred fired when the page is saved. A response counts towards the scraper's limit of
+    responses in process, 5 MB in total, until its item is saved, and downloads are paused beyond the limit, so
+    pages waiting for a thread are bounded.
+
+    With `SAVE_PAGE_BATCH_SIZE` greater than 1, parsed pages are buffered and saved by create_city_records in one
+    transaction every `SAVE_PAGE_BATCH_SIZE` pages or `SAVE_PAGE_BATCH_INTERVAL` seconds, and once more when the
+    spider is closed. The item filling the buffer waits for the batch to be saved, so batches never pile up.
+
+    The spider's page_saved is called on the reactor thread for every page whose record is saved or already exists,
+    or which is backed up if the spider is not to parse, so that its crawl state only advances then.
+    """
+    def __init__(self, threads=1, batch_size=0, batch_interval=60):
+        self.threads = threads
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.threadpool = None
+        self.buffer = []
+        self.flush_lock = defer.DeferredLock()
+        self.flush_loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            threads=settings.getint('SAVE_PAGE_THREADS', 1),
+            batch_size=settings.getint('SAVE_PAGE_BATCH_SIZE', 0),
+            batch_interval=settings.getfloat('SAVE_PAGE_BATCH_INTERVAL', 60),
+        )
+
+    @property
+    def batched(self):
+        return self.batch_size > 1
+
     @staticmethod
     def _backup_to_file(city_name, res_dir, content, logger):
         file_name = '{}.html'.format(city_name)
@@ -19,36 +61,180 @@ class SavePagePipeline(object):
             f.write(content)
         logger.info("Successfully backup the page of city '{}'".format(city_name))
 
+    @staticmethod
+    def _is_saved(create_status):
+        return create_status['success'] == 1 or create_status['error_type'] == 'UniquenessError'
+
+    @staticmethod
+    def _log_create_status(logger, city_name, info_dict, create_status):
+        record_info = '{name} on {dtm}'.format(name=city_name, dtm=info_dict['update_dtm'])
+        if create_status['success'] == 1:
+            logger.info('Successfully save a record: {}'.format(record_info))
+        else:
+            err_type = create_status['error_type']
+            if err_type == 'UniquenessError':
+                logger.warn('Ignore duplicate record: {}'.format(record_info))
+            else:
+                logger.error('Fail to save record: {record} because of {err_type}: {err_msg}'.format(
+                    record=record_info,
+                    err_type=err_type,
+                    err_msg=create_status['info']
+                ))
+
+    def open_spider(self, spider):
+        if spider.to_parse:
+            # Fill the in-process caches so that saving records needs no lookup of names or AQHI history
+            models.name_registry.load()
+            models.aqhi_window_cache.load()
+            # Invalidate cached API responses once at the end of the crawl instead of on every record
+            caching.begin_batch()
+        self.threadpool = ThreadPool(minthreads=1, maxthreads=self.threads, name='SavePagePipeline')
+        self.threadpool.start()
+        if self.batched and spider.to_parse:
+            self.flush_loop = task.LoopingCall(self.flush, spider)
+            self.flush_loop.start(self.batch_interval, now=False)
+
+    def close_spider(self, spider):
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        d = self.flush(spider)
+        d.addBoth(self._close)
+        return d
+
+    def _close(self, result):
+        # Every item is processed and flushed before, so threads are idle
+        self.threadpool.stop()
+        models.aqhi_window_cache.clear()
+        caching.end_batch()
+        return result
+
     def process_item(self, item, spider):
+        if not isinstance(item, PageItem):
+            return item
+        if self.batched and spider.to_parse:
+            d = self._defer_to_thread(self.parse_page, item, spider)
+            d.addCallback(self._buffer, spider)
+        else:
+            d = self._defer_to_thread(self.save_page, item, spider)
+            d.addCallback(lambda saved: self._pages_saved([item['name']] if saved else [], spider))
+        d.addCallback(lambda _: item)
+        return d
+
+    def _defer_to_thread(self, func, *args):
+        return threads.deferToThreadPool(reactor, self.threadpool, self._call_in_thread, func, *args)
+
+    @staticmethod
+    def _call_in_thread(func, *args):
+        # Each thread has its own database connection, closed like at the end of a request
+        close_old_connections()
+        try:
+            return func(*args)
+        finally:
+            close_old_connections()
+
+    def _buffer(self, page, spider):
+        if page is not None:
+            self.buffer.append(page)
+        if len(self.buffer) >= self.batch_size:
+            return self.flush(spider)
+
+    def flush(self, spider):
+        """Save buffered pages in the thread pool. Return a Deferred fired when they are saved."""
+        # Batches are saved one at a time, in the order they are buffered
+        return self.flush_lock.run(self._flush, spider)
+
+    def _flush(self, spider):
+        pages, self.buffer = self.buffer, []
+        if not pages:
+            return defer.succeed(None)
+        d = self._defer_to_thread(self.save_pages, pages, spider)
+        d.addCallback(self._pages_saved, spider)
+        return d
+
+    @staticmethod
+    def _pages_saved(city_names, spider):
+        for city_name in city_names:
+            spider.page_saved(city_name)
+
+    def save_page(self, item, spider):
+        """
+        Parse a page and save its records if the spider is to parse, then back it up.
+
+        :return: whether the record of the page is saved or already exists, or the page is backed up if the spider
+            is not to parse
+        """
         logger = spider.custom_logger
         to_parse = spider.to_parse
-        if isinstance(item, PageItem):
-            city_name = item['name']
-            if to_parse:
-                page_content = item['page'].decode()
-                # save record to database first
-                try:
-                    info_dict, create_status = utils.parse_and_create_records_from_html(page_content, city_name)
-                    record_info = '{name} on {dtm}'.format(name=city_name, dtm=info_dict['update_dtm'])
-                    if create_status['success'] == 1:
-                        logger.info('Successfully save a record: {}'.format(record_info))
-                    else:
-                        err_type = create_status['error_type']
-                        if err_type == 'UniquenessError':
-                            logger.warn('Ignore duplicate record: {}'.format(record_info))
-                        else:
-                            logger.error('Fail to save record: {record} because of {err_type}: {err_msg}'.format(
-                                record=record_info,
-                                err_type=err_type,
-                                err_msg=create_status['info']
-                            ))
-                except Exception as e:
-                    logger.error("Exception raised when parsing web page and saving record of city '{city}': {e}".format(
-                        city=city_name,
-                        e=repr(e)
-                    ))
-                finally:
-                    # backup file
-                    self._backup_to_file(city_name, spider.res_dir, item['page'], logger)
-            else:
+        city_name = item['name']
+        saved = False
+        if to_parse:
+            page_content = item['page'].decode()
+            # save record to database first
+            try:
+                info_dict, create_status = utils.parse_and_create_records_from_html(page_content, city_name)
+                self._log_create_status(logger, city_name, info_dict, create_status)
+                saved = self._is_saved(create_status)
+            except Exception as e:
+                logger.error("Exception raised when parsing web page and saving record of city '{city}': {e}".format(
+                    city=city_name,
+                    e=repr(e)
+                ))
+            finally:
+                # backup file
                 self._backup_to_file(city_name, spider.res_dir, item['page'], logger)
+        else:
+            self._backup_to_file(city_name, spider.res_dir, item['page'], logger)
+            saved = True
+        return saved
+
+    def parse_page(self, item, spider):
+        """
+        Parse a page and back it up, in batch mode.
+
+        :return: a (city_name, info_dict) pair to save by save_pages, or None if the page can not be parsed
+        """
+        logger = spider.custom_logger
+        city_name = item['name']
+        try:
+            return city_name, utils.parse_records_from_html(item['page'].decode(), city_name)
+        except Exception as e:
+            logger.error("Exception raised when parsing web page of city '{city}': {e}".format(
+                city=city_name,
+                e=repr(e)
+            ))
+        finally:
+            self._backup_to_file(city_name, spider.res_dir, item['page'], logger)
+
+    def save_pages(self, pages, spider):
+        """
+        Save (city_name, info_dict) pairs of parsed pages by create_city_records in one transaction.
+
+        If the batch raises an exception, which rolls the whole transaction back, pages are saved again one by one
+        by create_city_record, so that one bad page only loses its own record.
+
+        :return: names of cities whose records are saved or already exist
+        """
+        logger = spider.custom_logger
+        try:
+            results = models.create_city_records([info_dict for _, info_dict in pages])
+        except Exception as e:
+            logger.error('Exception raised when saving records of {num} pages in a batch: {e}. '
+                         'Save them one by one.'.format(num=len(pages), e=repr(e)))
+            results = [self._save_one(logger, city_name, info_dict) for city_name, info_dict in pages]
+        saved = []
+        for (city_name, info_dict), create_status in zip(pages, results):
+            if create_status is not None:
+                self._log_create_status(logger, city_name, info_dict, create_status)
+                if self._is_saved(create_status):
+                    saved.append(city_name)
+        return saved
+
+    @staticmethod
+    def _save_one(logger, city_name, info_dict):
+        try:
+            return models.create_city_record(info_dict)
+        except Exception as e:
+            logger.error("Exception raised when saving record of city '{city}': {e}".format(
+                city=city_name,
+                e=repr(e)
+            ))
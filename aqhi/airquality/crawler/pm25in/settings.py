@@ -24,6 +24,13 @@ NEWSPIDER_MODULE = prefix_project_module('pm25in.spiders')
 ITEM_PIPELINES = {
     prefix_project_module('pm25in.pipelines.SavePagePipeline'): 300,
 }
+# Pages are saved by SavePagePipeline in a thread pool of this size. Use 1 with SQLite, which locks on writes.
+# Pages waiting for a thread are bounded by Scrapy, which pauses downloads while the responses being processed
+# exceed 5 MB in total. The limit is fixed in this version of Scrapy, later ones read SCRAPER_SLOT_MAX_ACTIVE_SIZE.
+SAVE_PAGE_THREADS = 4
+# Pages are saved in batches of this size, or of the pages parsed in the interval in seconds. 0 saves each page.
+SAVE_PAGE_BATCH_SIZE = 50
+SAVE_PAGE_BATCH_INTERVAL = 30
 
 # Logging
 #LOG_FILE = 'pm25in/log/log.txt'
@@ -63,9 +70,16 @@ CONCURRENT_REQUESTS_PER_DOMAIN = 4
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'aqi_data.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+    prefix_project_module('pm25in.middlewares.BackoffRetryMiddleware'): 500,
+}
+
+# Failed requests are retried at most RETRY_TIMES times, after a delay in seconds doubled on every retry
+RETRY_TIMES = 3
+RETRY_HTTP_CODES = [500, 502, 503, 504, 408, 429]
+RETRY_BACKOFF_BASE = 5
+RETRY_BACKOFF_MAX = 120
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
@@ -80,7 +94,7 @@ AUTOTHROTTLE_ENABLED = True
 # The initial download delay
 AUTOTHROTTLE_START_DELAY = 1
 # The maximum download delay to be set in case of high latencies
-#AUTOTHROTTLE_MAX_DELAY=60
+AUTOTHROTTLE_MAX_DELAY = 60
 # Enable showing throttling stats for every response received:
 AUTOTHROTTLE_DEBUG = True
 
@@ -3,6 +3,8 @@ import scrapy
 import urllib.parse
 
 from ..items import PageItem
+from aqhi.airquality import extractors
+from aqhi.airquality.utils import CrawlState
 
 
 class AQISpider(scrapy.Spider):
@@ -11,13 +13,40 @@ class AQISpider(scrapy.Spider):
     start_urls = [
         'http://pm25.in/',
     ]
+    # Pages not modified since the last crawl are answered with 304 to conditional requests
+    handle_httpstatus_list = [304]
 
-    def __init__(self, res_dir, logger, page_num, to_parse=True, *args, **kwargs):
+    def __init__(self, res_dir, logger, page_num, to_parse=True, crawl_state=None, city_names=None,
+                 *args, **kwargs):
+        """
+        :param crawl_state: a CrawlState to skip pages not updated since the last crawl, see parse_city_page
+        :param city_names: if given, only pages of these cities are crawled, without the index page
+        """
         super(AQISpider, self).__init__(*args, **kwargs)
         self.res_dir = res_dir
         self.custom_logger = logger
         self.page_num = page_num
         self.to_parse = to_parse
+        self.crawl_state = crawl_state if crawl_state is not None else CrawlState()
+        self.city_names = city_names
+        # Crawl states of pages yielded but not saved by pipelines yet, see page_saved
+        self.pending_states = {}
+
+    @staticmethod
+    def get_city_name(url):
+        return urllib.parse.urlparse(url).path[1:]
+
+    def start_requests(self):
+        if self.city_names is None:
+            for request in super(AQISpider, self).start_requests():
+                yield request
+        else:
+            for name in self.city_names:
+                yield self.city_request(urllib.parse.urljoin(self.start_urls[0], name))
+
+    def city_request(self, url):
+        return scrapy.Request(url, callback=self.parse_city_page,
+                              headers=self.crawl_state.get_headers(self.get_city_name(url)))
 
     def parse(self, response):
         # Get all city urls
@@ -29,18 +58,54 @@ class AQISpider(scrapy.Spider):
         self.custom_logger.info('Get {} city urls.'.format(len(city_urls)))
 
         for url in city_urls:
-            yield scrapy.Request(response.urljoin(url), callback=self.parse_city_page)
+            yield self.city_request(response.urljoin(url))
 
     def parse_city_page(self, response):
-        if response.status == 200:
+        name = self.get_city_name(response.url)
+        if response.status == 304:
+            self.custom_logger.info('Skip {} not modified since the last crawl.'.format(response.url))
+        elif response.status == 200:
+            # Check the update time before the page is parsed by pipelines
+            update_dtm = extractors.extract_update_dtm(response.body)
+            last_update_dtm = self.crawl_state.get_update_dtm(name)
+            state = {
+                'update_dtm': update_dtm,
+                'etag': self._get_header(response, 'ETag'),
+                'last_modified': self._get_header(response, 'Last-Modified'),
+            }
+            if update_dtm is not None and last_update_dtm is not None and update_dtm <= last_update_dtm:
+                # The update was saved when it was first seen, so only the headers are new
+                self.crawl_state.update(name, **state)
+                self.custom_logger.info('Skip {} not updated since {}.'.format(response.url, last_update_dtm))
+                return
+
+            # Advanced only when the page is saved, so a page failing to be parsed or saved is fetched again
+            self.pending_states[name] = state
             self.custom_logger.info('Successfully crawl from {}.'.format(response.url))
             yield PageItem(
-                name=urllib.parse.urlparse(response.url).path[1:],
+                name=name,
                 page=response.body
             )
         else:
-            self.custom_logger.warning()
-            self.custom_logger.info('Fail to crawl from {}. Retry.'.format(response.url))
-            yield scrapy.Request(response.url, callback=self.parse_city_page)
+            # Failed responses are retried by BackoffRetryMiddleware and dropped by HttpErrorMiddleware, so only
+            # other successful ones, e.g. 206, get here
+            self.custom_logger.warning('Ignore {} with status {}.'.format(response.url, response.status))
+
+    def page_saved(self, name):
+        """
+        Called by SavePagePipeline on the reactor thread when the page is saved, or backed up if the spider is not
+        to parse, to advance its crawl state.
+        """
+        state = self.pending_states.pop(name, None)
+        if state is not None:
+            self.crawl_state.update(name, **state)
 
+    def closed(self, reason):
+        # Pages only backed up are parsed later from the backups, so they must not be skipped by the next crawl
+        if self.to_parse:
+            self.crawl_state.save()
 
+    @staticmethod
+    def _get_header(response, name):
+        value = response.headers.get(name)
+        return value.decode('latin-1') if value is not None else None
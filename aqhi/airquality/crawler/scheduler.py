@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import collections
+from datetime import timedelta
+from statistics import median
+
+
+class CrawlScheduler(object):
+    """
+    Decide when to fetch the page of each city, just after its next update is expected to be published.
+
+    The next update of a city is expected one interval after its last update datetime, where the interval is the
+    median of the intervals of its recent update datetimes, e.g. one hour. It is published after a delay, which is
+    the median of the recent delays between update datetimes and the times they were first seen by a crawl, kept in
+    the CrawlState. So the page is fetched at last update_dtm + interval + delay, see record for how delays are
+    measured.
+
+    If a fetch finds no update, the page is fetched again after a retry delay doubled on every miss, from
+    `min_retry` to `max_retry`.
+    """
+
+    def __init__(self, crawl_state, default_interval=timedelta(hours=1), default_delay=timedelta(minutes=20),
+                 min_retry=timedelta(minutes=2), max_retry=timedelta(minutes=30), history=24):
+        """
+        :param crawl_state: the CrawlState updated by crawls, from which update datetimes and delays are read
+        :param default_interval: interval of cities with less than two known update datetimes
+        :param default_delay: delay of cities without a known delay
+        :param history: number of recent update datetimes kept for every city
+        """
+        self.crawl_state = crawl_state
+        self.default_interval = default_interval
+        self.default_delay = default_delay
+        self.min_retry = min_retry
+        self.max_retry = max_retry
+        self.history = history
+        self.update_dtms = {}
+        self.misses = {}
+        self.next_fetch = {}
+
+    def learn(self, name, update_dtms):
+        """Add known update datetimes of a city, e.g. of its records in database."""
+        dtms = set(self.update_dtms.get(name, [])) | set(update_dtms)
+        self.update_dtms[name] = collections.deque(sorted(dtms), maxlen=self.history)
+
+    def add_cities(self, names, now):
+        """Schedule cities not scheduled yet, which are fetched as soon as possible."""
+        for name in names:
+            if name not in self.next_fetch:
+                self.misses[name] = 0
+                self.next_fetch[name] = self.get_expected_fetch(name) or now
+
+    def get_interval(self, name):
+        dtms = list(self.update_dtms.get(name, []))
+        intervals = [later - earlier for earlier, later in zip(dtms, dtms[1:])]
+        return median(intervals) if intervals else self.default_interval
+
+    def get_delay(self, name):
+        delays = self.crawl_state.get_delays(name)
+        return timedelta(seconds=median(delays)) if delays else self.default_delay
+
+    def get_expected_fetch(self, name):
+        """Return when the next update of a city is expected to be published, or None if nothing is known."""
+        dtms = self.update_dtms.get(name)
+        if not dtms:
+            return None
+        return dtms[-1] + self.get_interval(name) + self.get_delay(name)
+
+    def due(self, now):
+        """Return names of cities to fetch now, in the order they are due."""
+        return sorted((name for name, dtm in self.next_fetch.items() if dtm <= now), key=self.next_fetch.get)
+
+    def record(self, name, now):
+        """
+        Schedule the next fetch of a city after it is fetched, by comparing its update datetime in the crawl state
+        with the known ones.
+        """
+        update_dtm = self.crawl_state.get_update_dtm(name)
+        dtms = self.update_dtms.get(name)
+        if update_dtm is not None and (not dtms or update_dtm > dtms[-1]):
+            if dtms:
+                # After a miss, the update was published between the last fetch and now. Otherwise it may have
+                # been published any time before, so the delay is shortened to probe for earlier fetches.
+                delay = now - update_dtm
+                if not self.misses.get(name):
+                    delay = max(delay - self.min_retry, timedelta(0))
+                self.crawl_state.add_delay(name, delay.total_seconds(), keep=self.history)
+            self.learn(name, [update_dtm])
+            self.misses[name] = 0
+            self.next_fetch[name] = max(self.get_expected_fetch(name), now + self.min_retry)
+        else:
+            self.next_fetch[name] = now + self.get_retry_delay(self.misses.get(name, 0))
+            self.misses[name] = self.misses.get(name, 0) + 1
+
+    def get_retry_delay(self, misses):
+        return min(self.min_retry * 2 ** misses, self.max_retry)
@@ -7,6 +7,7 @@ from datetime import datetime
 import pytz
 
 import lxml.html as html
+from lxml import etree
 
 from .utils import (
     aggregate_keys_with_one_freq, calc_freq,
@@ -14,6 +15,96 @@ from .utils import (
 from . import rules
 
 
+# Compiled xpath mappings, keyed by the content of the mappings dict
+_compiled_mappings_cache = {}
+_string_xpath = etree.XPath('string()')
+_whitespace_pattern = re.compile(r'\s+')
+_update_dtm_pattern = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}')
+
+
+def compile_xpath_mappings(name_xpath_mappings):
+    """
+    Compile the xpath patterns of a name-xpath mappings dict into lxml.etree.XPath objects.
+
+    Compiled mappings are cached by the content of the mappings dict, so the patterns of the same mappings
+    are only compiled once per process.
+
+    :param name_xpath_mappings: a dict mapping info's name to xpath, see extract_info
+    :return: a dict with the same structure but with xpath strings replaced by XPath objects
+    """
+    cache_key = tuple(sorted(
+        (name, tuple(pattern) if isinstance(pattern, list) else pattern)
+        for name, pattern in name_xpath_mappings.items()
+    ))
+    if cache_key in _compiled_mappings_cache:
+        return _compiled_mappings_cache[cache_key]
+
+    compiled = {}
+    for info_name, xpath_pattern in name_xpath_mappings.items():
+        if isinstance(xpath_pattern, str):
+            compiled[info_name] = etree.XPath(xpath_pattern)
+        elif isinstance(xpath_pattern, list):
+            compiled[info_name] = [etree.XPath(pattern) for pattern in xpath_pattern]
+        else:
+            raise ValueError('Invalid name-xpath mappings.')
+
+    _compiled_mappings_cache[cache_key] = compiled
+    return compiled
+
+
+def compile_anchor_mappings(name_anchor_mappings):
+    """
+    Compile a name-anchor mappings dict used by extract_info_in_one_pass.
+
+    :param name_anchor_mappings: a dict mapping info's name to a pair of ((attribute, value), relative xpath)
+    :return: a pair of (XPath selecting every anchor element, dict mapping info's name to ((attribute, value),
+        compiled relative xpath))
+    """
+    cache_key = tuple(sorted(
+        (name, anchor, tuple(pattern) if isinstance(pattern, list) else pattern)
+        for name, (anchor, pattern) in name_anchor_mappings.items()
+    ))
+    if cache_key in _compiled_mappings_cache:
+        return _compiled_mappings_cache[cache_key]
+
+    predicates = []
+    compiled = {}
+    for info_name, (anchor, xpath_pattern) in name_anchor_mappings.items():
+        attr, value = anchor
+        if attr == 'class':
+            predicate = "contains(concat(' ', @class, ' '), ' {} ')".format(value)
+        else:
+            predicate = "@{}='{}'".format(attr, value)
+        if predicate not in predicates:
+            predicates.append(predicate)
+        compiled[info_name] = (anchor, compile_xpath_mappings({info_name: xpath_pattern})[info_name])
+
+    anchors_xpath = etree.XPath('//*[{}]'.format(' or '.join(predicates)))
+    _compiled_mappings_cache[cache_key] = (anchors_xpath, compiled)
+    return _compiled_mappings_cache[cache_key]
+
+
+def _extract_and_normalize_string_from_element(e):
+    return _whitespace_pattern.sub(' ', _string_xpath(e)).strip()
+
+
+def _normalize_and_preprocess(info_name, data, name_preprocessor_mappings, two_dimensions):
+    if not two_dimensions:
+        processed_list = list(map(_extract_and_normalize_string_from_element, data))
+        if info_name in name_preprocessor_mappings:
+            processed_list = name_preprocessor_mappings[info_name](processed_list)
+        return processed_list
+
+    has_preprocessor = (info_name in name_preprocessor_mappings)
+    data_rows = []
+    for row in data:
+        row = list(map(_extract_and_normalize_string_from_element, row))
+        if has_preprocessor:
+            row = name_preprocessor_mappings[info_name](row)
+        data_rows.append(row)
+    return data_rows
+
+
 def extract_info(html_string, name_xpath_mappings=rules.info_xpath_mappings,
                  name_preprocessor_mappings=rules.info_preprocessors):
     """
@@ -34,53 +125,104 @@ def extract_info(html_string, name_xpath_mappings=rules.info_xpath_mappings,
     a single string. In this way, you can process further such as split one value into multiple ones.
 
     Each info value will be in a list even if there is only one value.
+
+    The xpath patterns are compiled once by compile_xpath_mappings and reused across calls.
     """
     html_element = html.fromstring(html_string)
-
-    def extract_and_normalize_string_from_element(e):
-        return re.sub(r'\s+', ' ', e.xpath("string()")).strip()
+    compiled_mappings = compile_xpath_mappings(name_xpath_mappings)
 
     info_dict = {}
-    for info_name in name_xpath_mappings:
-        xpath_pattern = name_xpath_mappings[info_name]
-        if isinstance(xpath_pattern, str):
+    for info_name, xpath in compiled_mappings.items():
+        if isinstance(xpath, list):
+            # Two dimensions
+            data = [xpath[1](data_row) for data_row in xpath[0](html_element)]
+        else:
             # One dimension
-            data_list = html_element.xpath(xpath_pattern)
+            data = xpath(html_element)
 
-            processed_list = list(map(
-                extract_and_normalize_string_from_element,
-                data_list
-            ))
-            if info_name in name_preprocessor_mappings:
-                preprocessor = name_preprocessor_mappings[info_name]
-                processed_list = preprocessor(processed_list)
+        info_dict[info_name] = _normalize_and_preprocess(
+            info_name, data, name_preprocessor_mappings, isinstance(xpath, list)
+        )
 
-            info_dict[info_name] = processed_list
+    return info_dict
 
-        elif isinstance(xpath_pattern, list):
-            # Two dimensions
-            data_rows = html_element.xpath(xpath_pattern[0])
-            for i in range(len(data_rows)):
-                data_row = data_rows[i].xpath(xpath_pattern[1])
-                data_rows[i] = data_row
 
-            has_preprocessor = (info_name in name_preprocessor_mappings)
-            for i, row in enumerate(data_rows):
-                for j, cell in enumerate(row):
-                    cell = extract_and_normalize_string_from_element(cell)
-                    data_rows[i][j] = cell
+def extract_info_in_one_pass(html_string, name_anchor_mappings=rules.info_anchor_mappings,
+                             name_preprocessor_mappings=rules.info_preprocessors):
+    """
+    The same as extract_info, but walk the document only once.
+
+    Instead of evaluating one absolute xpath per info, every info is located by an anchor element
+    (an element with a certain class or id) and an xpath relative to it. All anchor elements are
+    collected by one traversal of the document, and the relative xpaths then only search the small
+    subtrees under the anchors.
 
-                if has_preprocessor:
-                    data_rows[i] = name_preprocessor_mappings[info_name](row)
+    :param html_string: a string containing html content
+    :param name_anchor_mappings: a dict mapping info's name to ((attribute, value), relative xpath),
+        see rules.info_anchor_mappings
+    :param name_preprocessor_mappings: a dict telling how to process data just after extracting
+    :return: a dict mapping info's name to a list of info(strings or lists of strings)
+    """
+    html_element = html.fromstring(html_string)
+    anchors_xpath, compiled_mappings = compile_anchor_mappings(name_anchor_mappings)
 
-            info_dict[info_name] = data_rows
+    # One walk of the document to classify anchor elements by (attribute, value)
+    anchors = {}
+    for element in anchors_xpath(html_element):
+        element_id = element.get('id')
+        if element_id is not None:
+            anchors.setdefault(('id', element_id), []).append(element)
+        for class_name in set(element.get('class', '').split()):
+            anchors.setdefault(('class', class_name), []).append(element)
 
-        else:
-            raise ValueError('Invalid name-xpath mappings.')
+    info_dict = {}
+    for info_name, (anchor, xpath) in compiled_mappings.items():
+        first_xpath = xpath[0] if isinstance(xpath, list) else xpath
+        # Anchors may be nested, so keep the results unique and in document order
+        data = []
+        seen = set()
+        for anchor_element in anchors.get(anchor, []):
+            for element in first_xpath(anchor_element):
+                if element not in seen:
+                    seen.add(element)
+                    data.append(element)
+        if isinstance(xpath, list):
+            data = [xpath[1](data_row) for data_row in data]
+
+        info_dict[info_name] = _normalize_and_preprocess(
+            info_name, data, name_preprocessor_mappings, isinstance(xpath, list)
+        )
 
     return info_dict
 
 
+def extract_update_dtm(html_string, marker='live_data_time', scan_length=500):
+    """
+    Find update datetime of a page without parsing it, by searching the datetime in the text after the first
+    `marker`, which is the class of the element holding it. This costs little compared to extract_info, so that
+    pages not updated since the last crawl can be skipped.
+
+    :param html_string: a string or bytes of html content
+    :return: the update datetime with utc timezone, or None if it is not found
+    """
+    if isinstance(html_string, bytes):
+        marker = marker.encode()
+    start = html_string.find(marker)
+    if start == -1:
+        return None
+    text = html_string[start:start + scan_length]
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', errors='ignore')
+    match = _update_dtm_pattern.search(text)
+    if match is None:
+        return None
+    try:
+        dtm = datetime.strptime(match.group(), '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+    return pytz.timezone('Asia/Shanghai').localize(dtm).astimezone(pytz.utc)
+
+
 def parse_info_dict(info_dict, info_patterns=rules.info_patterns, consts_mapping=rules.consts_pattern_field_mappings):
     """
     Try to parse the info dict returned by extract_info using the consts mapping to
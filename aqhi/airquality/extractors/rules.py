@@ -15,6 +15,22 @@ info_xpath_mappings = dict(
     station_quality_rows=["//table[@id='detail-data']/tbody//tr", "td[not(position()>11)]"]
 )
 
+# Web page info to (anchor, relative xpath) mapping, used by extractors.extract_info_in_one_pass
+# The anchor is an (attribute, value) pair. 'class' matches one of the element's classes while
+# other attributes match the whole value.
+info_anchor_mappings = dict(
+    city_quality_names=(('class', 'data'),
+                        "div[not(position() >= 9)]//*[contains(concat(' ', @class, ' '), ' caption ')]"),
+    city_quality_values=(('class', 'data'),
+                         "div[not(position() >= 9)]//*[contains(concat(' ', @class, ' '), ' value ')]"),
+    area_cn=(('class', 'city_name'), "*[count(*)=0]"),
+    update_dtm=(('class', 'live_data_time'), "p"),
+    quality=(('class', 'level'), "*[count(*)=0]"),
+    primary_pollutant=(('class', 'primary_pollutant'), "p"),
+    station_quality_names=(('id', 'detail-data'), "self::table/thead//th"),
+    station_quality_rows=(('id', 'detail-data'), ["self::table/tbody//tr", "td[not(position()>11)]"])
+)
+
 info_preprocessors = dict(
     update_dtm=lambda data_list: [re.search(r'([0-9]{4}\D.*$)', data).group() for data in data_list],
     primary_pollutant=lambda data_list:
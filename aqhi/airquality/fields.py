@@ -0,0 +1,41 @@
+from decimal import Decimal
+
+from django.db import models
+
+
+class ScaledDecimalField(models.DecimalField):
+    """
+    A DecimalField stored as an integer scaled by 10 ** decimal_places, which is smaller than a numeric column and
+    cheaper to read. Values are still Decimals in Python, so validation, lookups and serialization are unchanged.
+
+    Database aggregates other than Avg return scaled values converted back by this field. Avg returns a float of
+    the scaled values, use unscale() on it.
+    """
+    description = "Decimal number stored as a scaled integer"
+
+    def get_internal_type(self):
+        return 'IntegerField'
+
+    @property
+    def scale(self):
+        return 10 ** self.decimal_places
+
+    def unscale(self, value):
+        if value is None:
+            return None
+        return value / self.scale
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return None
+        return Decimal(int(value)).scaleb(-self.decimal_places)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None:
+            return None
+        return int(value.scaleb(self.decimal_places).to_integral_value())
+
+    def get_db_prep_save(self, value, connection):
+        return self.get_db_prep_value(value, connection)
@@ -77,11 +77,11 @@ class CityRecordFilter(filters.FilterSet):
 
 
 class StationRecordFilter(filters.FilterSet):
-    update_dtm = django_filters.IsoDateTimeFilter(name='city_record__update_dtm')
-    start_dtm = django_filters.IsoDateTimeFilter(name='city_record__update_dtm', lookup_expr='gte')
-    end_dtm = django_filters.IsoDateTimeFilter(name='city_record__update_dtm', lookup_expr='lte')
-    city = django_filters.CharFilter(name='city_record__city__name_en')
-    city_cn = django_filters.CharFilter(name='city_record__city__name_cn')
+    update_dtm = django_filters.IsoDateTimeFilter(name='update_dtm')
+    start_dtm = django_filters.IsoDateTimeFilter(name='update_dtm', lookup_expr='gte')
+    end_dtm = django_filters.IsoDateTimeFilter(name='update_dtm', lookup_expr='lte')
+    city = django_filters.CharFilter(name='city')
+    city_cn = django_filters.CharFilter(name='city__name_cn')
 
     order_by_field = 'ordering'
 
@@ -93,3 +93,29 @@ class StationRecordFilter(filters.FilterSet):
                     'pm2_5', '-pm2_5', 'pm10', '-pm10', 'o3', '-o3', 'o3_8h', '-o3_8h']
 
 
+class CityRollupFilter(filters.FilterSet):
+    start_dtm = django_filters.IsoDateTimeFilter(name='start_dtm', lookup_expr='gte')
+    end_dtm = django_filters.IsoDateTimeFilter(name='start_dtm', lookup_expr='lte')
+    city = CommaSeperatedMultipleCharFilter(name='city__name_en')
+    city_cn = django_filters.CharFilter(name='city__name_cn')
+
+    order_by_field = 'ordering'
+
+    class Meta:
+        model = models.CityRollup
+        fields = ['period']
+        order_by = ['start_dtm', '-start_dtm']
+
+
+class StationRollupFilter(filters.FilterSet):
+    start_dtm = django_filters.IsoDateTimeFilter(name='start_dtm', lookup_expr='gte')
+    end_dtm = django_filters.IsoDateTimeFilter(name='start_dtm', lookup_expr='lte')
+    city = django_filters.CharFilter(name='station__city__name_en')
+    city_cn = django_filters.CharFilter(name='station__city__name_cn')
+
+    order_by_field = 'ordering'
+
+    class Meta:
+        model = models.StationRollup
+        fields = ['station', 'period']
+        order_by = ['start_dtm', '-start_dtm']
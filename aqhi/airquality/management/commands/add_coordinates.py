@@ -7,15 +7,19 @@ from functools import partial
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
-from aqhi.airquality.models import Station, City
+from aqhi.airquality.models import Station, City, name_registry
 
 
 def add_coord_to_station_by_name(city_name_cn, station_name_cn, lng, lat, override=False):
-    station = Station.objects.filter(city__name_cn=city_name_cn, name_cn=station_name_cn)
-    if not station.exists():
+    station_pk = None
+    for city_pk in name_registry.city_pks_by_name_cn(city_name_cn):
+        station_pk = name_registry.station_pk(city_pk, station_name_cn)
+        if station_pk is not None:
+            break
+    if station_pk is None:
         raise CommandError('Station not found: {}, {}.'.format(station_name_cn, city_name_cn))
 
-    station = station[0]
+    station = Station.objects.get(pk=station_pk)
     old_lng = station.longitude
     if (old_lng and override) or not old_lng:
         station.longitude = Decimal(lng)
@@ -31,13 +35,13 @@ def add_coord_to_station_by_name(city_name_cn, station_name_cn, lng, lat, overri
 
 
 def add_coord_to_city_by_name(city_name_cn, lng, lat, override=False):
-    city = City.objects.filter(name_cn=city_name_cn)
-    if not city.exists():
+    city_pks = name_registry.city_pks_by_name_cn(city_name_cn)
+    if not city_pks:
         raise CommandError('City not found: {}.'.format(city_name_cn))
-    if len(city) > 1:
+    if len(city_pks) > 1:
         raise CommandError('Duplicate cities not found: {}.'.format(city_name_cn))
 
-    city = city[0]
+    city = City.objects.get(pk=city_pks[0])
     old_lng = city.longitude
     if (old_lng and override) or not old_lng:
         city.longitude = Decimal(lng)
@@ -97,6 +101,7 @@ class Command(BaseCommand):
             map(partial(zip, headers), data_rows)
         ))
 
+        name_registry.load()
         with transaction.atomic():
             add_func = (
                 add_coord_to_station_by_name
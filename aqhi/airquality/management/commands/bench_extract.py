@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from aqhi.airquality import extractors
+
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'tests', 'files')
+
+
+class Command(BaseCommand):
+    help = "Benchmark extract_info against extract_info_in_one_pass on html files. " \
+           "The test fixture pages are used by default."
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='*',
+                            help='html files to extract info from, defaults to the fixture pages')
+        parser.add_argument('-n', '--number', type=int, default=100,
+                            help='how many times to extract each page')
+
+    def handle(self, *args, **options):
+        file_names = options['pages'] or sorted(glob.glob(os.path.join(TEST_FILES_DIR, '*.html')))
+        if not file_names:
+            raise CommandError('No html files found.')
+
+        pages = []
+        for file_name in file_names:
+            with open(file_name, encoding='utf-8') as f:
+                pages.append(f.read())
+
+        # Make sure both extractors agree before timing them
+        for file_name, page in zip(file_names, pages):
+            if extractors.extract_info(page) != extractors.extract_info_in_one_pass(page):
+                raise CommandError('Extractors disagree on {}.'.format(file_name))
+
+        number = options['number']
+        results = {}
+        for func in [extractors.extract_info, extractors.extract_info_in_one_pass]:
+            seconds = timeit.timeit(lambda: [func(page) for page in pages], number=number)
+            results[func.__name__] = seconds / (number * len(pages))
+            self.stdout.write('{}: {:.3f} ms per page'.format(func.__name__, results[func.__name__] * 1000))
+
+        self.stdout.write(self.style.SUCCESS('Speedup of one pass extraction: {:.2f}x over {} pages.'.format(
+            results['extract_info'] / results['extract_info_in_one_pass'],
+            len(pages)
+        )))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import glob
+import itertools
+import os
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, models as dj_models, transaction
+from django.utils import timezone
+
+from aqhi.airquality import fields, models
+from aqhi.airquality.management.commands.collect_records import parse_page
+
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'tests', 'files')
+
+# Models are registered once per process
+_bench_models = {}
+
+
+def get_bench_model(name, field_class):
+    """Return an unmanaged model with update_dtm and DECIMAL_FIELDS of field_class, in table airquality_bench_<name>."""
+    if name not in _bench_models:
+        attrs = {
+            '__module__': __name__,
+            'Meta': type('Meta', (), {'app_label': 'airquality', 'db_table': 'airquality_bench_{}'.format(name),
+                                      'managed': False}),
+            'update_dtm': dj_models.DateTimeField(),
+        }
+        for field in models.DECIMAL_FIELDS:
+            attrs[field] = field_class(max_digits=models.POLL_MAX_DIGITS, decimal_places=models.POLL_DECIMAL_PLACES,
+                                       null=True, blank=True)
+        _bench_models[name] = type('Bench{}Record'.format(name.capitalize()), (dj_models.Model, ), attrs)
+    return _bench_models[name]
+
+
+def get_table_size(table):
+    """Return the size of a table with its indexes in bytes, or None if the database can not tell."""
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT pg_total_relation_size(%s)'
+    elif connection.vendor == 'sqlite':
+        sql = 'SELECT SUM(pgsize) FROM dbstat WHERE name = %s'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT data_length + index_length FROM information_schema.tables ' \
+              'WHERE table_schema = DATABASE() AND table_name = %s'
+    else:
+        return None
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            return cursor.fetchone()[0]
+    except DatabaseError:
+        # e.g. SQLite compiled without the dbstat table
+        return None
+
+
+def bench_model(model, rows, batch_size):
+    """Insert rows into the table of model, then read and aggregate them, and return timings and table size."""
+    fields_ = models.DECIMAL_FIELDS
+    start = time.perf_counter()
+    with transaction.atomic():
+        model.objects.bulk_create([model(**row) for row in rows], batch_size=batch_size)
+    insert_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    list(model.objects.values_list(*fields_))
+    read_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    averages = model.objects.aggregate(**{field: dj_models.Avg(field) for field in fields_})
+    aggregate_seconds = time.perf_counter() - start
+    for field in fields_:
+        unscale = getattr(model._meta.get_field(field), 'unscale', None)
+        if unscale is not None:
+            averages[field] = unscale(averages[field])
+
+    return {
+        'insert_rate': len(rows) / insert_seconds,
+        'read_ms': read_seconds * 1000,
+        'aggregate_ms': aggregate_seconds * 1000,
+        'size': get_table_size(model._meta.db_table),
+        'averages': averages,
+    }
+
+
+class Command(BaseCommand):
+    help = "Benchmark decimal against scaled integer storage of pollutant fields, with table size, insert rate " \
+           "and aggregation speed of records built from html files. The test fixture pages are used by default. " \
+           "Records are written to temporary tables, which are dropped afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='*',
+                            help='html files to build records from, defaults to the fixture pages')
+        parser.add_argument('-n', '--records', type=int, default=100000,
+                            help='how many records to insert into each table')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='number of records inserted at once')
+
+    def handle(self, *args, **options):
+        file_names = options['pages'] or sorted(glob.glob(os.path.join(TEST_FILES_DIR, '*.html')))
+        values = []
+        for file_name in file_names:
+            with open(file_name, encoding='utf-8') as f:
+                _, info_dict, exception = parse_page((file_name, f.read()))
+            if exception is not None:
+                continue
+            for record_dict in [info_dict['city']] + list(info_dict['stations'].values()):
+                values.append({
+                    field: record_dict.get(field) if isinstance(record_dict.get(field), (int, Decimal)) else None
+                    for field in models.DECIMAL_FIELDS
+                })
+        if not values:
+            raise CommandError('No records found in html files.')
+
+        # Spread records over hours as they are in record tables
+        base_dtm = timezone.make_aware(datetime(2016, 1, 1))
+        rows = [
+            dict(row, update_dtm=base_dtm + timedelta(hours=i // len(values)))
+            for i, row in zip(range(options['records']), itertools.cycle(values))
+        ]
+
+        results = {}
+        for name, field_class in [('decimal', dj_models.DecimalField), ('scaled', fields.ScaledDecimalField)]:
+            model = get_bench_model(name, field_class)
+            with connection.schema_editor() as editor:
+                editor.create_model(model)
+            try:
+                results[name] = bench_model(model, rows, options['batch_size'])
+            finally:
+                with connection.schema_editor() as editor:
+                    editor.delete_model(model)
+
+            result = results[name]
+            self.stdout.write('{}: {:.0f} records/s inserted, {:.1f} ms to read, {:.1f} ms to aggregate, {}'.format(
+                name, result['insert_rate'], result['read_ms'], result['aggregate_ms'],
+                'table size unknown' if result['size'] is None else '{} bytes'.format(result['size'])
+            ))
+
+        # Both representations must hold the same values
+        for field in models.DECIMAL_FIELDS:
+            decimal_avg, scaled_avg = results['decimal']['averages'][field], results['scaled']['averages'][field]
+            if (decimal_avg is None) != (scaled_avg is None) or \
+                    (decimal_avg is not None and abs(decimal_avg - scaled_avg) > 1e-6):
+                raise CommandError('Averages of {} disagree: {} and {}.'.format(field, decimal_avg, scaled_avg))
+
+        decimal, scaled = results['decimal'], results['scaled']
+        self.stdout.write(self.style.SUCCESS(
+            'Scaled over decimal storage of {} records: {:.2f}x insert rate, {:.2f}x read speed, '
+            '{:.2f}x aggregation speed{}.'.format(
+                len(rows),
+                scaled['insert_rate'] / decimal['insert_rate'],
+                decimal['read_ms'] / scaled['read_ms'],
+                decimal['aggregate_ms'] / scaled['aggregate_ms'],
+                '' if decimal['size'] is None or scaled['size'] is None
+                else ', {:.2f}x table size'.format(scaled['size'] / decimal['size'])
+            )
+        ))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from aqhi.airquality import models
+
+
+class Command(BaseCommand):
+    help = "Add all city and station records to the time series store in AIRQUALITY_TIMESERIES_DIR. \n" \
+           "Values of existing hours in the store are overwritten."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='number of records read from database at once')
+
+    def handle(self, *args, **options):
+        store = models.get_timeseries_store()
+        if store is None:
+            raise CommandError('AIRQUALITY_TIMESERIES_DIR is not set.')
+
+        for kind, queryset, entity_field in [
+            ('city', models.CityRecord.objects.all(), 'city'),
+            ('station', models.StationRecord.objects.all(), 'station'),
+        ]:
+            fields = [entity_field, 'update_dtm'] + store.fields
+            count = 0
+            for chunk in queryset.scan(*fields, chunk_size=options['batch_size']):
+                for row in chunk:
+                    store.add(kind, row[0], row[1], dict(zip(store.fields, row[2:])))
+                store.flush()
+                count += len(chunk)
+            self.stdout.write('Total {} {} records added.'.format(count, kind))
+
+        self.stdout.write(self.style.SUCCESS('Successfully built time series store in {}.'.format(store.root)))
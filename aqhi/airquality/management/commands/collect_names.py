@@ -11,7 +11,7 @@ from django.core.exceptions import ValidationError
 from aqhi.airquality.utils import get_ssh_client, get_html_files_from_dir
 from aqhi.airquality import extractors
 from aqhi.airquality.extractors import ssh_exception
-from aqhi.airquality.models import City, Station
+from aqhi.airquality.models import City, Station, name_registry
 
 
 class Command(BaseCommand):
@@ -83,6 +83,7 @@ class Command(BaseCommand):
         total_city = 0
         total_station = 0
 
+        name_registry.load()
         try:
             with transaction.atomic():
                 for file_name, content in get_html_files_from_dir(pages_dir, client, city_names=options['city']):
@@ -94,6 +95,9 @@ class Command(BaseCommand):
                     )
                     name_en = re.search(r'([a-z]+)\.html', file_name).group(1)
                     name_cn = info_dict['city']['area_cn']
+                    if name_registry.city_pk(name_en) is not None:
+                        self.count_duplicates(city_duplicates, name_en)
+                        continue
                     try:
                         city = City.objects.validate_and_create(name_en=name_en, name_cn=name_cn)
                     except ValidationError:
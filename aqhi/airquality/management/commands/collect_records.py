@@ -1,16 +1,70 @@
 # -*- coding: utf-8 -*-
 import getpass
+import itertools
+import multiprocessing
 import re
 import os.path
 import pprint
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
+from django.db import connections
 
 from aqhi.airquality.utils import get_ssh_client, get_html_files_from_dir
-from aqhi.airquality import extractors, utils
+from aqhi.airquality import extractors, caching
 from aqhi.airquality.extractors import ssh_exception
-from aqhi.airquality.models import create_city_record
+from aqhi.airquality.models import create_city_records
+
+
+def parse_page(page):
+    """
+    Parse one (file_name, content) pair yielded by get_html_files_from_dir.
+
+    This runs in worker processes, so it never touches database and never raises. Any exception is
+    returned instead.
+
+    :return: a tuple of (file_name, info_dict, exception_repr) with either info_dict or exception_repr None
+    """
+    file_name, content = page
+    try:
+        info_dict = extractors.process_parsed_dict(
+            extractors.parse_info_dict(
+                extractors.extract_info_in_one_pass(content)
+            )
+        )
+        info_dict['city']['area_en'] = re.search(r'([a-z]+)\.html', file_name).group(1)
+    except Exception as e:
+        return file_name, None, repr(e)
+    return file_name, info_dict, None
+
+
+def parse_in_batches(pages, batch_size, pool=None):
+    """
+    Parse pages batch by batch with parse_page, yielding a list of results for each batch.
+
+    Only a bounded number of pages are in flight. With a process pool, the next batch is parsed by workers
+    while the caller is handling the current one.
+
+    :param pages: an iterator of (file_name, content) pairs
+    :param batch_size: max number of pages in one batch
+    :param pool: an optional multiprocessing.Pool
+    """
+    def next_batch():
+        return list(itertools.islice(pages, batch_size))
+
+    if pool is None:
+        batch = next_batch()
+        while batch:
+            yield list(map(parse_page, batch))
+            batch = next_batch()
+        return
+
+    batch = next_batch()
+    pending = pool.map_async(parse_page, batch) if batch else None
+    while pending is not None:
+        parsed_batch = pending.get()
+        batch = next_batch()
+        pending = pool.map_async(parse_page, batch) if batch else None
+        yield parsed_batch
 
 
 class Command(BaseCommand):
@@ -26,6 +80,10 @@ class Command(BaseCommand):
                                  'If no username is provided, then it will try to get current system username.')
         parser.add_argument('--city', action='append',
                             help='the city name to collect, file name without .html is the city name')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='number of processes parsing pages, while saving is always done by one process')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='number of pages parsed and saved in one transaction')
         ssh_group = parser.add_argument_group('SSH', 'options for using ssh')
         ssh_group.add_argument('--ssh', action='store_true',
                                help='whether to access pages_dir through ssh')
@@ -77,26 +135,37 @@ class Command(BaseCommand):
             except ssh_exception.ConnectionTimeOut:
                 raise CommandError('Connection timed out.')
 
+        workers = options['workers']
+        batch_size = options['batch_size']
+        if workers < 1 or batch_size < 1:
+            raise CommandError('--workers and --batch-size must be positive integers.')
+
         # Collect any error info for each file
         errors = []
         # Collect update datetime for each successful creation classified by city
         success = {}
-        try:
-            with transaction.atomic():
-                for file_name, content in get_html_files_from_dir(pages_dir, client, city_names=options['city']):
-                    info_dict = utils.append_extra_fileds(
-                        extractors.process_parsed_dict(
-                            extractors.parse_info_dict(
-                                extractors.extract_info(content)
-                            )
-                        )
-                    )
-                    name_en = re.search(r'([a-z]+)\.html', file_name).group(1)
-                    info_dict['city']['area_en'] = name_en
 
+        pages = get_html_files_from_dir(pages_dir, client, city_names=options['city'])
+        pool = None
+        if workers > 1:
+            # Workers only parse pages, so they must not share the parent's database connections
+            connections.close_all()
+            pool = multiprocessing.Pool(workers)
+
+        # Invalidate cached API responses once after all batches
+        caching.begin_batch()
+        try:
+            for parsed_batch in parse_in_batches(pages, batch_size, pool):
+                for file_name, info_dict, exception in parsed_batch:
+                    if exception is not None:
+                        raise CommandError('Exception raised from {}: {}'.format(file_name, exception))
+
+                # Only this process writes to database, saving a whole batch at once
+                results = create_city_records(info_dict for _, info_dict, _ in parsed_batch)
+                for (file_name, info_dict, _), result in zip(parsed_batch, results):
+                    name_en = info_dict['city']['area_en']
                     rel_path = os.path.relpath(file_name, pages_dir)
 
-                    result = create_city_record(info_dict)
                     if result['success'] == 0:
                         del result['success']
                         result['file'] = rel_path
@@ -109,11 +178,15 @@ class Command(BaseCommand):
                         record = result['info']
                         success[name_en].append(record.update_dtm)
         except Exception as e:
-            self.stderr.write('Exception raised from {}: {}'.format(file_name, repr(e)))
+            self.stderr.write('Exception raised: {}'.format(repr(e)))
             raise e
+        finally:
+            if pool:
+                pool.terminate()
+            caching.end_batch()
 
         error_num = len(errors)
-        success_num_by_city = dict(map(lambda item: (item[0], len(item[1])), success))
+        success_num_by_city = dict(map(lambda item: (item[0], len(item[1])), success.items()))
         success_num = sum(success_num_by_city.values())
 
         self.stdout.write('Successfully collect {} city records.'.format(success_num))
@@ -125,5 +198,5 @@ class Command(BaseCommand):
             self.stdout.write('file: {}, type: {}, info: {}'.format(
                 error['file'], error['error_type'], error['info']
             ))
-            if error['error_type'] in {'ValidationError' or 'ValueError'}:
+            if error['error_type'] in {'ValidationError', 'ValueError'}:
                 self.stdout.write('{}'.format(pprint.pformat(error['info_dict'])))
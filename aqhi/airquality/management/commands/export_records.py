@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import dateparse, timezone
+
+from aqhi.airquality import archive, models
+
+
+class Command(BaseCommand):
+    help = "Export city or station records to a compressed NumPy .npz file with one array per column. " \
+           "Records can be limited to cities, stations and a range of update_dtm."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['city', 'station'], help='export city records or station records')
+        parser.add_argument('output', help='path of the .npz file')
+        parser.add_argument('--city', help='comma separated name_en of cities')
+        parser.add_argument('--station', help='comma separated name_cn of stations, only for station records')
+        parser.add_argument('--start-dtm', help='ISO datetime, only records updated at or after it are exported')
+        parser.add_argument('--end-dtm', help='ISO datetime, only records updated at or before it are exported')
+        parser.add_argument('--fields', help='comma separated pollutant fields to export, defaults to all')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='number of records read at once')
+
+    def handle(self, *args, **options):
+        if options['kind'] == 'city':
+            queryset = models.CityRecord.objects.all()
+            if options['station']:
+                raise CommandError('--station is only for station records.')
+        else:
+            queryset = models.StationRecord.objects.all()
+            if options['station']:
+                queryset = queryset.filter(station__name_cn__in=self.split(options['station']))
+        if options['city']:
+            queryset = queryset.filter(city__in=self.split(options['city']))
+        if options['start_dtm']:
+            queryset = queryset.filter(update_dtm__gte=self.parse_datetime(options['start_dtm']))
+        if options['end_dtm']:
+            queryset = queryset.filter(update_dtm__lte=self.parse_datetime(options['end_dtm']))
+
+        fields = None
+        if options['fields']:
+            fields = self.split(options['fields'])
+            invalid_fields = [f for f in fields if f not in models.DECIMAL_FIELDS]
+            if invalid_fields:
+                raise CommandError('Invalid fields: {}.'.format(', '.join(invalid_fields)))
+
+        count = archive.write_archive(queryset, options['output'], fields=fields, chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Successfully exported {} {} records to {}.'.format(
+            count, options['kind'], options['output']
+        )))
+
+    @staticmethod
+    def split(value):
+        return [v for v in value.split(',') if v]
+
+    @staticmethod
+    def parse_datetime(value):
+        try:
+            dtm = dateparse.parse_datetime(value)
+        except ValueError:
+            dtm = None
+        if dtm is None:
+            raise CommandError('Invalid datetime: {}.'.format(value))
+        if timezone.is_naive(dtm):
+            dtm = timezone.make_aware(dtm)
+        return dtm
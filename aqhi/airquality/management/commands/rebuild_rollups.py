@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from aqhi.airquality import models
+
+
+class Command(BaseCommand):
+    help = """Rebuild daily and monthly rollups of cities and stations from all records. \n
+           Existing rollups are deleted first. Rollups follow records created, deleted or updated by update_aqhi,
+           so this is only needed after records are changed otherwise, e.g. with raw SQL."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='number of records added to rollups at once')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        with transaction.atomic():
+            models.CityRollup.objects.all().delete()
+            models.StationRollup.objects.all().delete()
+
+            count = 0
+            for chunk in models.CityRecord.objects.scan(chunk_size=batch_size):
+                models.update_rollups(chunk, [])
+                count += len(chunk)
+            self.stdout.write('Total {} city records added to rollups.'.format(count))
+
+            count = 0
+            for chunk in models.StationRecord.objects.scan(chunk_size=batch_size):
+                models.update_rollups([], chunk)
+                count += len(chunk)
+            self.stdout.write('Total {} station records added to rollups.'.format(count))
+
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt {} city rollups and {} station rollups.'.format(
+            models.CityRollup.objects.count(), models.StationRollup.objects.count()
+        )))
@@ -0,0 +1,155 @@
+import logging
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.log import configure_logging
+from scrapy.utils.project import get_project_settings
+from twisted.internet import defer, reactor, task
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from aqhi.airquality import models
+from aqhi.airquality.crawler.pm25in.spiders.pm25in_spider import AQISpider
+from aqhi.airquality.crawler.scheduler import CrawlScheduler
+from aqhi.airquality.utils import CrawlState
+
+
+class Command(BaseCommand):
+    help = "Crawl city pages from pm25.in continuously in one process. Each city is fetched just after its next " \
+           "update is expected, learnt from update datetimes of its records and pages, and fetched again with " \
+           "backoff until the update is found. Pages are saved in a directory of each hour under dest."
+
+    def add_arguments(self, parser):
+        parser.add_argument('dest', help='the parent directory to save the pages')
+        parser.add_argument('-l', '--log', help="log file path which defaults to 'log.txt' under dest")
+        parser.add_argument('--state-file',
+                            help="file of update times, ETags and Last-Modified headers of crawled pages and delays "
+                                 "of their updates. Defaults to 'crawl_state.json' under dest")
+        parser.add_argument('--tick', type=float, default=30,
+                            help='seconds between checks of cities to fetch')
+        parser.add_argument('--refresh', type=float, default=3600,
+                            help='seconds between reloads of cities from database, to schedule cities added since')
+        parser.add_argument('--max-cities', type=int, default=50,
+                            help='max number of cities fetched by one crawl, 0 for no limit')
+        parser.add_argument('--not-parse', action='store_false',
+                            help='whether to parse crawled pages and save data to db.')
+
+    def handle(self, *args, **options):
+        self.dest = os.path.expanduser(options['dest'])
+        os.makedirs(self.dest, exist_ok=True)
+        self.to_parse = options['not_parse']
+        self.max_cities = options['max_cities']
+
+        self.crawl_state = CrawlState(os.path.expanduser(
+            options['state_file'] or os.path.join(self.dest, 'crawl_state.json')
+        ))
+        self.scheduler = get_scheduler(self.crawl_state, timezone.now())
+        if not self.scheduler.next_fetch:
+            # Only pages of known cities are crawled, never the index page
+            raise CommandError('No city is in database or the state file. Run start_crawl or collect_names first.')
+
+        log_file_path = os.path.expanduser(options['log'] or os.path.join(self.dest, 'log.txt'))
+        log_file_handler = logging.FileHandler(log_file_path)
+        log_file_handler.setFormatter(logging.Formatter(
+            fmt='%(asctime)s [%(name)s] %(levelname)s: %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S',
+        ))
+        self.logger = logging.getLogger('pm25in')
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(log_file_handler)
+
+        self.refresh_interval = timedelta(seconds=options['refresh'])
+        self.refreshed = timezone.now()
+
+        settings = get_project_settings()
+        settings.set('LOG_FILE', log_file_path)
+        # Unlike CrawlerProcess, CrawlerRunner leaves logging to its caller
+        configure_logging(settings)
+        self.runner = CrawlerRunner(settings)
+        self.crawling = False
+
+        loop = task.LoopingCall(self.tick)
+        loop.start(options['tick'])
+        self.stdout.write('Start scheduling crawls of {} cities.'.format(len(self.scheduler.next_fetch)))
+        reactor.run()
+
+    def tick(self):
+        # An exception would stop the LoopingCall for good, so it is only logged and the next tick tries again
+        try:
+            # Queries on this thread, by refresh_cities and pipelines opening, never run in a request, so the
+            # connection is dropped here if it is broken, e.g. by a database restart, or too old
+            close_old_connections()
+            now = timezone.now()
+            if now - self.refreshed >= self.refresh_interval:
+                self.refresh_cities(now)
+            self.crawl_due(now)
+        except Exception:
+            self.logger.exception('Fail to schedule crawls.')
+
+    def refresh_cities(self, now):
+        """Schedule cities added to database since the last refresh."""
+        # Not retried before the next refresh if the query fails
+        self.refreshed = now
+        names = get_city_names(self.crawl_state) - set(self.scheduler.next_fetch)
+        if names:
+            self.logger.info('Schedule {} new cities: {}.'.format(len(names), ', '.join(sorted(names))))
+            self.scheduler.add_cities(sorted(names), now)
+
+    def crawl_due(self, now):
+        # Crawls never overlap, so pipelines of two crawls never share the in-process caches
+        if self.crawling:
+            return
+        due = self.scheduler.due(now)
+        if self.max_cities:
+            due = due[:self.max_cities]
+        if not due:
+            return
+
+        res_dir = os.path.join(self.dest, timezone.localtime(now).strftime('%Y-%m-%d-%H'))
+        os.makedirs(res_dir, exist_ok=True)
+        self.logger.info('Fetch {} cities: {}.'.format(len(due), ', '.join(due)))
+        self.crawling = True
+        # Exceptions raised when the crawl starts are handled like failed crawls, so crawling is reset
+        d = defer.maybeDeferred(self.runner.crawl, AQISpider, res_dir=res_dir, logger=self.logger, page_num=0,
+                                to_parse=self.to_parse, crawl_state=self.crawl_state, city_names=due)
+        d.addErrback(lambda failure: self.logger.error('Crawl failed: {}'.format(failure.getErrorMessage())))
+        d.addBoth(self.crawled, due)
+
+    def crawled(self, _, names):
+        try:
+            now = timezone.now()
+            for name in names:
+                self.scheduler.record(name, now)
+            # Like AQISpider.closed, pages only backed up are not saved as crawled
+            if self.to_parse:
+                self.crawl_state.save()
+        finally:
+            self.crawling = False
+
+
+def get_scheduler(crawl_state, now, days=2):
+    """
+    Create a CrawlScheduler of all cities in database or crawl_state, learning from update datetimes of their
+    records in the last `days` days and in crawl_state.
+    """
+    scheduler = CrawlScheduler(crawl_state)
+    update_dtms = defaultdict(list)
+    for city, update_dtm in models.CityRecord.objects.filter(
+        update_dtm__gte=now - timedelta(days=days)
+    ).order_by().values_list('city', 'update_dtm'):
+        update_dtms[city].append(update_dtm)
+
+    names = get_city_names(crawl_state)
+    for name in names:
+        state_dtm = crawl_state.get_update_dtm(name)
+        scheduler.learn(name, update_dtms[name] + ([state_dtm] if state_dtm is not None else []))
+    scheduler.add_cities(sorted(names), now)
+    return scheduler
+
+
+def get_city_names(crawl_state):
+    """Return names of all cities in database or crawl_state."""
+    return set(models.City.objects.values_list('name_en', flat=True)) | set(crawl_state.pages)
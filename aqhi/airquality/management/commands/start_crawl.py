@@ -11,7 +11,7 @@ from pydispatch import dispatcher
 from django.core.management.base import BaseCommand
 
 from aqhi.airquality.crawler.pm25in.spiders.pm25in_spider import AQISpider
-from aqhi.airquality.utils import buptnet
+from aqhi.airquality.utils import buptnet, CrawlState
 
 
 def positive_integer(string):
@@ -47,6 +47,12 @@ class Command(BaseCommand):
                                  '(for debugging)')
         parser.add_argument('--not-parse', action='store_false',
                             help='whether to parse crawled pagees and save data to db.')
+        parser.add_argument('--state-file',
+                            help="file of update times, ETags and Last-Modified headers of crawled pages, used to "
+                                 "skip pages not updated since the last crawl. Defaults to 'crawl_state.json' "
+                                 "under dest")
+        parser.add_argument('--full', action='store_true',
+                            help='crawl and save all pages even if they are not updated since the last crawl')
 
         return parser
 
@@ -63,6 +69,7 @@ class Command(BaseCommand):
                 )
             else:
                 os.makedirs(root_dir)
+        state_file_path = os.path.expanduser(options['state_file'] or os.path.join(root_dir, 'crawl_state.json'))
         if not options['absolute']:
             root_dir = os.path.join(root_dir, datetime.now(pytz.utc).astimezone().strftime("%Y-%m-%d-%H-%M-%S"))
             os.makedirs(root_dir)
@@ -126,6 +133,7 @@ class Command(BaseCommand):
             res_dir=root_dir,
             logger=crawler_logger,
             page_num=options['page_num'],
-            to_parse=options['not_parse']
+            to_parse=options['not_parse'],
+            crawl_state=CrawlState(state_file_path, load=not options['full'])
         )
         process.start()
@@ -1,19 +1,82 @@
 # -*- coding: utf-8 -*-
-from decimal import Decimal
+from datetime import timedelta
 
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
+from aqhi.airquality import caching
 from aqhi.airquality import utils
 from aqhi.airquality import models
 
 
-def update_record(record, override=False):
-    if record.aqhi is None or override:
-        record.aqhi = record.calculate_aqhi_field()
-        record.save()
-        return True
-    return False
+def update_records(queryset, entity_field, override=False, batch_size=10000, checkpoint=None, checkpoint_name=None):
+    """
+    Calculate aqhi of all records in a queryset and save it.
+
+    Records are scanned in chunks ordered by time with keyset pagination, so only one chunk and the 3-hour
+    windows of cities or stations are kept in memory. Changed values of a chunk are written back in batched
+    UPDATEs in their own transaction, after which the checkpoint, if any, is saved.
+
+    The UPDATEs send no signals, so the AQHI level counts of rollups are moved along in the same transaction,
+    the time series store, if enabled, is updated after it is committed, and cached responses of the changed
+    records are invalidated by their cities and update datetimes.
+
+    :param queryset: a CityRecord or StationRecord queryset
+    :param entity_field: the field identifying the city or station of a record
+    :param override: whether to re-calculate and override existing aqhi
+    :param batch_size: number of records calculated and written at once
+    :param checkpoint: a utils.ScanCheckpoint to resume from and save progress to
+    :param checkpoint_name: name of the scan in the checkpoint
+    :return: number of updated records
+    """
+    dtm_field = queryset.scan_dtm_field
+    after = checkpoint.get(checkpoint_name) if checkpoint else None
+    if after is not None:
+        # Records in the two hours before the checkpoint are scanned again to fill the 3-hour windows,
+        # but not written
+        queryset = queryset.filter(**{dtm_field + '__gte': after[0] - timedelta(hours=2)})
+
+    model = queryset.model
+    rollup_model = models.CityRollup if model is models.CityRecord else models.StationRollup
+    kind = 'city' if model is models.CityRecord else 'station'
+    fields = ['pk', 'aqhi', entity_field, dtm_field] + list(utils.aqhi_pollutants)
+    # Cached responses are invalidated by city, which station records have as well
+    if entity_field != 'city':
+        fields.append('city')
+    calc_length = 4 + len(utils.aqhi_pollutants)
+    city_index = fields.index('city')
+
+    calculator = utils.RollingAqhiCalculator()
+    count = 0
+    for chunk in queryset.scan(*fields, chunk_size=batch_size):
+        changed = {}
+        changes = []
+        cities = set()
+        dtms = set()
+        for row, (pk, old_value, new_value) in zip(chunk, calculator.calculate(row[:calc_length] for row in chunk)):
+            if after is not None and (row[3], pk) <= after:
+                continue
+            if old_value is not None and not override:
+                continue
+            count += 1
+            # Rows whose value does not change need no write
+            if new_value != old_value:
+                changed[pk] = new_value
+                changes.append((row[2], row[3], old_value, new_value))
+                cities.add(row[city_index])
+                dtms.add(row[3])
+
+        if changed:
+            with transaction.atomic():
+                model.objects.update_in_bulk('aqhi', changed)
+                models.update_rollup_aqhi(rollup_model, entity_field + '_id', changes)
+                models.update_timeseries_on_commit(
+                    kind, 'aqhi', [(entity, dtm, new_value) for entity, dtm, _, new_value in changes]
+                )
+            caching.touch(model._meta.model_name, cities=cities, dtms=dtms)
+        if checkpoint:
+            checkpoint.set(checkpoint_name, (chunk[-1][3], chunk[-1][0]))
+    return count
 
 
 class Command(BaseCommand):
@@ -23,20 +86,23 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--override', action='store_true',
                             help='whether to re-calculate and override the original value')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='number of records calculated and written at once')
+        parser.add_argument('--checkpoint',
+                            help='a file to save progress to, and to resume from if it exists. '
+                                 'It is deleted when all records are updated')
 
     def handle(self, *args, **options):
         override = options['override']
-        count = 0
-        with transaction.atomic():
-            for city_record in models.CityRecord.objects.all():
-                if update_record(city_record, override):
-                    count += 1
+        batch_size = options['batch_size']
+        checkpoint = utils.ScanCheckpoint(options['checkpoint']) if options['checkpoint'] else None
 
+        count = update_records(models.CityRecord.objects.all(), 'city', override, batch_size, checkpoint, 'city')
         self.stdout.write('Total {} city records updated.'.format(count) if count else 'No city records updated.')
 
-        count = 0
-        with transaction.atomic():
-            for station_record in models.StationRecord.objects.all():
-                if update_record(station_record, override):
-                    count += 1
+        count = update_records(models.StationRecord.objects.all(), 'station', override, batch_size,
+                               checkpoint, 'station')
         self.stdout.write('Total {} station records updated.'.format(count) if count else 'No station records updated.')
+
+        if checkpoint:
+            checkpoint.clear()
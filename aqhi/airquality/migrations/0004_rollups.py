@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 13:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airquality', '0003_auto_20160520_1527'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CityRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'Day'), ('month', 'Month')], max_length=5)),
+                ('start_dtm', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('aqi_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('aqi_count', models.PositiveIntegerField(default=0)),
+                ('aqi_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('aqi_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('no2_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('no2_count', models.PositiveIntegerField(default=0)),
+                ('no2_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('no2_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('co_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('co_count', models.PositiveIntegerField(default=0)),
+                ('co_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('co_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('so2_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('so2_count', models.PositiveIntegerField(default=0)),
+                ('so2_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('so2_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('o3_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('o3_count', models.PositiveIntegerField(default=0)),
+                ('o3_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('o3_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('o3_8h_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('o3_8h_count', models.PositiveIntegerField(default=0)),
+                ('o3_8h_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('o3_8h_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('pm2_5_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('pm2_5_count', models.PositiveIntegerField(default=0)),
+                ('pm2_5_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('pm2_5_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('pm10_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('pm10_count', models.PositiveIntegerField(default=0)),
+                ('pm10_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('pm10_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('aqhi_1', models.PositiveIntegerField(default=0)),
+                ('aqhi_2', models.PositiveIntegerField(default=0)),
+                ('aqhi_3', models.PositiveIntegerField(default=0)),
+                ('aqhi_4', models.PositiveIntegerField(default=0)),
+                ('aqhi_5', models.PositiveIntegerField(default=0)),
+                ('aqhi_6', models.PositiveIntegerField(default=0)),
+                ('aqhi_7', models.PositiveIntegerField(default=0)),
+                ('aqhi_8', models.PositiveIntegerField(default=0)),
+                ('aqhi_9', models.PositiveIntegerField(default=0)),
+                ('aqhi_10', models.PositiveIntegerField(default=0)),
+                ('aqhi_11', models.PositiveIntegerField(default=0)),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='airquality.City')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StationRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', 'Day'), ('month', 'Month')], max_length=5)),
+                ('start_dtm', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('aqi_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('aqi_count', models.PositiveIntegerField(default=0)),
+                ('aqi_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('aqi_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('no2_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('no2_count', models.PositiveIntegerField(default=0)),
+                ('no2_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('no2_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('co_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('co_count', models.PositiveIntegerField(default=0)),
+                ('co_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('co_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('so2_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('so2_count', models.PositiveIntegerField(default=0)),
+                ('so2_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('so2_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('o3_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('o3_count', models.PositiveIntegerField(default=0)),
+                ('o3_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('o3_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('o3_8h_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('o3_8h_count', models.PositiveIntegerField(default=0)),
+                ('o3_8h_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('o3_8h_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('pm2_5_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('pm2_5_count', models.PositiveIntegerField(default=0)),
+                ('pm2_5_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('pm2_5_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('pm10_sum', models.DecimalField(decimal_places=4, default=0, max_digits=16)),
+                ('pm10_count', models.PositiveIntegerField(default=0)),
+                ('pm10_min', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('pm10_max', models.DecimalField(blank=True, decimal_places=4, max_digits=8, null=True)),
+                ('aqhi_1', models.PositiveIntegerField(default=0)),
+                ('aqhi_2', models.PositiveIntegerField(default=0)),
+                ('aqhi_3', models.PositiveIntegerField(default=0)),
+                ('aqhi_4', models.PositiveIntegerField(default=0)),
+                ('aqhi_5', models.PositiveIntegerField(default=0)),
+                ('aqhi_6', models.PositiveIntegerField(default=0)),
+                ('aqhi_7', models.PositiveIntegerField(default=0)),
+                ('aqhi_8', models.PositiveIntegerField(default=0)),
+                ('aqhi_9', models.PositiveIntegerField(default=0)),
+                ('aqhi_10', models.PositiveIntegerField(default=0)),
+                ('aqhi_11', models.PositiveIntegerField(default=0)),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='airquality.Station')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationrollup',
+            unique_together=set([('station', 'period', 'start_dtm')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cityrollup',
+            unique_together=set([('city', 'period', 'start_dtm')]),
+        ),
+    ]
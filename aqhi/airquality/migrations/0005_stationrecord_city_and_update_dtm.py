@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Copy city and update_dtm of city records to their station records in one set-based UPDATE
+COPY_CITY_AND_UPDATE_DTM_SQL = """
+UPDATE airquality_stationrecord SET
+    city_id = (SELECT city_id FROM airquality_cityrecord
+               WHERE airquality_cityrecord.id = airquality_stationrecord.city_record_id),
+    update_dtm = (SELECT update_dtm FROM airquality_cityrecord
+                  WHERE airquality_cityrecord.id = airquality_stationrecord.city_record_id)
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airquality', '0004_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='stationrecord',
+            options={'get_latest_by': 'update_dtm'},
+        ),
+        migrations.AddField(
+            model_name='stationrecord',
+            name='city',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='cities_airquality_stationrecord', to='airquality.City'),
+        ),
+        migrations.AddField(
+            model_name='stationrecord',
+            name='update_dtm',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunSQL(COPY_CITY_AND_UPDATE_DTM_SQL, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='stationrecord',
+            name='city',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='cities_airquality_stationrecord', to='airquality.City'),
+        ),
+        migrations.AlterField(
+            model_name='stationrecord',
+            name='update_dtm',
+            field=models.DateTimeField(),
+        ),
+        migrations.AlterIndexTogether(
+            name='stationrecord',
+            index_together=set([('city', 'update_dtm'), ('station', 'update_dtm')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 13:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airquality', '0005_stationrecord_city_and_update_dtm'),
+    ]
+
+    operations = [
+        # Create the composite index before dropping the index on update_dtm, which it replaces
+        migrations.AlterIndexTogether(
+            name='cityrecord',
+            index_together=set([('update_dtm', 'aqhi')]),
+        ),
+        migrations.AlterField(
+            model_name='cityrecord',
+            name='update_dtm',
+            field=models.DateTimeField(),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.5 on 2026-10-18 13:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_latest_records(apps, schema_editor):
+    """Point every city and station to its newest record, with one query per city or station."""
+    CityRecord = apps.get_model('airquality', 'CityRecord')
+    StationRecord = apps.get_model('airquality', 'StationRecord')
+    LatestCityRecord = apps.get_model('airquality', 'LatestCityRecord')
+    LatestStationRecord = apps.get_model('airquality', 'LatestStationRecord')
+
+    latest_city_records = []
+    for city, update_dtm in CityRecord.objects.order_by().values_list('city').annotate(models.Max('update_dtm')):
+        record = CityRecord.objects.get(city=city, update_dtm=update_dtm)
+        latest_city_records.append(LatestCityRecord(city_id=city, city_record=record, update_dtm=update_dtm))
+    LatestCityRecord.objects.bulk_create(latest_city_records, batch_size=100)
+
+    latest_station_records = []
+    for station, update_dtm in StationRecord.objects.order_by().values_list('station').annotate(
+            models.Max('update_dtm')):
+        record = StationRecord.objects.get(station=station, update_dtm=update_dtm)
+        latest_station_records.append(LatestStationRecord(station_id=station, station_record=record,
+                                                          city_id=record.city_id, update_dtm=update_dtm))
+    LatestStationRecord.objects.bulk_create(latest_station_records, batch_size=100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airquality', '0006_cityrecord_ranking_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatestCityRecord',
+            fields=[
+                ('city', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='latest_record', serialize=False, to='airquality.City')),
+                ('update_dtm', models.DateTimeField()),
+                ('city_record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='latest_of', to='airquality.CityRecord')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LatestStationRecord',
+            fields=[
+                ('station', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='latest_record', serialize=False, to='airquality.Station')),
+                ('update_dtm', models.DateTimeField()),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='latest_station_records', to='airquality.City')),
+                ('station_record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='latest_of', to='airquality.StationRecord')),
+            ],
+        ),
+        migrations.RunPython(populate_latest_records, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Func
+
+import aqhi.airquality.fields
+
+
+RECORD_MODELS = ['cityrecord', 'stationrecord', 'estimatedcityrecord', 'estimatedstationrecord']
+POLLUTANT_FIELDS = ['aqi', 'aqhi', 'co', 'no2', 'o3', 'o3_8h', 'pm10', 'pm2_5', 'so2']
+MAX_DIGITS = 8
+DECIMAL_PLACES = 4
+
+
+def scaled_name(field):
+    return '{}_scaled'.format(field)
+
+
+def copy_to_scaled(apps, schema_editor):
+    for model_name in RECORD_MODELS:
+        apps.get_model('airquality', model_name).objects.update(**{
+            scaled_name(field): Func(F(field), template='CAST(ROUND(%(expressions)s * {}) AS INTEGER)'.format(
+                10 ** DECIMAL_PLACES
+            ))
+            for field in POLLUTANT_FIELDS
+        })
+
+
+def copy_from_scaled(apps, schema_editor):
+    for model_name in RECORD_MODELS:
+        apps.get_model('airquality', model_name).objects.update(**{
+            field: Func(F(scaled_name(field)), template='%(expressions)s / {}.0'.format(10 ** DECIMAL_PLACES))
+            for field in POLLUTANT_FIELDS
+        })
+
+
+def get_operations():
+    """
+    Convert pollutant columns of records to scaled integers if AIRQUALITY_COMPACT_POLLUTANTS is set.
+    Values are copied to new integer columns, which then replace the decimal columns, so nothing overflows.
+    """
+    if not settings.AIRQUALITY_COMPACT_POLLUTANTS:
+        return []
+
+    operations = []
+    for model_name in RECORD_MODELS:
+        for field in POLLUTANT_FIELDS:
+            operations.append(migrations.AddField(
+                model_name=model_name,
+                name=scaled_name(field),
+                field=aqhi.airquality.fields.ScaledDecimalField(
+                    blank=True, decimal_places=DECIMAL_PLACES, max_digits=MAX_DIGITS, null=True
+                ),
+            ))
+    operations.append(migrations.RunPython(copy_to_scaled, copy_from_scaled))
+    # The ranking index of city records is created again on the new aqhi column
+    operations.append(migrations.AlterIndexTogether(name='cityrecord', index_together=set()))
+    for model_name in RECORD_MODELS:
+        for field in POLLUTANT_FIELDS:
+            operations.append(migrations.RemoveField(model_name=model_name, name=field))
+            operations.append(migrations.RenameField(model_name=model_name, old_name=scaled_name(field),
+                                                     new_name=field))
+    operations.append(migrations.AlterIndexTogether(name='cityrecord', index_together=set([('update_dtm', 'aqhi')])))
+    return operations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airquality', '0007_latest_records'),
+    ]
+
+    operations = get_operations()
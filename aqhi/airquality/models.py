@@ -1,20 +1,59 @@
 # -*- coding: utf-8 -*-
 import copy
+import threading
+from collections import defaultdict
 from datetime import timedelta
+from decimal import Decimal
 
+from django.conf import settings
 from django.db import models, transaction
+from django.db.models.expressions import DateTime
+from django.db.models.signals import post_save, post_delete
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
-from . import querysets, utils
+from . import caching, fields, querysets, timeseries, utils
+from . import checks  # noqa, registers system checks
 
 
 POLL_MAX_DIGITS = 8
 POLL_DECIMAL_PLACES = 4
+# Pollutant fields of records are stored as scaled integers with AIRQUALITY_COMPACT_POLLUTANTS, see migration 0008
+PollutantField = fields.ScaledDecimalField if settings.AIRQUALITY_COMPACT_POLLUTANTS else models.DecimalField
 COORD_MAX_DIGITS = 8
 COORD_DECIMAL_PLACES = 4
 DECIMAL_FIELDS = ['aqhi', 'aqi', 'no2', 'co', 'so2', 'o3', 'o3_8h', 'pm2_5', 'pm10']
 
 
+# ===================================================================
+# Helpers
+# ===================================================================
+def get_pollutant_item_model(record_model):
+    """
+    Return the primary pollutant item model of a record model and the name of its foreign key to the record.
+    """
+    pollutant_item_model = [
+        f.related_model
+        for f in record_model._meta.get_fields(include_parents=False)
+        if f.is_relation and f.one_to_many and issubclass(f.related_model, PrimaryPollutantItem)
+        ][0]
+    item_record_field_name = [
+        f.name
+        for f in pollutant_item_model._meta.get_fields()
+        if f.many_to_one and issubclass(f.related_model, RecordFields)
+        ][0]
+    return pollutant_item_model, item_record_field_name
+
+
+def normalize_pollutants(pollutants):
+    """Map the primary pollutant value of info dicts to a list of pollutant names."""
+    if pollutants is None or pollutants == '':
+        return []
+    if isinstance(pollutants, str):
+        return [pollutants]
+    return pollutants
+
+
 # ===================================================================
 # Custom Mixins
 # ===================================================================
@@ -27,21 +66,8 @@ class ValidateAndCreateWithPollutantsManagerMixin(object):
             instance.save()
             return instance
 
-        pollutant_item_model = [
-            f.related_model
-            for f in self.model._meta.get_fields(include_parents=False)
-            if f.is_relation and f.one_to_many and issubclass(f.related_model, PrimaryPollutantItem)
-            ][0]
-        item_record_field_name = [
-            f.name
-            for f in pollutant_item_model._meta.get_fields()
-            if f.many_to_one and issubclass(f.related_model, RecordFields)
-            ][0]
-
-        if pollutants == '':
-            pollutants = []
-        if isinstance(pollutants, str):
-            pollutants = [pollutants]
+        pollutant_item_model, item_record_field_name = get_pollutant_item_model(self.model)
+        pollutants = normalize_pollutants(pollutants)
 
         instance.full_clean()
         with transaction.atomic():
@@ -70,7 +96,13 @@ class ValidateAndCreateManagerMixin(object):
 
 class CalculateAQHIFieldRecordMixin(object):
     def calculate_aqhi_field(self):
-        if isinstance(self, StationRecord) or isinstance(self, EstimatedStationRecord):
+        if isinstance(self, StationRecord):
+            dtm = self.update_dtm
+            lookup_kwargs_factory = lambda base_dtm, hours: dict(
+                station=self.station,
+                update_dtm=base_dtm - timedelta(hours=hours),
+            )
+        elif isinstance(self, EstimatedStationRecord):
             dtm = self.city_record.update_dtm
             lookup_kwargs_factory = lambda base_dtm, hours: dict(
                 station=self.station,
@@ -186,15 +218,15 @@ class RecordFields(CalculateAQHIFieldRecordMixin, models.Model):
         ('SP', 'Severely Polluted')
     )
 
-    aqi = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
-    aqhi = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
-    co = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
-    no2 = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
-    o3 = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
-    o3_8h = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
-    pm10 = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
-    pm2_5 = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
-    so2 = models.DecimalField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    aqi = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    aqhi = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    co = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    no2 = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    o3 = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    o3_8h = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    pm10 = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    pm2_5 = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
+    so2 = PollutantField(max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True)
     quality = models.CharField(max_length=2, choices=QUALITY_LEVEL_CHOICES, blank=True)
 
     class Meta:
@@ -210,11 +242,14 @@ class CityRecordManager(ValidateAndCreateWithPollutantsManagerMixin, models.Mana
 class CityRecord(RecordFields):
     city = models.ForeignKey('City', models.CASCADE,
                              related_name="cities_%(app_label)s_%(class)s",)
-    update_dtm = models.DateTimeField(db_index=True)
+    update_dtm = models.DateTimeField()
     objects = CityRecordManager.from_queryset(querysets.CityRecordQuerySet)()
 
     class Meta:
+        # (city, update_dtm) serves records of a city, and (update_dtm, aqhi) serves records at a time ranked by
+        # AQHI without sorting. Both also serve lookups on their first column alone.
         unique_together = ('city', 'update_dtm')
+        index_together = [('update_dtm', 'aqhi')]
         get_latest_by = 'update_dtm'
 
     def __str__(self):
@@ -236,7 +271,14 @@ class EstimatedCityRecord(RecordFields):
 # Station Records
 # -------------------------------------------------------------------
 class StationRecordManager(ValidateAndCreateWithPollutantsManagerMixin, models.Manager):
-    pass
+    def validate_and_create_with_pollutants(self, pollutants=None, **kwargs):
+        # city and update_dtm default to those of the city record
+        city_record = kwargs.get('city_record', None)
+        if city_record is not None:
+            if 'city' not in kwargs:
+                kwargs.setdefault('city_id', city_record.city_id)
+            kwargs.setdefault('update_dtm', city_record.update_dtm)
+        return super(StationRecordManager, self).validate_and_create_with_pollutants(pollutants, **kwargs)
 
 
 class StationRecord(RecordFields):
@@ -244,21 +286,27 @@ class StationRecord(RecordFields):
                                     related_name="station_records")
     station = models.ForeignKey('Station', models.CASCADE,
                                 related_name="stations_%(app_label)s_%(class)s",)
+    # Copies of city_record.city and city_record.update_dtm, so that station records are filtered and ordered
+    # without joining city records
+    city = models.ForeignKey('City', models.CASCADE,
+                             related_name="cities_%(app_label)s_%(class)s",)
+    update_dtm = models.DateTimeField()
 
     objects = StationRecordManager.from_queryset(querysets.StationRecordQuerySet)()
 
     class Meta:
         unique_together = ('city_record', 'station')
-        get_latest_by = 'city_record__update_dtm'
+        index_together = [('station', 'update_dtm'), ('city', 'update_dtm')]
+        get_latest_by = 'update_dtm'
 
     def get_update_dtm(self):
-        return self.city_record.update_dtm
+        return self.update_dtm
 
     def get_city(self):
-        return self.city_record.city
+        return self.city
 
     def __str__(self):
-        return '{station}-{dtm}'.format(station=self.station, dtm=self.city_record.update_dtm)
+        return '{station}-{dtm}'.format(station=self.station, dtm=self.update_dtm)
 
 
 class EstimatedStationRecordManager(ValidateAndCreateManagerMixin,
@@ -314,10 +362,447 @@ class Station(models.Model):
         return '{name} in {city}'.format(name=self.name_cn, city=self.city)
 
 
+# Rollups
+# -------------------------------------------------------------------
+class RollupFields(models.Model):
+    """
+    Aggregates of the records of a city or station in a day or a month of local time.
+
+    For each field in ROLLUP_FIELDS, `<field>_sum` and `<field>_count` sum and count values that are not None,
+    so that rollups can be updated incrementally, and `<field>_min` and `<field>_max` are the extremes.
+    `aqhi_<level>` counts records of each AQHI level.
+
+    Rollups are kept up to date when records are created by create_city_record(s), when their aqhi is updated by
+    the update_aqhi command and when they are deleted. After records are changed any other way, e.g. with
+    QuerySet.update, run the rebuild_rollups command.
+    """
+    PERIOD_CHOICES = (
+        ('day', 'Day'),
+        ('month', 'Month'),
+    )
+
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    start_dtm = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    @staticmethod
+    def get_start_dtm(dtm, period):
+        """Return the start of the day or month in local time which `dtm` is in."""
+        local_dtm = timezone.localtime(dtm).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+        if period == 'month':
+            local_dtm = local_dtm.replace(day=1)
+        return timezone.make_aware(local_dtm)
+
+    @staticmethod
+    def get_end_dtm(start_dtm, period):
+        """Return the start of the next day or month of a period starting at `start_dtm`."""
+        local_dtm = timezone.localtime(start_dtm).replace(tzinfo=None)
+        if period == 'month':
+            local_dtm = (local_dtm.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else:
+            local_dtm += timedelta(days=1)
+        return timezone.make_aware(local_dtm)
+
+    def mean(self, field):
+        count = getattr(self, '{}_count'.format(field))
+        if not count:
+            return None
+        return round(getattr(self, '{}_sum'.format(field)) / count, POLL_DECIMAL_PLACES)
+
+    def add_record(self, record):
+        self.count += 1
+        for field in ROLLUP_FIELDS:
+            value = getattr(record, field)
+            if value is None:
+                continue
+            setattr(self, '{}_sum'.format(field), getattr(self, '{}_sum'.format(field)) + value)
+            setattr(self, '{}_count'.format(field), getattr(self, '{}_count'.format(field)) + 1)
+            for suffix, func in [('min', min), ('max', max)]:
+                name = '{}_{}'.format(field, suffix)
+                setattr(self, name, value if getattr(self, name) is None else func(getattr(self, name), value))
+        if record.aqhi is not None and int(record.aqhi) in AQHI_LEVELS:
+            name = 'aqhi_{}'.format(int(record.aqhi))
+            setattr(self, name, getattr(self, name) + 1)
+
+    def add_aggregates(self, aggregates):
+        """Add aggregates of records, a dict with the same keys as the fields of a rollup, e.g. of a day."""
+        self.count += aggregates['count']
+        for field in ROLLUP_FIELDS:
+            count = aggregates['{}_count'.format(field)]
+            if not count:
+                continue
+            name = '{}_sum'.format(field)
+            setattr(self, name, getattr(self, name) + aggregates[name])
+            setattr(self, '{}_count'.format(field), getattr(self, '{}_count'.format(field)) + count)
+            for suffix, func in [('min', min), ('max', max)]:
+                name = '{}_{}'.format(field, suffix)
+                value = aggregates[name]
+                setattr(self, name, value if getattr(self, name) is None else func(getattr(self, name), value))
+        for level in AQHI_LEVELS:
+            name = 'aqhi_{}'.format(level)
+            setattr(self, name, getattr(self, name) + (aggregates[name] or 0))
+
+
+ROLLUP_FIELDS = [f for f in DECIMAL_FIELDS if f != 'aqhi']
+AQHI_LEVELS = range(1, 12)
+
+for field in ROLLUP_FIELDS:
+    RollupFields.add_to_class('{}_sum'.format(field), models.DecimalField(
+        max_digits=POLL_MAX_DIGITS + 8, decimal_places=POLL_DECIMAL_PLACES, default=0))
+    RollupFields.add_to_class('{}_count'.format(field), models.PositiveIntegerField(default=0))
+    RollupFields.add_to_class('{}_min'.format(field), models.DecimalField(
+        max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True))
+    RollupFields.add_to_class('{}_max'.format(field), models.DecimalField(
+        max_digits=POLL_MAX_DIGITS, decimal_places=POLL_DECIMAL_PLACES, null=True, blank=True))
+for level in AQHI_LEVELS:
+    RollupFields.add_to_class('aqhi_{}'.format(level), models.PositiveIntegerField(default=0))
+
+
+class CityRollup(RollupFields):
+    city = models.ForeignKey('City', models.CASCADE, related_name='rollups')
+
+    class Meta:
+        unique_together = ('city', 'period', 'start_dtm')
+
+    def __str__(self):
+        return '{city} in {period} of {dtm}'.format(city=self.city_id, period=self.period,
+                                                   dtm=self.start_dtm.strftime('%Y-%m-%d'))
+
+
+class StationRollup(RollupFields):
+    station = models.ForeignKey('Station', models.CASCADE, related_name='rollups')
+
+    class Meta:
+        unique_together = ('station', 'period', 'start_dtm')
+
+    def __str__(self):
+        return '{station} in {period} of {dtm}'.format(station=self.station_id, period=self.period,
+                                                      dtm=self.start_dtm.strftime('%Y-%m-%d'))
+
+
+# Latest Records
+# -------------------------------------------------------------------
+class LatestCityRecord(models.Model):
+    """
+    The newest record of a city, so that latest records of many cities are read with one join instead of a latest()
+    query per city. It is maintained by update_latest_records when records are saved, including in bulk by
+    create_city_records, and by refresh_latest_records when they are deleted.
+    """
+    city = models.OneToOneField('City', models.CASCADE, primary_key=True, related_name='latest_record')
+    city_record = models.OneToOneField('CityRecord', models.CASCADE, related_name='latest_of')
+    update_dtm = models.DateTimeField()
+
+    def __str__(self):
+        return 'Latest record of {}'.format(self.city_id)
+
+
+class LatestStationRecord(models.Model):
+    """The newest record of a station, maintained like LatestCityRecord."""
+    station = models.OneToOneField('Station', models.CASCADE, primary_key=True, related_name='latest_record')
+    station_record = models.OneToOneField('StationRecord', models.CASCADE, related_name='latest_of')
+    city = models.ForeignKey('City', models.CASCADE, related_name='latest_station_records')
+    update_dtm = models.DateTimeField()
+
+    def __str__(self):
+        return 'Latest record of {}'.format(self.station_id)
+
+
+# ===================================================================
+# Name Registry
+# ===================================================================
+class NameRegistry(object):
+    """
+    A process-wide registry resolving city and station names to primary keys without querying database.
+
+    Cities and stations are loaded with two queries on first use and kept up to date by the post_save and
+    post_delete signals of City and Station. Changes are applied only after being committed, and the registry
+    is never loaded inside an atomic block, so it never holds rows that may be rolled back.
+
+    Names missing from the registry (or every name while it cannot be loaded) are looked up in database,
+    so cities and stations created by other processes or in the current transaction are still found.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._cities = None
+        self._stations = None
+        self._station_keys = None
+
+    def clear(self):
+        with self._lock:
+            self._cities = None
+            self._stations = None
+            self._station_keys = None
+
+    def load(self):
+        """
+        Load the registry if it is not loaded and not inside an atomic block, and return whether it can be used.
+        Call this before entering an atomic block to use the registry inside it.
+        """
+        with self._lock:
+            if self._cities is None and not transaction.get_connection().in_atomic_block:
+                self._cities = dict(City.objects.values_list('pk', 'name_cn'))
+                self._station_keys = {
+                    pk: (city_pk, name_cn)
+                    for pk, city_pk, name_cn in Station.objects.values_list('pk', 'city', 'name_cn')
+                }
+                self._stations = {key: pk for pk, key in self._station_keys.items()}
+            return self._cities is not None
+
+    def city_pk(self, name_en):
+        """Return the primary key of the city with English name `name_en`, or None if it does not exist."""
+        if self.load() and name_en in self._cities:
+            return name_en
+        city = City.objects.filter(pk=name_en).values_list('pk', 'name_cn').first()
+        if city is None:
+            return None
+        self._add_city(*city)
+        return city[0]
+
+    def city_pks_by_name_cn(self, name_cn):
+        """Return a list of primary keys of the cities with Chinese name `name_cn`."""
+        if self.load():
+            pks = [pk for pk, city_name_cn in self._cities.items() if city_name_cn == name_cn]
+            if pks:
+                return pks
+        cities = list(City.objects.filter(name_cn=name_cn).values_list('pk', 'name_cn'))
+        for city in cities:
+            self._add_city(*city)
+        return [pk for pk, _ in cities]
+
+    def station_pk(self, city_pk, name_cn):
+        """Return the primary key of the station named `name_cn` in the city, or None if it does not exist."""
+        return self.station_pks(city_pk, [name_cn]).get(name_cn)
+
+    def station_pks(self, city_pk, names_cn):
+        """
+        Return a dict mapping station names `names_cn` of the city to their primary keys.
+        Missing stations are left out.
+        """
+        found = {}
+        missing = list(names_cn)
+        if self.load():
+            missing = []
+            for name in names_cn:
+                if (city_pk, name) in self._stations:
+                    found[name] = self._stations[(city_pk, name)]
+                else:
+                    missing.append(name)
+        if missing:
+            for pk, name in Station.objects.filter(city=city_pk, name_cn__in=missing).values_list('pk', 'name_cn'):
+                self._add_station(pk, city_pk, name)
+                found[name] = pk
+        return found
+
+    def _add_city(self, pk, name_cn):
+        with self._lock:
+            if self._cities is not None and not transaction.get_connection().in_atomic_block:
+                self._cities[pk] = name_cn
+
+    def _add_station(self, pk, city_pk, name_cn):
+        with self._lock:
+            if self._cities is not None and not transaction.get_connection().in_atomic_block:
+                self._remove_station(pk)
+                self._station_keys[pk] = (city_pk, name_cn)
+                self._stations[(city_pk, name_cn)] = pk
+
+    def _remove_city(self, pk):
+        with self._lock:
+            if self._cities is not None:
+                self._cities.pop(pk, None)
+
+    def _remove_station(self, pk):
+        with self._lock:
+            if self._cities is not None:
+                key = self._station_keys.pop(pk, None)
+                if key is not None:
+                    self._stations.pop(key, None)
+
+    def update(self, sender, instance, **kwargs):
+        """Receiver of post_save signals of City and Station."""
+        if sender is City:
+            args = (instance.pk, instance.name_cn)
+            transaction.on_commit(lambda: self._add_city(*args))
+        else:
+            args = (instance.pk, instance.city_id, instance.name_cn)
+            transaction.on_commit(lambda: self._add_station(*args))
+
+    def remove(self, sender, instance, **kwargs):
+        """Receiver of post_delete signals of City and Station."""
+        # Stations deleted in cascade send their own signals
+        if sender is City:
+            pk = instance.pk
+            transaction.on_commit(lambda: self._remove_city(pk))
+        else:
+            pk = instance.pk
+            transaction.on_commit(lambda: self._remove_station(pk))
+
+
+name_registry = NameRegistry()
+
+for model in [City, Station]:
+    post_save.connect(name_registry.update, sender=model, dispatch_uid='name_registry_update')
+    post_delete.connect(name_registry.remove, sender=model, dispatch_uid='name_registry_remove')
+
+
+# ===================================================================
+# AQHI Window Cache
+# ===================================================================
+class AqhiWindowCache(object):
+    """
+    A process-wide cache of pollutant values of the last hours of every city and station, from which AQHI of
+    new records is calculated without querying their history.
+
+    It is empty until loaded, which should be done once at the start of a crawl, and new records are added
+    to it after being committed by create_city_record and create_city_records. Records of each city or station
+    are expected to come in time order, so only the last `hours` hours before the newest record are kept.
+    """
+    def __init__(self, hours=6):
+        self.hours = hours
+        self._lock = threading.RLock()
+        self._rows = None
+
+    @property
+    def loaded(self):
+        return self._rows is not None
+
+    def clear(self):
+        with self._lock:
+            self._rows = None
+
+    def load(self):
+        """
+        Fill the cache with records of the last `hours` hours before the latest city record, with three queries.
+        Like NameRegistry, it is never loaded inside an atomic block. Return whether the cache is loaded.
+        """
+        with self._lock:
+            if transaction.get_connection().in_atomic_block:
+                return self.loaded
+            self._rows = {'city': {}, 'station': {}}
+            latest_dtm = CityRecord.objects.aggregate(models.Max('update_dtm'))['update_dtm__max']
+            if latest_dtm is not None:
+                since = latest_dtm - timedelta(hours=self.hours)
+                self._add('city', CityRecord.objects.filter(
+                    update_dtm__gt=since
+                ).values_list('city', 'update_dtm', *utils.aqhi_pollutants))
+                self._add('station', StationRecord.objects.filter(
+                    update_dtm__gt=since
+                ).values_list('station', 'update_dtm', *utils.aqhi_pollutants))
+            return True
+
+    def get_rows(self, kind, entities):
+        """
+        :param kind: 'city' or 'station'
+        :param entities: primary keys of cities or stations
+        :return: a list of cached rows of (entity, update_dtm, pm10, pm2_5, so2, no2, o3)
+        """
+        with self._lock:
+            return [row for entity in entities for row in self._rows[kind].get(entity, {}).values()]
+
+    def add_on_commit(self, city_rows, station_rows):
+        """Add rows of new records to the cache, if it is loaded, after the current transaction is committed."""
+        if self.loaded:
+            transaction.on_commit(lambda: (self._add('city', city_rows), self._add('station', station_rows)))
+
+    def _add(self, kind, rows):
+        with self._lock:
+            if self._rows is None:
+                return
+            entity_rows = self._rows[kind]
+            for row in rows:
+                dtm_rows = entity_rows.setdefault(row[0], {})
+                dtm_rows[row[1]] = tuple(row)
+                since = max(dtm_rows) - timedelta(hours=self.hours)
+                for dtm in [dtm for dtm in dtm_rows if dtm <= since]:
+                    del dtm_rows[dtm]
+
+
+aqhi_window_cache = AqhiWindowCache()
+
+
+# ===================================================================
+# Time Series Store
+# ===================================================================
+def get_timeseries_store():
+    """Return the TimeSeriesStore in AIRQUALITY_TIMESERIES_DIR, or None if it is not enabled."""
+    return timeseries.get_store(settings.AIRQUALITY_TIMESERIES_DIR, DECIMAL_FIELDS)
+
+
+def add_to_timeseries_on_commit(city_records, station_records):
+    """Add new records to the time series store, if it is enabled, after the current transaction is committed."""
+    store = get_timeseries_store()
+    if store is not None:
+        transaction.on_commit(lambda: store.add_records(city_records, station_records))
+
+
+def update_timeseries_on_commit(kind, field, items):
+    """
+    Set a field of records in the time series store, if it is enabled, after the current transaction is committed.
+
+    :param kind: 'city' or 'station'
+    :param items: (entity, update_dtm, value) tuples
+    """
+    store = get_timeseries_store()
+    if store is not None:
+        transaction.on_commit(lambda: store.update_values(kind, field, items))
+
+
+# ===================================================================
+# Deleted Records
+# ===================================================================
+# Keys of records deleted in the current thread, whose rollups and time series are refreshed after the deletion
+# is committed
+_deleted_records = threading.local()
+
+
+def refresh_on_delete(sender, instance, **kwargs):
+    """
+    Receiver of post_delete signals of CityRecord and StationRecord. Rollups and latest records of all records
+    deleted in a transaction are refreshed, and the records are removed from the time series store, once after it is
+    committed, by the first callback.
+    """
+    if not hasattr(_deleted_records, 'keys'):
+        _deleted_records.keys = {CityRecord: set(), StationRecord: set()}
+    entity = instance.city_id if sender is CityRecord else instance.station_id
+    _deleted_records.keys[sender].add((entity, instance.update_dtm))
+    transaction.on_commit(_refresh_deleted_records)
+
+
+def _refresh_deleted_records():
+    # Keys left by a rolled back transaction are refreshed as well, which does no harm to rollups and latest records
+    keys = getattr(_deleted_records, 'keys', None)
+    if not keys or not any(keys.values()):
+        return
+    _deleted_records.keys = {CityRecord: set(), StationRecord: set()}
+    refresh_rollups(keys[CityRecord], keys[StationRecord])
+    refresh_latest_records({key[0] for key in keys[CityRecord]}, {key[0] for key in keys[StationRecord]})
+
+    store = get_timeseries_store()
+    if store is None:
+        return
+    for kind, model, entity_field in [('city', CityRecord, 'city'), ('station', StationRecord, 'station')]:
+        deleted = keys[model]
+        if not deleted:
+            continue
+        # Unlike rollups, the store has to keep records of those keys still in database
+        dtms = [key[1] for key in deleted]
+        existing = set(model.objects.filter(**{
+            entity_field + '__in': list({key[0] for key in deleted}),
+            'update_dtm__range': (min(dtms), max(dtms)),
+        }).values_list(entity_field, 'update_dtm'))
+        store.remove_records(kind, deleted - existing)
+
+
+for model in [CityRecord, StationRecord]:
+    post_delete.connect(refresh_on_delete, sender=model, dispatch_uid='refresh_on_delete')
+
+
 # ===================================================================
 # Utils
 # ===================================================================
-def create_city_record(info_dict):
+def create_city_record(info_dict, calculate_aqhi=True):
     """
     Save the info dict to database as a city record with any necessary station record.
     The expecting dict is almost the same as the dict returned by extractors.aggregate_parsed_dict but it has
@@ -336,18 +821,21 @@ def create_city_record(info_dict):
 
     The successful return is {'success': 1, 'info': the created CityRecord instance}
 
+    With `calculate_aqhi`, AQHI of the city record and its station records is calculated by calculate_new_aqhi,
+    which queries nothing if aqhi_window_cache is loaded.
+
     This operation is atomic.
 
     :param info_dict: the dict returned by extractors.aggregate_parsed_dict
+    :param calculate_aqhi: whether to calculate the aqhi field of new records
     :return: a dict showing the success of the saving.
     """
     city_dict = info_dict['city']
     city_name_en = city_dict['area_en']
     # Check city's existence
-    city = City.objects.filter(name_en=city_name_en)
-    if not city.exists():
+    city = name_registry.city_pk(city_name_en)
+    if city is None:
         return {'success': 0, 'error_type': 'CityNotFound', 'info': city_name_en}
-    city = city[0]
 
     # Check uniqueness of this record
     update_dtm = info_dict['update_dtm']
@@ -356,14 +844,9 @@ def create_city_record(info_dict):
 
     # Check stations' existence
     station_names = list(info_dict['stations'])
-    stations = []
-    missing_station = []
-    for station_name in station_names:
-        station = Station.objects.filter(city=city, name_cn=station_name)
-        if not station.exists():
-            missing_station.append(station_name)
-        else:
-            stations.append(station[0])
+    station_pks = name_registry.station_pks(city, station_names)
+    stations = [station_pks[name] for name in station_names if name in station_pks]
+    missing_station = [name for name in station_names if name not in station_pks]
     if missing_station:
         return {'success': 0, 'error_type': 'StationNotFound', 'info': missing_station}
 
@@ -376,22 +859,503 @@ def create_city_record(info_dict):
 
     city_dict['pollutants'] = city_dict.pop('primary_pollutant')
 
-    city_dict['city'] = city
+    city_dict['city_id'] = city
+
+    city_rows = [aqhi_row(city, update_dtm, city_dict)]
+    station_rows = [aqhi_row(station, update_dtm, info_dict['stations'][station_names[i]])
+                    for i, station in enumerate(stations)]
+    if calculate_aqhi:
+        city_aqhi, station_aqhi = calculate_new_aqhi(city_rows, station_rows)
+        city_dict['aqhi'] = city_aqhi[(city, update_dtm)]
 
     try:
         with transaction.atomic():
             # Create CityRecord
             city_record = CityRecord.objects.validate_and_create_with_pollutants(**city_dict)
             # Create StationRecords
+            station_records = []
             for i, station in enumerate(stations):
                 station_dict = copy.deepcopy(info_dict['stations'][station_names[i]])
-                station_dict['station'] = station
+                station_dict['station_id'] = station
                 station_dict['city_record'] = city_record
                 station_dict['pollutants'] = station_dict.pop('primary_pollutant')
-                StationRecord.objects.validate_and_create_with_pollutants(**station_dict)
+                if calculate_aqhi:
+                    station_dict['aqhi'] = station_aqhi[(station, update_dtm)]
+                station_records.append(StationRecord.objects.validate_and_create_with_pollutants(**station_dict))
+            # Latest records are updated on post_save
+            update_rollups([city_record], station_records)
+            aqhi_window_cache.add_on_commit(city_rows, station_rows)
+            add_to_timeseries_on_commit([city_record], station_records)
     except ValidationError as e:
         return {'success': 0, 'error_type': 'ValidationError', 'info': e.message_dict if hasattr(e, 'message_dict') else str(e)}
     except ValueError as e:
         return {'success': 0, 'error_type': 'ValueError', 'info': str(e)}
 
     return {'success': 1, 'info': city_record}
+
+
+def create_city_records(info_dicts, calculate_aqhi=True):
+    """
+    Bulk version of create_city_record, saving many info dicts with a constant number of queries.
+
+    Cities and stations are resolved by name_registry, existing records of all info dicts are loaded at once,
+    every record is validated in memory, and then all valid city records, station records and primary pollutant items are inserted
+    with bulk_create.
+
+    Each info dict gets the same result dict as create_city_record would return, with one more error type
+    when two info dicts of the same city and update_dtm are given: the later one gets 'UniquenessError'.
+    Unlike create_city_record, no post_save signal is sent for the created records.
+
+    With `calculate_aqhi`, AQHI of the new city and station records is calculated by calculate_new_aqhi from
+    the new records and the records of the previous two hours. AQHI of existing records is not updated even if
+    a new record falls in their 3-hour window.
+
+    This operation is atomic as a whole: invalid info dicts are skipped before anything is written.
+
+    :param info_dicts: an iterable of dicts as create_city_record expects
+    :param calculate_aqhi: whether to calculate the aqhi field of new records
+    :return: a list of dicts showing the success of the saving, in the same order as info_dicts
+    """
+    info_dicts = list(info_dicts)
+    results = [None] * len(info_dicts)
+
+    # Resolve names from the registry and load existing records in one query
+    cities = {
+        name_en for name_en in {info_dict['city']['area_en'] for info_dict in info_dicts}
+        if name_registry.city_pk(name_en) is not None
+    }
+    existing_keys = set(CityRecord.objects.filter(
+        city__in=list(cities),
+        update_dtm__in=list({info_dict['update_dtm'] for info_dict in info_dicts})
+    ).values_list('city', 'update_dtm'))
+
+    city_pollutant_model, city_pollutant_field = get_pollutant_item_model(CityRecord)
+    station_pollutant_model, station_pollutant_field = get_pollutant_item_model(StationRecord)
+
+    # Build and validate all records in memory
+    to_create = []
+    for i, info_dict in enumerate(info_dicts):
+        city_dict = info_dict['city']
+        city_name_en = city_dict['area_en']
+        if city_name_en not in cities:
+            results[i] = {'success': 0, 'error_type': 'CityNotFound', 'info': city_name_en}
+            continue
+
+        update_dtm = info_dict['update_dtm']
+        if (city_name_en, update_dtm) in existing_keys:
+            results[i] = {'success': 0, 'error_type': 'UniquenessError', 'info': update_dtm}
+            continue
+
+        station_pks = name_registry.station_pks(city_name_en, list(info_dict['stations']))
+        missing_station = [name for name in info_dict['stations'] if name not in station_pks]
+        if missing_station:
+            results[i] = {'success': 0, 'error_type': 'StationNotFound', 'info': missing_station}
+            continue
+
+        try:
+            city_fields = copy.deepcopy(city_dict)
+            del city_fields['area_en']
+            del city_fields['area_cn']
+            city_pollutants = normalize_pollutants(city_fields.pop('primary_pollutant'))
+            city_record = CityRecord(city_id=city_name_en, update_dtm=update_dtm, **city_fields)
+            # Related objects and uniqueness are already checked above without extra queries
+            city_record.full_clean(exclude=['city'], validate_unique=False)
+            for p in city_pollutants:
+                city_pollutant_model(pollutant=p).full_clean(exclude=[city_pollutant_field], validate_unique=False)
+
+            station_records = []
+            for station_name, station_dict in info_dict['stations'].items():
+                station_fields = copy.deepcopy(station_dict)
+                station_pollutants = normalize_pollutants(station_fields.pop('primary_pollutant'))
+                station_record = StationRecord(station_id=station_pks[station_name], city_id=city_name_en,
+                                               update_dtm=update_dtm, **station_fields)
+                station_record.full_clean(exclude=['city_record', 'station', 'city'], validate_unique=False)
+                for p in station_pollutants:
+                    station_pollutant_model(pollutant=p).full_clean(exclude=[station_pollutant_field],
+                                                                    validate_unique=False)
+                station_records.append((station_record, station_pollutants))
+        except ValidationError as e:
+            results[i] = {'success': 0, 'error_type': 'ValidationError',
+                          'info': e.message_dict if hasattr(e, 'message_dict') else str(e)}
+            continue
+        except ValueError as e:
+            results[i] = {'success': 0, 'error_type': 'ValueError', 'info': str(e)}
+            continue
+
+        existing_keys.add((city_name_en, update_dtm))
+        to_create.append((i, city_record, city_pollutants, station_records))
+
+    if not to_create:
+        return results
+
+    city_rows = [aqhi_row(city_record.city_id, city_record.update_dtm, city_record)
+                 for _, city_record, _, _ in to_create]
+    station_rows = [aqhi_row(station_record.station_id, station_record.update_dtm, station_record)
+                    for _, _, _, station_records in to_create
+                    for station_record, _ in station_records]
+    if calculate_aqhi:
+        city_aqhi, station_aqhi = calculate_new_aqhi(city_rows, station_rows)
+        for _, city_record, _, station_records in to_create:
+            city_record.aqhi = city_aqhi[(city_record.city_id, city_record.update_dtm)]
+            for station_record, _ in station_records:
+                station_record.aqhi = station_aqhi[(station_record.station_id, station_record.update_dtm)]
+
+    # Insert with a constant number of queries
+    with transaction.atomic():
+        CityRecord.objects.bulk_create([city_record for _, city_record, _, _ in to_create])
+        # Primary keys are not set by bulk_create on every backend, so fetch them back by the unique key
+        city_record_pks = {
+            (city_pk, update_dtm): pk
+            for pk, city_pk, update_dtm in CityRecord.objects.filter(
+                city__in=list({city_record.city_id for _, city_record, _, _ in to_create}),
+                update_dtm__in=list({city_record.update_dtm for _, city_record, _, _ in to_create})
+            ).values_list('pk', 'city', 'update_dtm')
+        }
+        created_pks = []
+        for _, city_record, _, station_records in to_create:
+            city_record.pk = city_record_pks[(city_record.city_id, city_record.update_dtm)]
+            created_pks.append(city_record.pk)
+            for station_record, _ in station_records:
+                station_record.city_record_id = city_record.pk
+
+        StationRecord.objects.bulk_create([
+            station_record
+            for _, _, _, station_records in to_create
+            for station_record, _ in station_records
+        ])
+        station_record_pks = {
+            (city_record_pk, station_pk): pk
+            for pk, city_record_pk, station_pk in StationRecord.objects.filter(
+                city_record__in=created_pks
+            ).values_list('pk', 'city_record', 'station')
+        }
+
+        city_pollutant_items = []
+        station_pollutant_items = []
+        for _, city_record, city_pollutants, station_records in to_create:
+            for p in city_pollutants:
+                city_pollutant_items.append(city_pollutant_model(**{'pollutant': p, city_pollutant_field: city_record}))
+            for station_record, station_pollutants in station_records:
+                station_record.pk = station_record_pks[(station_record.city_record_id, station_record.station_id)]
+                for p in station_pollutants:
+                    station_pollutant_items.append(station_pollutant_model(**{
+                        'pollutant': p, station_pollutant_field: station_record
+                    }))
+        city_pollutant_model.objects.bulk_create(city_pollutant_items)
+        station_pollutant_model.objects.bulk_create(station_pollutant_items)
+        created_city_records = [city_record for _, city_record, _, _ in to_create]
+        created_station_records = [
+            station_record for _, _, _, station_records in to_create for station_record, _ in station_records
+        ]
+        update_rollups(created_city_records, created_station_records)
+        update_latest_records(created_city_records, created_station_records)
+        aqhi_window_cache.add_on_commit(city_rows, station_rows)
+        add_to_timeseries_on_commit(created_city_records, created_station_records)
+        # Bulk creation sends no post_save signals to invalidate cached API responses
+        cities = {city_record.city_id for _, city_record, _, _ in to_create}
+        dtms = {city_record.update_dtm for _, city_record, _, _ in to_create}
+        transaction.on_commit(lambda: caching.touch('cityrecord', 'stationrecord', cities=cities, dtms=dtms))
+
+    for i, city_record, _, _ in to_create:
+        results[i] = {'success': 1, 'info': city_record}
+
+    return results
+
+
+def aqhi_row(entity, update_dtm, values):
+    """
+    Build a row of a new record for calculate_new_aqhi and AqhiWindowCache.
+    Values not in a number type, which will not pass validation anyway, are taken as missing.
+
+    :param values: a record instance or a dict of record fields
+    """
+    get = values.get if isinstance(values, dict) else lambda field: getattr(values, field)
+    return (entity, update_dtm) + tuple(
+        value if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) else None
+        for value in map(get, utils.aqhi_pollutants)
+    )
+
+
+def calculate_new_aqhi(city_rows, station_rows):
+    """
+    Calculate AQHI of new city and station records from their rows and those of the previous two hours.
+    History is taken from aqhi_window_cache if it is loaded, or else from the time series store if it is enabled,
+    or queried from database with two queries otherwise. Hours the store does not cover are queried as well.
+
+    :param city_rows: rows of new city records built by aqhi_row
+    :param station_rows: rows of new station records built by aqhi_row
+    :return: a tuple of two dicts mapping (entity, update_dtm) of city and station rows to AQHI
+    """
+    store = get_timeseries_store()
+    results = []
+    for kind, model, entity_field, rows in [
+        ('city', CityRecord, 'city', city_rows),
+        ('station', StationRecord, 'station', station_rows),
+    ]:
+        entities = list({row[0] for row in rows})
+        dtms = list({row[1] - timedelta(hours=hours) for row in rows for hours in range(1, 3)})
+        new_keys = {row[:2] for row in rows}
+        if aqhi_window_cache.loaded:
+            history = aqhi_window_cache.get_rows(kind, entities)
+        else:
+            missing = {(row[0], row[1] - timedelta(hours=hours)) for row in rows for hours in range(1, 3)} - new_keys
+            history = []
+            if store is not None:
+                history = store.get_rows(kind, entities, dtms, utils.aqhi_pollutants)
+                missing = {key for key in missing if not store.covers(kind, *key)}
+            if missing:
+                history += [row for row in model.objects.filter(**{
+                    entity_field + '__in': list({key[0] for key in missing}),
+                    'update_dtm__in': list({key[1] for key in missing}),
+                }).values_list(entity_field, 'update_dtm', *utils.aqhi_pollutants) if tuple(row[:2]) in missing]
+        history = [row for row in history if tuple(row[:2]) not in new_keys]
+        results.append(utils.calculate_aqhi_by_entity(list(history) + list(rows)))
+    return tuple(results)
+
+
+def update_rollups(city_records, station_records):
+    """
+    Add new records to the daily and monthly rollups of their cities and stations.
+    Rollups are queried, deleted and created again in bulk, so the number of queries is constant.
+    Call this in the same atomic block as the records are created.
+
+    :param city_records: a list of saved CityRecords
+    :param station_records: a list of saved StationRecords
+    """
+    def add_records(rollup, records):
+        for record in records:
+            rollup.add_record(record)
+
+    for rollup_model, entity_field, items in [
+        (CityRollup, 'city_id', [(record.city_id, record.update_dtm, record) for record in city_records]),
+        (StationRollup, 'station_id', [(record.station_id, record.update_dtm, record) for record in station_records]),
+    ]:
+        _apply_to_rollups(rollup_model, entity_field, items, add_records)
+
+
+def update_rollup_aqhi(rollup_model, entity_field, changes):
+    """
+    Move records from the AQHI level counts of their old aqhi to those of their new one in the daily and monthly
+    rollups of their cities or stations, e.g. after aqhi is updated in bulk. Like update_rollups, the number of
+    queries is constant. Rollups not created yet are left to rebuild_rollups.
+
+    :param rollup_model: CityRollup or StationRollup
+    :param entity_field: 'city_id' or 'station_id'
+    :param changes: a list of (entity, update_dtm, old aqhi, new aqhi) of changed records
+    """
+    def move_levels(rollup, values):
+        for old_value, new_value in values:
+            for value, delta in [(old_value, -1), (new_value, 1)]:
+                if value is not None and int(value) in AQHI_LEVELS:
+                    name = 'aqhi_{}'.format(int(value))
+                    setattr(rollup, name, getattr(rollup, name) + delta)
+
+    items = [(entity, dtm, (old_value, new_value)) for entity, dtm, old_value, new_value in changes]
+    _apply_to_rollups(rollup_model, entity_field, items, move_levels, create=False)
+
+
+def _apply_to_rollups(rollup_model, entity_field, items, apply, create=True):
+    """
+    Group items by the rollups they fall in, call apply(rollup, values) on each rollup with the values of its items,
+    and write the rollups back in bulk.
+
+    :param items: a list of (entity, update_dtm, value)
+    :param create: whether to create rollups not existing yet, otherwise their items are ignored
+    """
+    periods = [period for period, _ in RollupFields.PERIOD_CHOICES]
+    groups = defaultdict(list)
+    for entity, dtm, value in items:
+        for period in periods:
+            groups[(entity, period, RollupFields.get_start_dtm(dtm, period))].append(value)
+    if not groups:
+        return
+
+    existing = {
+        (getattr(rollup, entity_field), rollup.period, rollup.start_dtm): rollup
+        for rollup in rollup_model.objects.select_for_update().filter(**{
+            entity_field + '__in': list({key[0] for key in groups}),
+            'start_dtm__in': list({key[2] for key in groups}),
+        })
+    }
+    rollups = []
+    for key, values in groups.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            if not create:
+                continue
+            rollup = rollup_model(**{entity_field: key[0], 'period': key[1], 'start_dtm': key[2]})
+        apply(rollup, values)
+        rollups.append(rollup)
+
+    # Updated rollups keep their primary keys
+    updated = [rollup.pk for rollup in rollups if rollup.pk is not None]
+    if updated:
+        rollup_model.objects.filter(pk__in=updated).delete()
+    rollup_model.objects.bulk_create(rollups)
+
+
+def refresh_rollups(city_keys, station_keys):
+    """
+    Calculate the daily and monthly rollups of cities and stations again from their records, e.g. after records are
+    deleted. Rollups without any record left are deleted.
+
+    Records of the changed months are aggregated by entity and local day with one grouped query for each model, and
+    monthly rollups are merged from the daily aggregates, so the number of queries does not depend on the number of
+    rollups.
+
+    :param city_keys: an iterable of (city id, update_dtm) of changed city records
+    :param station_keys: an iterable of (station id, update_dtm) of changed station records
+    """
+    periods = [period for period, _ in RollupFields.PERIOD_CHOICES]
+    aggregates = {'count': models.Count('pk')}
+    for field in ROLLUP_FIELDS:
+        aggregates.update({
+            '{}_sum'.format(field): models.Sum(field),
+            '{}_count'.format(field): models.Count(field),
+            '{}_min'.format(field): models.Min(field),
+            '{}_max'.format(field): models.Max(field),
+        })
+    for level in AQHI_LEVELS:
+        aggregates['aqhi_{}'.format(level)] = models.Sum(models.Case(
+            models.When(aqhi__gte=level, aqhi__lt=level + 1, then=1), default=0, output_field=models.IntegerField()
+        ))
+
+    with transaction.atomic():
+        for rollup_model, record_model, entity_field, keys in [
+            (CityRollup, CityRecord, 'city', city_keys),
+            (StationRollup, StationRecord, 'station', station_keys),
+        ]:
+            groups = {(entity, period, RollupFields.get_start_dtm(dtm, period))
+                      for entity, dtm in keys for period in periods}
+            if not groups:
+                continue
+
+            entity_id_field = entity_field + '_id'
+            existing = {
+                (getattr(rollup, entity_id_field), rollup.period, rollup.start_dtm): rollup.pk
+                for rollup in rollup_model.objects.select_for_update().filter(**{
+                    entity_id_field + '__in': list({key[0] for key in groups}),
+                    'start_dtm__in': list({key[2] for key in groups}),
+                }).only('pk', entity_id_field, 'period', 'start_dtm')
+            }
+
+            # Days of a month are all in its rollup, so the changed months cover every changed rollup
+            month_starts = [key[2] for key in groups if key[1] == 'month']
+            rows = record_model.objects.filter(**{
+                entity_field + '__in': list({key[0] for key in groups}),
+                'update_dtm__gte': min(month_starts),
+                'update_dtm__lt': RollupFields.get_end_dtm(max(month_starts), 'month'),
+            }).annotate(
+                day=DateTime('update_dtm', 'day', timezone.get_current_timezone())
+            ).order_by().values(entity_field, 'day').annotate(**aggregates)
+
+            rollups = {}
+            for row in rows:
+                entity = row.pop(entity_field)
+                day = row.pop('day')
+                for period in periods:
+                    key = (entity, period, RollupFields.get_start_dtm(day, period))
+                    if key not in groups:
+                        continue
+                    if key not in rollups:
+                        # Refreshed rollups keep their primary keys
+                        rollups[key] = rollup_model(pk=existing.get(key), **{
+                            entity_id_field: entity, 'period': period, 'start_dtm': key[2]
+                        })
+                    rollups[key].add_aggregates(row)
+
+            refreshed = [existing[key] for key in groups if key in existing]
+            if refreshed:
+                rollup_model.objects.filter(pk__in=refreshed).delete()
+            rollup_model.objects.bulk_create(rollups.values())
+
+
+def update_latest_records(city_records, station_records):
+    """
+    Point LatestCityRecord and LatestStationRecord of cities and stations to new records newer than their latest ones.
+    Like update_rollups, the number of queries is constant, and this is called in the same atomic block as the records
+    are created.
+
+    :param city_records: a list of saved CityRecords
+    :param station_records: a list of saved StationRecords
+    """
+    for latest_model, entity_field, records, build in [
+        (LatestCityRecord, 'city_id', city_records,
+         lambda record: LatestCityRecord(city_id=record.city_id, city_record_id=record.pk,
+                                         update_dtm=record.update_dtm)),
+        (LatestStationRecord, 'station_id', station_records,
+         lambda record: LatestStationRecord(station_id=record.station_id, station_record_id=record.pk,
+                                            city_id=record.city_id, update_dtm=record.update_dtm)),
+    ]:
+        newest = {}
+        for record in records:
+            entity = getattr(record, entity_field)
+            if entity not in newest or record.update_dtm > newest[entity].update_dtm:
+                newest[entity] = record
+        if not newest:
+            continue
+
+        existing = dict(latest_model.objects.select_for_update().filter(
+            pk__in=list(newest)
+        ).values_list('pk', 'update_dtm'))
+        newer = [record for entity, record in newest.items()
+                 if entity not in existing or record.update_dtm > existing[entity]]
+        if not newer:
+            continue
+
+        replaced = [getattr(record, entity_field) for record in newer if getattr(record, entity_field) in existing]
+        if replaced:
+            latest_model.objects.filter(pk__in=replaced).delete()
+        latest_model.objects.bulk_create([build(record) for record in newer])
+
+
+def refresh_latest_records(city_ids, station_ids):
+    """
+    Point LatestCityRecord and LatestStationRecord of cities and stations to their newest records again, e.g. after
+    records are deleted, with two queries of records for each model.
+
+    :param city_ids: an iterable of city ids
+    :param station_ids: an iterable of station ids
+    """
+    newest_records = []
+    with transaction.atomic():
+        for latest_model, record_model, entity_field, entities in [
+            (LatestCityRecord, CityRecord, 'city', city_ids),
+            (LatestStationRecord, StationRecord, 'station', station_ids),
+        ]:
+            entities = list(set(entities))
+            if not entities:
+                newest_records.append([])
+                continue
+            newest = dict(record_model.objects.filter(**{entity_field + '__in': entities}).order_by().values(
+                entity_field
+            ).annotate(models.Max('update_dtm')).values_list(entity_field, 'update_dtm__max'))
+            newest_records.append([
+                record for record in record_model.objects.filter(**{
+                    entity_field + '__in': list(newest),
+                    'update_dtm__in': list(set(newest.values())),
+                }) if record.update_dtm == newest[getattr(record, entity_field + '_id')]
+            ])
+            latest_model.objects.filter(pk__in=entities).delete()
+        update_latest_records(*newest_records)
+
+
+def update_latest_on_save(sender, instance, created, raw=False, **kwargs):
+    """
+    Receiver of post_save signals of CityRecord and StationRecord, so that records saved in any way, e.g. in admin,
+    are in LatestCityRecord and LatestStationRecord. A changed record may be moved back in time, so its city or
+    station is refreshed.
+    """
+    # Related rows of fixtures may not be loaded yet
+    if raw:
+        return
+    is_city = sender is CityRecord
+    with transaction.atomic():
+        if created:
+            update_latest_records([instance] if is_city else [], [] if is_city else [instance])
+        else:
+            refresh_latest_records([instance.city_id] if is_city else [], [] if is_city else [instance.station_id])
+
+
+for model in [CityRecord, StationRecord]:
+    post_save.connect(update_latest_on_save, sender=model, dispatch_uid='update_latest_on_save')
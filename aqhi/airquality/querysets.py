@@ -1,7 +1,118 @@
-from django.db import models as dj_models
-from django.db.models import Q
+from collections import defaultdict
+from datetime import timedelta
 
-from . import models
+from django.db import connections, models as dj_models
+from django.db.models import Q, Avg
+
+from . import models, utils
+
+
+class HourBucket(dj_models.Func):
+    """
+    Index of the `hours`-hour bucket since `start` a datetime expression falls into, calculated in database.
+    Only database vendors in `templates` are supported, see supports.
+    """
+    templates = {
+        'sqlite': "((CAST(strftime('%%s', {expression}) AS INTEGER) - CAST(strftime('%%s', {start}) AS INTEGER))"
+                  " / {seconds})",
+        'postgresql': "CAST(FLOOR(EXTRACT(EPOCH FROM ({expression} - {start})) / {seconds}) AS INTEGER)",
+        'mysql': "FLOOR(TIMESTAMPDIFF(SECOND, {start}, {expression}) / {seconds})",
+    }
+
+    def __init__(self, expression, start, hours, **extra):
+        super(HourBucket, self).__init__(
+            expression, dj_models.Value(start, output_field=dj_models.DateTimeField()),
+            output_field=dj_models.IntegerField(), **extra
+        )
+        self.hours = hours
+
+    @classmethod
+    def supports(cls, connection):
+        return connection.vendor in cls.templates
+
+    def as_sql(self, compiler, connection):
+        if not self.supports(connection):
+            raise NotImplementedError('HourBucket is not supported on {}.'.format(connection.vendor))
+        expression_sql, expression_params = compiler.compile(self.source_expressions[0])
+        start_sql, start_params = compiler.compile(self.source_expressions[1])
+        # Parameters appear in the order of the template
+        if connection.vendor == 'mysql':
+            params = start_params + expression_params
+        else:
+            params = expression_params + start_params
+        return self.templates[connection.vendor].format(
+            expression=expression_sql, start=start_sql, seconds=int(self.hours * 3600)
+        ), params
+
+
+class BulkUpdateQuerySetMixin(object):
+    def update_in_bulk(self, field, values, batch_size=1000):
+        """
+        Set a field of many rows to different values with as few UPDATE queries as possible.
+        Rows are grouped by their new value, so this suits fields with few distinct values like aqhi.
+
+        :param field: name of the field to update
+        :param values: a dict mapping primary keys to new values
+        :param batch_size: max number of primary keys in one query
+        :return: number of updated rows
+        """
+        pks_by_value = defaultdict(list)
+        for pk, value in values.items():
+            pks_by_value[value].append(pk)
+
+        count = 0
+        for value, pks in pks_by_value.items():
+            for i in range(0, len(pks), batch_size):
+                count += self.filter(pk__in=pks[i:i + batch_size]).update(**{field: value})
+        return count
+
+
+class KeysetScanQuerySetMixin(object):
+    # Field of update datetime the scan is ordered by, together with pk
+    scan_dtm_field = 'update_dtm'
+
+    def scan(self, *fields, chunk_size=1000, after=None):
+        """
+        Iterate over the queryset in chunks ordered by update datetime and pk with keyset pagination.
+        Every chunk is a separate query filtered by the key of the last row of the previous chunk, so memory
+        stays flat and the cost of a chunk does not grow with its position like OFFSET does.
+
+        :param fields: if given, rows are tuples of values_list(*fields), otherwise model instances.
+            The dtm field and 'pk' are appended to the fields if not included.
+        :param chunk_size: max number of rows in a chunk
+        :param after: an (update_dtm, pk) key, only rows after it are scanned. Use it to resume a scan.
+        :return: a generator of lists of rows
+        """
+        dtm_field = self.scan_dtm_field
+        queryset = self.order_by(dtm_field, 'pk')
+        if fields:
+            fields = list(fields) + [f for f in [dtm_field, 'pk'] if f not in fields]
+            queryset = queryset.values_list(*fields)
+            dtm_index, pk_index = fields.index(dtm_field), fields.index('pk')
+            get_key = lambda row: (row[dtm_index], row[pk_index])
+        else:
+            related_path = dtm_field.split('__')
+            if len(related_path) > 1:
+                queryset = queryset.select_related('__'.join(related_path[:-1]))
+
+            def get_key(obj):
+                value = obj
+                for name in related_path:
+                    value = getattr(value, name)
+                return value, obj.pk
+
+        while True:
+            chunk = queryset
+            if after is not None:
+                chunk = chunk.filter(Q(**{dtm_field + '__gt': after[0]}) |
+                                     Q(**{dtm_field: after[0], 'pk__gt': after[1]}))
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            after = get_key(chunk[-1])
 
 
 class CityQuerySet(dj_models.QuerySet):
@@ -12,7 +123,7 @@ class CityQuerySet(dj_models.QuerySet):
         return self.filter(Q(name_en='beijing') | Q(name_en='shanghai') | Q(name_en='guangzhou'))
 
 
-class CityRecordQuerySet(dj_models.QuerySet):
+class CityRecordQuerySet(KeysetScanQuerySetMixin, BulkUpdateQuerySetMixin, dj_models.QuerySet):
     def recorded_in(self, city=None, name_en=None, name_cn=None):
         if city is not None:
             return self.filter(city=city)
@@ -24,22 +135,80 @@ class CityRecordQuerySet(dj_models.QuerySet):
             return self
 
     def latests(self):
-        return self.filter(update_dtm=self.latest().update_dtm)
+        # Rows would otherwise come in the order of whichever index is used
+        return self.filter(update_dtm=self.latest().update_dtm).order_by('pk')
+
+    def current(self):
+        """Return the newest record of every city, as maintained in LatestCityRecord."""
+        return self.filter(latest_of__isnull=False)
 
     def latest_record_in(self, name_en):
-        return self.filter(city__name_en=name_en).latest()
+        try:
+            return self.current().get(city__name_en=name_en)
+        except self.model.DoesNotExist:
+            # Records loaded raw, e.g. by loaddata, are not in LatestCityRecord
+            return self.filter(city__name_en=name_en).latest()
+
+    def average_in_hours(self, start_dtm, hours=24, fields=None):
+        """
+        Average fields of records in buckets of `hours` hours since `start_dtm`, aggregated in database, or in Python
+        on database vendors HourBucket does not support. The last bucket may be partial.
+        None values are ignored like AVG does, so a field is None only if all its values in a bucket are None.
+
+        :param start_dtm: start of the first bucket, records before it are excluded
+        :param hours: length of a bucket in hours
+        :param fields: a list of field names to average, defaults to models.DECIMAL_FIELDS
+        :return: a list of dicts with averaged fields and 'datetime', the start of the bucket, in ascending order
+        """
+        if fields is None:
+            fields = models.DECIMAL_FIELDS
+        if not HourBucket.supports(connections[self.db]):
+            return self.filter(update_dtm__gte=start_dtm)._average_in_hours_in_python(start_dtm, hours, fields)
+        rows = self.filter(update_dtm__gte=start_dtm).annotate(
+            bucket=HourBucket('update_dtm', start_dtm, hours)
+        ).order_by().values('bucket').annotate(
+            **{field: Avg(field) for field in fields}
+        ).order_by('bucket')
 
+        # Averages of scaled integer fields are scaled
+        unscale_funcs = {field: getattr(self.model._meta.get_field(field), 'unscale', None) for field in fields}
+        res = []
+        for row in rows:
+            row['datetime'] = start_dtm + timedelta(hours=hours * int(row.pop('bucket')))
+            for field, unscale in unscale_funcs.items():
+                if unscale is not None:
+                    row[field] = unscale(row[field])
+            res.append(row)
+        return res
 
-class StationRecordQuerySet(dj_models.QuerySet):
+    def _average_in_hours_in_python(self, start_dtm, hours, fields):
+        """average_in_hours on database vendors HourBucket does not support, loading records to average them."""
+        buckets = defaultdict(list)
+        for record in self.only('update_dtm', *fields).order_by():
+            buckets[int((record.update_dtm - start_dtm).total_seconds() // (hours * 3600))].append(record)
+        res = []
+        for bucket in sorted(buckets):
+            row = utils.reduce_to_one_record_dict(buckets[bucket], fields, _round=False)
+            row['datetime'] = start_dtm + timedelta(hours=hours * bucket)
+            res.append(row)
+        return res
+
+
+class StationRecordQuerySet(KeysetScanQuerySetMixin, BulkUpdateQuerySetMixin, dj_models.QuerySet):
     def recorded_in(self, city=None, name_en=None, name_cn=None):
         if city is not None:
-            return self.filter(city_record__city=city)
+            return self.filter(city=city)
         elif name_en is not None:
-            return self.filter(city_record__city__name_en=name_en)
+            return self.filter(city__name_en=name_en)
         elif name_cn is not None:
-            return self.filter(city_record__city__name_cn=name_cn)
+            return self.filter(city__name_cn=name_cn)
         else:
             return self
 
     def latests(self):
-        return self.filter(city_record__update_dtm=self.latest().get_update_dtm())
+        # Rows would otherwise come in the order of whichever index is used
+        return self.filter(update_dtm=self.latest().update_dtm).order_by('pk')
+
+    def current(self):
+        """Return the newest record of every station, as maintained in LatestStationRecord."""
+        return self.filter(latest_of__isnull=False)
@@ -1,27 +1,116 @@
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
 
 from . import models
 
 
+# ===================================================================
+# Mixins
+# ===================================================================
+class SparseFieldsetMixin(object):
+    """
+    Only keep the fields in `sparse_fields`, a structure generated by views.FilterFieldsMixin._generate_structure.
+    A nested serializer is restricted by the sub structure of its name, or kept as a whole if its name maps to None.
+    `url` and `id` are always kept.
+
+    Serializers may map field sources to the paths of model fields they need in Meta.source_fields, so that
+    get_queryset_fields can load them. The source of hyperlinks to instances is `*`, whose names are str(instance).
+    """
+    preserved_fields = ('url', 'id')
+
+    def __init__(self, *args, **kwargs):
+        sparse_fields = kwargs.pop('sparse_fields', None)
+        super(SparseFieldsetMixin, self).__init__(*args, **kwargs)
+        if sparse_fields is not None:
+            self.restrict_fields(sparse_fields)
+
+    def restrict_fields(self, sparse_fields):
+        for name in list(self.fields):
+            if name not in sparse_fields and name not in self.preserved_fields:
+                self.fields.pop(name)
+            elif isinstance(sparse_fields.get(name), dict) and isinstance(self.fields[name], SparseFieldsetMixin):
+                self.fields[name].restrict_fields(sparse_fields[name])
+
+    def get_queryset_fields(self, prefix=''):
+        """
+        Return lists of field paths for only(), select_related() and prefetch_related() to load what the fields
+        need. The list for only() is None if some field needs the whole instance.
+        """
+        source_fields = getattr(self.Meta, 'source_fields', {})
+        only, select_related, prefetch_related = [], [], []
+
+        for field in self.fields.values():
+            if field.source in source_fields:
+                for path in source_fields[field.source]:
+                    if only is not None:
+                        only.append(prefix + path)
+                    relation = self._get_relation_path(path)
+                    if relation:
+                        select_related.append(prefix + relation)
+            elif isinstance(field, serializers.HyperlinkedIdentityField):
+                # Primary keys are always loaded
+                continue
+            elif isinstance(field, serializers.ListSerializer):
+                prefetch_related.append(prefix + field.source)
+            elif isinstance(field, SparseFieldsetMixin):
+                select_related.append(prefix + field.source)
+                nested_only, nested_select_related, nested_prefetch_related = field.get_queryset_fields(
+                    prefix + field.source + '__'
+                )
+                if nested_only is None or only is None:
+                    only = None
+                else:
+                    only.append(prefix + field.source)
+                    only.extend(nested_only)
+                select_related.extend(nested_select_related)
+                prefetch_related.extend(nested_prefetch_related)
+            elif only is not None:
+                try:
+                    self.Meta.model._meta.get_field(field.source)
+                    only.append(prefix + field.source)
+                except FieldDoesNotExist:
+                    only = None
+
+        return only, select_related, prefetch_related
+
+    def _get_relation_path(self, path):
+        """
+        Return the longest prefix of a field path which is a relation, e.g. `station__city` of `station__city__name_cn`
+        or `station__city` itself, or an empty string if there is none.
+        """
+        model = self.Meta.model
+        names = path.split('__')
+        relation_names = []
+        for name in names:
+            field = model._meta.get_field(name)
+            if not field.is_relation:
+                break
+            relation_names.append(name)
+            model = field.related_model
+        return '__'.join(relation_names)
+
+
 # ===================================================================
 # Serializers
 # ===================================================================
 # City and Station Serializers
 # -------------------------------------------------------------------
-class CitySerializer(serializers.HyperlinkedModelSerializer):
+class CitySerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = models.City
+        source_fields = {'*': ['name_cn']}
         fields = ('url', 'name_en', 'name_cn', 'longitude', 'latitude')
         extra_kwargs = {
             'url': {'view_name': 'api:city-detail'}
         }
 
 
-class StationSerializer(serializers.HyperlinkedModelSerializer):
+class StationSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = models.Station
+        source_fields = {'*': ['name_cn', 'city']}
         fields = ('url', 'id', 'name_cn', 'longitude', 'latitude')
         extra_kwargs = {
             'url': {'view_name': 'api:station-detail'}
@@ -30,7 +119,7 @@ class StationSerializer(serializers.HyperlinkedModelSerializer):
 
 # Primary Pollutant Serializer
 # -------------------------------------------------------------------
-class CityPrimaryPollutantSerializer(serializers.HyperlinkedModelSerializer):
+class CityPrimaryPollutantSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = models.CityPrimaryPollutantItem
@@ -39,13 +128,14 @@ class CityPrimaryPollutantSerializer(serializers.HyperlinkedModelSerializer):
 
 # CityRecord Serializer
 # -------------------------------------------------------------------
-class CityRecordSerializer(serializers.HyperlinkedModelSerializer):
+class CityRecordSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
 
     city = CitySerializer(read_only=True)
     primary_pollutants = CityPrimaryPollutantSerializer(many=True, read_only=True)
 
     class Meta:
         model = models.CityRecord
+        source_fields = {'*': ['city', 'update_dtm']}
         fields = ('url', 'id', 'update_dtm', 'city', 'primary_pollutants',
                   'aqhi', 'aqi', 'co', 'no2', 'o3', 'o3_8h', 'pm10', 'pm2_5', 'so2', 'quality')
         extra_kwargs = {
@@ -53,13 +143,16 @@ class CityRecordSerializer(serializers.HyperlinkedModelSerializer):
         }
 
 
-class StationRecordSerializer(serializers.HyperlinkedModelSerializer):
+class StationRecordSerializer(SparseFieldsetMixin, serializers.HyperlinkedModelSerializer):
 
     station = StationSerializer(read_only=True)
-    update_dtm = serializers.DateTimeField(source='get_update_dtm')
 
     class Meta:
         model = models.StationRecord
+        source_fields = {
+            '*': ['station__name_cn', 'station__city', 'update_dtm'],
+            'city_record': ['city_record__city', 'city_record__update_dtm'],
+        }
         fields = ('url', 'id', 'station', 'city_record', 'update_dtm',
                   'aqhi', 'aqi', 'co', 'no2', 'o3', 'o3_8h', 'pm10', 'pm2_5', 'so2', 'quality')
         extra_kwargs = {
@@ -91,3 +184,35 @@ class AverageCityRecordSerializer(serializers.Serializer):
                                     required=False, read_only=True)
     pm2_5 = serializers.DecimalField(max_digits=models.POLL_MAX_DIGITS, decimal_places=models.POLL_DECIMAL_PLACES,
                                      required=False, read_only=True)
+
+
+# Rollup Serializers
+# -------------------------------------------------------------------
+class RollupSerializerMixin(serializers.Serializer):
+
+    mean = serializers.SerializerMethodField()
+    aqhi_distribution = serializers.SerializerMethodField()
+
+    rollup_fields = ('period', 'start_dtm', 'count', 'mean', 'aqhi_distribution') + tuple(
+        '{}_{}'.format(field, suffix) for field in models.ROLLUP_FIELDS for suffix in ['min', 'max', 'count']
+    )
+
+    def get_mean(self, obj):
+        return {field: obj.mean(field) for field in models.ROLLUP_FIELDS}
+
+    def get_aqhi_distribution(self, obj):
+        return {level: getattr(obj, 'aqhi_{}'.format(level)) for level in models.AQHI_LEVELS}
+
+
+class CityRollupSerializer(RollupSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
+
+    class Meta:
+        model = models.CityRollup
+        fields = ('id', 'city') + RollupSerializerMixin.rollup_fields
+
+
+class StationRollupSerializer(RollupSerializerMixin, SparseFieldsetMixin, serializers.ModelSerializer):
+
+    class Meta:
+        model = models.StationRollup
+        fields = ('id', 'station') + RollupSerializerMixin.rollup_fields
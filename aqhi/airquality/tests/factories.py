@@ -206,6 +206,8 @@ class EstimatedCityRecordFactory(BaseRecordFactory):
 class StationRecordFactory(BaseRecordFactory):
     station = factory.SubFactory(StationFactory)
     city_record = factory.SubFactory(CityRecordFactory)
+    city = factory.SelfAttribute('city_record.city')
+    update_dtm = factory.SelfAttribute('city_record.update_dtm')
     primary_pollutant = factory.RelatedFactory(
         'aqhi.airquality.tests.factories.StationPrimaryPollutantItemFactory',
         'station_record'
@@ -1,10 +1,23 @@
 import io
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
 from decimal import Decimal
+from unittest import mock
 
+import numpy
+import pytz
 from django.test import TestCase
-from django.core.management import call_command
+from django.core.management import call_command, CommandError
+from django.utils import timezone
 
 from aqhi.airquality.management.commands.add_coordinates import add_coord_to_station_by_name
+from aqhi.airquality.management.commands.collect_records import parse_page, parse_in_batches
+from aqhi.airquality.management.commands.run_scheduler import Command as RunScheduler, get_scheduler
+from aqhi.airquality.management.commands.update_aqhi import update_records
+from aqhi.airquality.utils import CrawlState, ScanCheckpoint
 from . import factories
 from .. import models
 
@@ -38,3 +51,216 @@ class TestAddCoordinates(TestCase):
         )
         self.assertEqual(station.longitude, old_lng + Decimal('1'))
         self.assertEqual(station.latitude, old_lat + Decimal('1'))
+
+
+class TestCollectRecords(TestCase):
+
+    def setUp(self):
+        file_name = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'files/beijing.html')
+        with open(file_name) as f:
+            self.page = (file_name, f.read())
+
+    def test_parse_page(self):
+        file_name, info_dict, exception = parse_page(self.page)
+        self.assertEqual(file_name, self.page[0])
+        self.assertIsNone(exception)
+        self.assertEqual(info_dict['city']['area_en'], 'beijing')
+
+        file_name, info_dict, exception = parse_page(('foo.txt', ''))
+        self.assertIsNone(info_dict)
+        self.assertIsNotNone(exception)
+
+    def test_collect(self):
+        files_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, files_dir)
+        shutil.copy(self.page[0], files_dir)
+
+        call_command('collect_names', files_dir, stdout=io.StringIO())
+        for workers in [1, 2]:
+            with self.subTest(workers=workers):
+                models.CityRecord.objects.all().delete()
+                call_command('collect_records', files_dir, workers=workers, stdout=io.StringIO())
+                city_record = models.CityRecord.objects.get(city='beijing')
+                self.assertEqual(city_record.station_records.count(), models.Station.objects.filter(city='beijing').count())
+
+    def test_parse_in_batches(self):
+        batches = list(parse_in_batches(iter([self.page] * 5), 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+
+class TestUpdateAqhi(TestCase):
+
+    def test_update(self):
+        station = factories.StationFactory()
+        for _ in range(4):
+            factories.StationRecordFactory(station=station, city_record=factories.CityRecordFactory(city=station.city))
+        models.CityRecord.objects.update(aqhi=None)
+        models.StationRecord.objects.update(aqhi=None)
+        models.StationRecord.objects.filter(pk=models.StationRecord.objects.first().pk).update(aqhi=Decimal(12))
+
+        call_command('update_aqhi', stdout=io.StringIO())
+        for record in list(models.CityRecord.objects.all()) + list(models.StationRecord.objects.all()):
+            if record.aqhi != Decimal(12):
+                self.assertEqual(record.aqhi, record.calculate_aqhi_field())
+
+        call_command('update_aqhi', override=True, stdout=io.StringIO())
+        for record in list(models.CityRecord.objects.all()) + list(models.StationRecord.objects.all()):
+            self.assertEqual(record.aqhi, record.calculate_aqhi_field())
+
+    def test_update_in_batches(self):
+        # Same values in all records, so each batch is written with one query
+        for _ in range(5):
+            factories.CityRecordFactory(aqhi=None, pm10=100, pm2_5=50, so2=10, no2=10, o3=100)
+
+        # For each batch, one select, a savepoint and its release, one update and one select of rollups
+        with self.assertNumQueries(3 * 5):
+            count = update_records(models.CityRecord.objects.all(), 'city', batch_size=2)
+        self.assertEqual(count, 5)
+        for record in models.CityRecord.objects.all():
+            self.assertEqual(record.aqhi, record.calculate_aqhi_field())
+
+    def test_update_rollups_and_caches(self):
+        station = factories.StationFactory()
+        dtm = datetime(2016, 6, 1, tzinfo=pytz.utc)
+        models.create_city_records([
+            factories.InfoDictFactory(city=station.city, stations=[station], station_num=1,
+                                      update_dtm=dtm + timedelta(hours=i))
+            for i in range(4)
+        ], calculate_aqhi=False)
+
+        with mock.patch('aqhi.airquality.caching.touch') as mock_touch:
+            call_command('update_aqhi', stdout=io.StringIO())
+        mock_touch.assert_any_call('cityrecord', cities={station.city_id}, dtms=mock.ANY)
+        mock_touch.assert_any_call('stationrecord', cities={station.city_id}, dtms=mock.ANY)
+        self.assertTrue(models.CityRecord.objects.filter(aqhi__isnull=False).exists())
+
+        for rollup_model, records in [
+            (models.CityRollup, models.CityRecord.objects.all()),
+            (models.StationRollup, models.StationRecord.objects.all()),
+        ]:
+            rollup = rollup_model.objects.get(period='month')
+            for level in models.AQHI_LEVELS:
+                self.assertEqual(getattr(rollup, 'aqhi_{}'.format(level)),
+                                 len([r for r in records if r.aqhi is not None and int(r.aqhi) == level]))
+
+    def test_resume_from_checkpoint(self):
+        city = factories.CityFactory()
+        records = [factories.CityRecordFactory(city=city, aqhi=None) for _ in range(5)]
+        checkpoint_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_dir)
+        checkpoint = ScanCheckpoint(os.path.join(checkpoint_dir, 'checkpoint.json'))
+        checkpoint.set('city', (records[2].update_dtm, records[2].pk))
+
+        count = update_records(models.CityRecord.objects.all(), 'city', batch_size=2,
+                               checkpoint=checkpoint, checkpoint_name='city')
+        self.assertEqual(count, 2)
+        for record in models.CityRecord.objects.all():
+            if record.update_dtm <= records[2].update_dtm:
+                self.assertIsNone(record.aqhi)
+            else:
+                self.assertEqual(record.aqhi, record.calculate_aqhi_field())
+
+        checkpoint = ScanCheckpoint(checkpoint.path)
+        self.assertEqual(checkpoint.get('city'), (records[4].update_dtm, records[4].pk))
+
+        # A complete run deletes the checkpoint, so the next run starts over
+        models.CityRecord.objects.update(aqhi=None)
+        call_command('update_aqhi', checkpoint=checkpoint.path, stdout=io.StringIO())
+        self.assertFalse(os.path.exists(checkpoint.path))
+        call_command('update_aqhi', checkpoint=checkpoint.path, override=True, stdout=io.StringIO())
+        for record in models.CityRecord.objects.all():
+            self.assertEqual(record.aqhi, record.calculate_aqhi_field())
+
+
+class TestExportRecords(TestCase):
+
+    def test_export(self):
+        records = [factories.StationRecordFactory() for _ in range(3)]
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        output = os.path.join(output_dir, 'records.npz')
+
+        call_command('export_records', 'station', output, city=records[0].city_id, fields='aqhi,pm2_5',
+                     chunk_size=1, stdout=io.StringIO())
+        arrays = numpy.load(output)
+        self.assertEqual(set(arrays.files), {'update_dtm', 'city', 'station', 'aqhi', 'pm2_5'})
+        self.assertEqual(list(arrays['city']), [records[0].city_id])
+        self.assertEqual(list(arrays['aqhi']), [float(records[0].aqhi)])
+
+        call_command('export_records', 'city', output, chunk_size=2, stdout=io.StringIO())
+        self.assertEqual(len(numpy.load(output)['update_dtm']), 3)
+
+
+class TestRunScheduler(TestCase):
+
+    def test_get_scheduler(self):
+        city_record = factories.CityRecordFactory()
+        city = city_record.city
+        factories.CityRecordFactory(city=city, update_dtm=city_record.update_dtm - timedelta(hours=1))
+        crawl_state = CrawlState()
+        crawl_state.update('foo', update_dtm=city_record.update_dtm)
+
+        scheduler = get_scheduler(crawl_state, city_record.update_dtm)
+        self.assertEqual(set(scheduler.next_fetch), {city.name_en, 'foo'})
+        self.assertEqual(scheduler.next_fetch[city.name_en], city_record.update_dtm + timedelta(hours=1, minutes=20))
+
+    def get_command(self, now):
+        command = RunScheduler()
+        command.logger = mock.create_autospec(logging.root)
+        command.crawl_state = CrawlState()
+        command.scheduler = get_scheduler(command.crawl_state, now)
+        command.refresh_interval = timedelta(hours=1)
+        command.refreshed = now
+        command.crawling = True
+        # Closing the connection would break the transaction of the test
+        self.close_old_connections = mock.patch(
+            'aqhi.airquality.management.commands.run_scheduler.close_old_connections'
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+        return command
+
+    def test_no_city(self):
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        with self.assertRaisesRegex(CommandError, 'No city'):
+            call_command('run_scheduler', dest, stdout=io.StringIO())
+
+    def test_refresh_cities(self):
+        now = timezone.now()
+        command = self.get_command(now)
+        city = factories.CityFactory()
+        command.tick()
+        self.assertNotIn(city.name_en, command.scheduler.next_fetch)
+        self.assertEqual(self.close_old_connections.call_count, 1)
+
+        with mock.patch.object(timezone, 'now', return_value=now + timedelta(hours=1)):
+            command.tick()
+        self.assertEqual(command.scheduler.next_fetch[city.name_en], now + timedelta(hours=1))
+        self.assertEqual(command.refreshed, now + timedelta(hours=1))
+
+    def test_tick_logs_exceptions(self):
+        command = self.get_command(timezone.now())
+        command.crawling = False
+        with mock.patch.object(command.scheduler, 'due', side_effect=RuntimeError):
+            command.tick()
+        self.assertEqual(command.logger.exception.call_count, 1)
+
+        # A crawl failing to start is handled like a failed crawl
+        command.dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, command.dest)
+        command.max_cities = 0
+        command.to_parse = False
+        command.scheduler.add_cities(['foo'], timezone.now())
+        command.runner = mock.Mock(**{'crawl.side_effect': RuntimeError})
+        command.tick()
+        self.assertFalse(command.crawling)
+        self.assertEqual(command.logger.error.call_count, 1)
+        self.assertGreater(command.scheduler.next_fetch['foo'], timezone.now())
+
+
+class TestBenchStorage(TestCase):
+
+    def test_bench(self):
+        out = io.StringIO()
+        call_command('bench_storage', records=50, stdout=out)
+        self.assertIn('Scaled over decimal storage of 50 records', out.getvalue())
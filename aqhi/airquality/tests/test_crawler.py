@@ -1,15 +1,27 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
 from unittest import mock
 import logging
 import re
 
+import pytz
 from django.test import SimpleTestCase, TestCase
-from scrapy.http import Response, TextResponse
+from scrapy.http import Request, Response, TextResponse
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+from twisted.internet.error import DNSLookupError
 
 from aqhi.airquality.crawler.pm25in.spiders.pm25in_spider import AQISpider
 from aqhi.airquality.crawler.pm25in.items import PageItem
+from aqhi.airquality.crawler.pm25in.middlewares import BackoffRetryMiddleware
 from aqhi.airquality.crawler.pm25in.pipelines import SavePagePipeline
+from aqhi.airquality.crawler.scheduler import CrawlScheduler
+from aqhi.airquality.utils import CrawlState
 from . import factories
+from .. import models
 
 
 class AQISpiderTestCase(SimpleTestCase):
@@ -27,6 +39,49 @@ class AQISpiderTestCase(SimpleTestCase):
             ['abazhou', 'akesudiqu', 'alashanmeng', 'aletaidiqu', 'alidiqu', 'ankang', 'anqing', 'anshan', 'anshun', 'anyang']
         )
 
+    def test_conditional_requests(self):
+        crawl_state = CrawlState()
+        crawl_state.update('city1', etag='"abc"', last_modified='Sat, 07 May 2016 00:10:00 GMT')
+        body = '<div class="all"><a href="/city1">1</a><a href="/city2">2</a></div>'
+        response = TextResponse('http://url', body=body, encoding='utf-8')
+        spider = AQISpider('path', self.mock_logger, 0, crawl_state=crawl_state)
+        requests = list(spider.parse(response))
+        self.assertEqual(requests[0].headers.get('If-None-Match'), b'"abc"')
+        self.assertEqual(requests[0].headers.get('If-Modified-Since'), b'Sat, 07 May 2016 00:10:00 GMT')
+        self.assertNotIn('If-None-Match', requests[1].headers)
+
+    def test_crawl_cities(self):
+        spider = AQISpider('path', self.mock_logger, 0, city_names=['city1', 'city2'])
+        self.assertEqual([request.url for request in spider.start_requests()],
+                         ['http://pm25.in/city1', 'http://pm25.in/city2'])
+
+    def test_skip_pages_not_updated(self):
+        def get_response(hour, status=200):
+            return Response('http://url/city1', status=status, headers={'ETag': '"{}"'.format(hour)}, body=(
+                '<div class="live_data_time"><p>数据更新时间：2016-05-07 {:02d}:00:00</p></div>'.format(hour)
+            ).encode())
+
+        spider = AQISpider('path', self.mock_logger, 0)
+        self.assertEqual(len(list(spider.parse_city_page(get_response(8)))), 1)
+        # Not advanced until the page is saved by the pipeline
+        self.assertEqual(spider.crawl_state.get_headers('city1'), {})
+        spider.page_saved('city1')
+        self.assertEqual(spider.crawl_state.get_headers('city1'), {'If-None-Match': '"8"'})
+        self.assertEqual(list(spider.parse_city_page(get_response(8))), [])
+        self.assertEqual(list(spider.parse_city_page(get_response(8, status=304))), [])
+        self.assertEqual(len(list(spider.parse_city_page(get_response(9)))), 1)
+        self.assertEqual(spider.crawl_state.get_update_dtm('city1'), datetime(2016, 5, 7, 0, tzinfo=pytz.utc))
+        spider.page_saved('city1')
+        self.assertEqual(spider.crawl_state.get_update_dtm('city1'), datetime(2016, 5, 7, 1, tzinfo=pytz.utc))
+
+    def test_save_state_when_closed(self):
+        crawl_state = mock.create_autospec(CrawlState)
+        AQISpider('path', self.mock_logger, 0, crawl_state=crawl_state).closed('finished')
+        self.assertEqual(crawl_state.save.call_count, 1)
+        # Pages only backed up are not skipped by the next crawl
+        AQISpider('path', self.mock_logger, 0, False, crawl_state=crawl_state).closed('finished')
+        self.assertEqual(crawl_state.save.call_count, 1)
+
     def test_city_page(self):
         sample_body = b'abcd'
 
@@ -38,6 +93,108 @@ class AQISpiderTestCase(SimpleTestCase):
             [PageItem(name='city1', page=sample_body)]
         )
 
+    def test_ignore_other_statuses(self):
+        spider = AQISpider('path', self.mock_logger, 0)
+        self.assertEqual(list(spider.parse_city_page(Response('http://url/city1', status=206))), [])
+        self.mock_logger.warning.assert_called_once_with('Ignore http://url/city1 with status 206.')
+
+
+class BackoffRetryMiddlewareTestCase(SimpleTestCase):
+    def setUp(self):
+        self.crawler = get_crawler(AQISpider, {
+            'RETRY_TIMES': 2, 'RETRY_BACKOFF_BASE': 5, 'RETRY_BACKOFF_MAX': 8
+        })
+        self.spider = AQISpider.from_crawler(self.crawler, 'path', logging.root, 0)
+        self.middleware = BackoffRetryMiddleware.from_crawler(self.crawler)
+
+    def test_retry_with_backoff(self):
+        request = Request('http://url/city1')
+        self.assertIsNone(self.middleware.process_request(request, self.spider))
+
+        retries = []
+        for i in range(3):
+            response = Response(request.url, status=503, request=request)
+            request = self.middleware.process_response(request, response, self.spider)
+            retries.append(request)
+        self.assertEqual([request.meta['retry_times'] for request in retries[:2]], [1, 2])
+        self.assertIsInstance(retries[2], Response)
+        self.assertEqual(self.crawler.stats.get_value('retry/count'), 2)
+        self.assertEqual(self.crawler.stats.get_value('retry/reason_count/503 Service Unavailable'), 2)
+        self.assertEqual(self.crawler.stats.get_value('retry/max_reached'), 1)
+
+        self.assertEqual([self.middleware.get_backoff(retries) for retries in (1, 2, 3)], [5, 8, 8])
+        with mock.patch('aqhi.airquality.crawler.pm25in.middlewares.task.deferLater') as mock_defer:
+            self.middleware.process_request(retries[0], self.spider)
+        self.assertEqual(mock_defer.call_args[0][1], 5)
+
+    def test_retry_exceptions(self):
+        request = Request('http://url/city1')
+        self.assertIsNotNone(self.middleware.process_exception(request, DNSLookupError(), self.spider))
+        self.assertEqual(self.crawler.stats.get_value('retry/reason_count/DNSLookupError'), 1)
+
+
+class CrawlSchedulerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.crawl_state = CrawlState()
+        self.scheduler = CrawlScheduler(self.crawl_state)
+        self.dtm = datetime(2016, 5, 7, tzinfo=pytz.utc)
+
+    def test_fetch_after_expected_update(self):
+        self.scheduler.learn('city1', [self.dtm - timedelta(hours=2), self.dtm])
+        self.scheduler.learn('city2', [self.dtm - timedelta(hours=2), self.dtm])
+        for delay in [600, 900, 1200]:
+            self.crawl_state.add_delay('city2', delay)
+        self.scheduler.add_cities(['city1', 'city2', 'city3'], self.dtm)
+
+        # Updates every two hours, published after the default delay or the median delay
+        self.assertEqual(self.scheduler.next_fetch['city1'], self.dtm + timedelta(hours=2, minutes=20))
+        self.assertEqual(self.scheduler.next_fetch['city2'], self.dtm + timedelta(hours=2, minutes=15))
+        self.assertEqual(self.scheduler.due(self.dtm), ['city3'])
+        self.assertEqual(self.scheduler.due(self.dtm + timedelta(hours=3)), ['city3', 'city2', 'city1'])
+
+    def test_retry_with_backoff(self):
+        self.scheduler.learn('city1', [self.dtm])
+        self.crawl_state.update('city1', update_dtm=self.dtm)
+        now = self.dtm + timedelta(hours=1, minutes=20)
+        for retry_minutes in [2, 4, 8, 16, 30, 30]:
+            self.scheduler.record('city1', now)
+            self.assertEqual(self.scheduler.next_fetch['city1'], now + timedelta(minutes=retry_minutes))
+            now = self.scheduler.next_fetch['city1']
+
+        # Found after misses, so the delay is measured
+        self.crawl_state.update('city1', update_dtm=self.dtm + timedelta(hours=1))
+        self.scheduler.record('city1', now)
+        delay = now - self.dtm - timedelta(hours=1)
+        self.assertEqual(self.crawl_state.get_delays('city1'), [delay.total_seconds()])
+        self.assertEqual(self.scheduler.misses['city1'], 0)
+        self.assertEqual(self.scheduler.next_fetch['city1'], self.dtm + timedelta(hours=2) + delay)
+
+    def test_probe_earlier_after_hits(self):
+        self.scheduler.learn('city1', [self.dtm])
+        self.crawl_state.update('city1', update_dtm=self.dtm + timedelta(hours=1))
+        self.scheduler.record('city1', self.dtm + timedelta(hours=1, minutes=20))
+        self.assertEqual(self.crawl_state.get_delays('city1'), [18 * 60])
+
+
+class CrawlStateTestCase(SimpleTestCase):
+
+    def test_save_and_load(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        path = os.path.join(state_dir, 'crawl_state.json')
+        dtm = datetime(2016, 5, 7, tzinfo=pytz.utc)
+
+        crawl_state = CrawlState(path)
+        crawl_state.update('city1', update_dtm=dtm, last_modified='Sat, 07 May 2016 00:10:00 GMT')
+        crawl_state.save()
+
+        crawl_state = CrawlState(path)
+        self.assertEqual(crawl_state.get_update_dtm('city1'), dtm)
+        self.assertEqual(crawl_state.get_headers('city1'), {'If-Modified-Since': 'Sat, 07 May 2016 00:10:00 GMT'})
+        self.assertIsNone(crawl_state.get_update_dtm('city2'))
+        self.assertIsNone(CrawlState(path, load=False).get_update_dtm('city1'))
+
 
 class SavePagePipelineTestCase(TestCase):
     def setUp(self):
@@ -53,7 +210,7 @@ class SavePagePipelineTestCase(TestCase):
         item = PageItem(name='city', page=b'abcd')
         spider = AQISpider(res_dir, self.mock_logger, 0)
 
-        SavePagePipeline().process_item(item, spider)
+        self.assertTrue(SavePagePipeline().save_page(item, spider))
         mock_parse_and_create.assert_called_once_with('abcd', 'city')
         mock_open.assert_called_once_with('path/city.html', 'wb')
         self.assertEqual(self.mock_logger.info.call_count, 2)
@@ -67,9 +224,138 @@ class SavePagePipelineTestCase(TestCase):
         item = PageItem(name='city', page=b'abcd')
         spider = AQISpider(res_dir, self.mock_logger, 0, False)
 
-        SavePagePipeline().process_item(item, spider)
+        self.assertTrue(SavePagePipeline().save_page(item, spider))
         self.assertEqual(mock_parse_and_create.call_count, 0)
         mock_open.assert_called_once_with('path/city.html', 'wb')
         self.assertEqual(self.mock_logger.info.call_count, 1)
         self.mock_logger.info.assert_any_call("Successfully backup the page of city '{}'".format('city'))
 
+    @mock.patch('aqhi.airquality.crawler.pm25in.pipelines.open')
+    @mock.patch('aqhi.airquality.utils.parse_and_create_records_from_html', autospec=True)
+    def test_not_saved(self, mock_parse_and_create, mock_open):
+        info_dict = factories.InfoDictFactory()
+        item = PageItem(name='city', page=b'abcd')
+        spider = AQISpider('path', self.mock_logger, 0)
+
+        mock_parse_and_create.return_value = (info_dict, {'success': 0, 'error_type': 'UniquenessError',
+                                                          'info': info_dict['update_dtm']})
+        self.assertTrue(SavePagePipeline().save_page(item, spider))
+        mock_parse_and_create.return_value = (info_dict, {'success': 0, 'error_type': 'CityNotFound',
+                                                          'info': 'city'})
+        self.assertFalse(SavePagePipeline().save_page(item, spider))
+        mock_parse_and_create.side_effect = ValueError
+        self.assertFalse(SavePagePipeline().save_page(item, spider))
+        self.assertEqual(mock_open.call_count, 3)
+
+    @mock.patch('aqhi.airquality.crawler.pm25in.pipelines.threads.deferToThreadPool')
+    def test_process_item_in_thread_pool(self, mock_defer):
+        pipeline = SavePagePipeline(threads=2)
+        spider = AQISpider('path', self.mock_logger, 0, False)
+        pipeline.open_spider(spider)
+        self.addCleanup(pipeline.close_spider, spider)
+        self.assertEqual(pipeline.threadpool.max, 2)
+
+        item = PageItem(name='city', page=b'abcd')
+        d = pipeline.process_item(item, spider)
+        self.assertEqual(mock_defer.call_args[0][1:],
+                         (pipeline.threadpool, pipeline._call_in_thread, pipeline.save_page, item, spider))
+        self.assertIs(d, mock_defer.return_value)
+
+
+class BatchedSavePagePipelineTestCase(TestCase):
+    def setUp(self):
+        self.mock_logger = mock.create_autospec(logging.root)
+        self.spider = AQISpider('path', self.mock_logger, 0)
+        self.pipeline = SavePagePipeline(batch_size=2)
+        # Run in this thread instead of the thread pool
+        self.pipeline._defer_to_thread = lambda func, *args: defer.maybeDeferred(func, *args)
+        self.addCleanup(self.stop_threadpool)
+        self.addCleanup(models.name_registry.clear)
+        self.page_saved = mock.patch.object(self.spider, 'page_saved').start()
+        self.addCleanup(mock.patch.stopall)
+
+        stations = [factories.StationFactory() for _ in range(3)]
+        self.cities = [station.city for station in stations]
+        self.info_dicts = {
+            station.city.name_en: factories.InfoDictFactory(city=station.city, stations=[station], station_num=1)
+            for station in stations
+        }
+
+    def stop_threadpool(self):
+        if self.pipeline.threadpool is not None and not self.pipeline.threadpool.joined:
+            self.pipeline.threadpool.stop()
+
+    def parse_records_from_html(self, html_string, city_name_en):
+        if html_string == 'invalid':
+            raise ValueError
+        return self.info_dicts[city_name_en]
+
+    def process_page(self, name, page=b'abcd'):
+        results = []
+        self.pipeline.process_item(PageItem(name=name, page=page), self.spider).addBoth(results.append)
+        return results[0]
+
+    @mock.patch('aqhi.airquality.crawler.pm25in.pipelines.open')
+    def test_flush_in_batches(self, mock_open):
+        with mock.patch('aqhi.airquality.utils.parse_records_from_html', self.parse_records_from_html):
+            self.pipeline.open_spider(self.spider)
+            self.process_page(self.cities[0].name_en)
+            self.assertEqual(models.CityRecord.objects.count(), 0)
+            self.process_page('foo', page=b'invalid')
+            self.process_page(self.cities[1].name_en)
+            self.assertEqual(models.CityRecord.objects.count(), 2)
+
+            self.process_page(self.cities[2].name_en)
+            # The last page is saved when the spider is closed
+            self.assertEqual(models.CityRecord.objects.count(), 2)
+            self.pipeline.close_spider(self.spider)
+        self.assertEqual(models.CityRecord.objects.count(), 3)
+
+        self.assertEqual(mock_open.call_count, 4)
+        self.assertEqual(self.mock_logger.error.call_count, 1)
+        self.assertEqual([call[0][0] for call in self.page_saved.call_args_list],
+                         [city.name_en for city in self.cities])
+        for city in self.cities:
+            self.mock_logger.info.assert_any_call('Successfully save a record: {} on {}'.format(
+                city.name_en, self.info_dicts[city.name_en]['update_dtm']
+            ))
+
+    @mock.patch('aqhi.airquality.crawler.pm25in.pipelines.open')
+    def test_log_duplicates(self, mock_open):
+        city = self.cities[0]
+        with mock.patch('aqhi.airquality.utils.parse_records_from_html', self.parse_records_from_html):
+            self.pipeline.open_spider(self.spider)
+            self.process_page(city.name_en)
+            self.process_page(city.name_en)
+            self.pipeline.close_spider(self.spider)
+        self.assertEqual(models.CityRecord.objects.count(), 1)
+        self.mock_logger.warn.assert_called_once_with('Ignore duplicate record: {} on {}'.format(
+            city.name_en, self.info_dicts[city.name_en]['update_dtm']
+        ))
+
+    @mock.patch('aqhi.airquality.crawler.pm25in.pipelines.open')
+    def test_save_one_by_one_when_batch_fails(self, mock_open):
+        bad_city = self.cities[1]
+        create_city_record = models.create_city_record
+
+        def create_or_fail(info_dict, *args, **kwargs):
+            if info_dict['city']['area_en'] == bad_city.name_en:
+                raise RuntimeError
+            return create_city_record(info_dict, *args, **kwargs)
+
+        with mock.patch('aqhi.airquality.utils.parse_records_from_html', self.parse_records_from_html), \
+                mock.patch.object(models, 'create_city_records', side_effect=RuntimeError), \
+                mock.patch.object(models, 'create_city_record', side_effect=create_or_fail):
+            self.pipeline.open_spider(self.spider)
+            for city in self.cities:
+                self.process_page(city.name_en)
+            self.pipeline.close_spider(self.spider)
+
+        self.assertEqual(
+            set(models.CityRecord.objects.values_list('city__name_en', flat=True)),
+            {city.name_en for city in self.cities if city != bad_city}
+        )
+        # One error for each failed batch, and one for the bad page
+        self.assertEqual(self.mock_logger.error.call_count, 3)
+        self.assertEqual([call[0][0] for call in self.page_saved.call_args_list],
+                         [city.name_en for city in self.cities if city != bad_city])
@@ -191,6 +191,49 @@ class TestExtractInfo(SimpleTestCase):
         )
 
 
+class TestExtractInfoInOnePass(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestExtractInfoInOnePass, cls).setUpClass()
+        cls.html_strings = []
+        for file_name in ['beijing.html', 'yushuzhou.html', 'guangzhou-index-error.html']:
+            with open(os.path.join(dir_path, 'files', file_name)) as f:
+                cls.html_strings.append(f.read())
+
+    def test_same_as_extract_info(self):
+        for html_string in self.html_strings:
+            with self.subTest(html=html_string[:50]):
+                self.assertEqual(
+                    extractors.extract_info_in_one_pass(html_string),
+                    extractors.extract_info(html_string)
+                )
+
+    def test_compiled_mappings_are_cached(self):
+        self.assertIs(
+            extractors.compile_xpath_mappings(extractors.rules.info_xpath_mappings),
+            extractors.compile_xpath_mappings(dict(extractors.rules.info_xpath_mappings))
+        )
+
+
+class TestExtractUpdateDtm(SimpleTestCase):
+
+    def test_same_as_parse_info_dict(self):
+        for file_name in ['beijing.html', 'yushuzhou.html']:
+            with self.subTest(file_name=file_name):
+                with open(os.path.join(dir_path, 'files', file_name), 'rb') as f:
+                    content = f.read()
+                update_dtm = extractors.parse_info_dict(
+                    extractors.extract_info_in_one_pass(content.decode())
+                )['update_dtm']
+                self.assertEqual(extractors.extract_update_dtm(content), update_dtm)
+                self.assertEqual(extractors.extract_update_dtm(content.decode()), update_dtm)
+
+    def test_not_found(self):
+        self.assertIsNone(extractors.extract_update_dtm('<html></html>'))
+        self.assertIsNone(extractors.extract_update_dtm('<div class="live_data_time"><p>foo</p></div>'))
+
+
 class TestParseInfoDict(SimpleTestCase):
 
     @classmethod
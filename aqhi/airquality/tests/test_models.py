@@ -1,18 +1,27 @@
 # -*- coding: utf-8 -*-
+import io
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 from decimal import Decimal
+from unittest import mock
 
 import pytz
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
 from aqhi.airquality.tests.utils import random_datetime
 from . import factories
+from .. import checks, filters, models
 from ..models import (
     City, Station, CityRecord, StationRecord, EstimatedCityRecord, EstimatedStationRecord,
     CityPrimaryPollutantItem, StationPrimaryPollutantItem,
     EstimatedCityPrimaryPollutantItem, EstimatedStationPrimaryPollutantItem,
-    create_city_record
+    CityRollup, StationRollup, RollupFields, AQHI_LEVELS, LatestCityRecord, LatestStationRecord,
+    create_city_record, create_city_records, normalize_pollutants, name_registry, aqhi_window_cache, refresh_rollups
 )
 
 
@@ -307,6 +316,26 @@ class TestStationRecord(TestCase):
             [latest_record],
         )
 
+    def test_scan(self):
+        base_dtm = datetime(2016, 1, 1, tzinfo=pytz.utc)
+        records = []
+        for hours in [2, 0, 1, 1, 0]:
+            records.append(factories.StationRecordFactory(
+                city_record=factories.CityRecordFactory(update_dtm=base_dtm + timedelta(hours=hours))
+            ))
+        expected = sorted(records, key=lambda r: (r.update_dtm, r.pk))
+
+        chunks = list(StationRecord.objects.scan(chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(sum(chunks, []), expected)
+
+        rows = sum(StationRecord.objects.scan('pk', chunk_size=2), [])
+        self.assertEqual([row[0] for row in rows], [r.pk for r in expected])
+        self.assertEqual(rows[0][1], expected[0].update_dtm)
+
+        after = (expected[2].update_dtm, expected[2].pk)
+        self.assertEqual(sum(StationRecord.objects.scan(chunk_size=2, after=after), []), expected[3:])
+
     def test_calc_aqhi_field(self):
         fields = ['pm10', 'pm2_5', 'so2', 'no2', 'o3']
         data = [
@@ -466,6 +495,7 @@ class TestCreateCityRecord(TestCase):
         city_record = city_record[0]
         self.assertEqual(result['info'], city_record)
         self.assertTrue(StationRecord.objects.filter(city_record=city_record, station=station1).exists())
+        self.assertEqual(StationRecord.objects.filter(city=city, update_dtm=dtm).count(), 2)
 
     def test_atomicity(self):
         dtm = random_datetime()
@@ -481,3 +511,504 @@ class TestCreateCityRecord(TestCase):
         self.assertEqual(result['success'], 0)
         self.assertEqual(result['error_type'], 'ValueError')
         self.assertFalse(CityRecord.objects.filter(city=city, update_dtm=dtm).exists())
+
+
+def build_info_dicts(city_num, station_num=3):
+    info_dicts = []
+    for i in range(city_num):
+        city = factories.CityFactory()
+        stations = [factories.StationFactory(city=city) for _ in range(station_num)]
+        info_dicts.append(factories.InfoDictFactory(city=city, stations=stations, station_num=station_num))
+    return info_dicts
+
+
+class TestCreateCityRecords(TestCase):
+
+    def test_save_records(self):
+        info_dicts = build_info_dicts(3)
+        results = create_city_records(info_dicts)
+
+        self.assertEqual([result['success'] for result in results], [1, 1, 1])
+        for info_dict, result in zip(info_dicts, results):
+            city_record = CityRecord.objects.get(city=info_dict['city']['area_en'], update_dtm=info_dict['update_dtm'])
+            self.assertEqual(result['info'], city_record)
+            self.assertEqual(city_record.aqi, info_dict['city']['aqi'])
+            self.assertEqual(
+                set(city_record.primary_pollutants.values_list('pollutant', flat=True)),
+                set(normalize_pollutants(info_dict['city']['primary_pollutant']))
+            )
+            self.assertEqual(city_record.station_records.count(), 3)
+            for station_record in city_record.station_records.all():
+                station_dict = info_dict['stations'][station_record.station.name_cn]
+                self.assertEqual(station_record.pm2_5, station_dict['pm2_5'])
+                self.assertEqual(station_record.city_id, city_record.city_id)
+                self.assertEqual(station_record.update_dtm, city_record.update_dtm)
+                self.assertEqual(
+                    set(station_record.primary_pollutants.values_list('pollutant', flat=True)),
+                    set(normalize_pollutants(station_dict['primary_pollutant']))
+                )
+
+    def test_errors(self):
+        dtm = random_datetime()
+        city = factories.CityFactory()
+        station = factories.StationFactory(city=city)
+        factories.CityRecordFactory(city=city, update_dtm=dtm)
+
+        invalid = factories.InfoDictFactory(city=city, stations=[station], station_num=1)
+        invalid['stations'][station.name_cn]['aqi'] = (None, 'foobar')
+        duplicate = factories.InfoDictFactory(city=city, stations=[station], station_num=1)
+        info_dicts = [
+            factories.InfoDictFactory(),
+            factories.InfoDictFactory(city=city, update_dtm=dtm),
+            factories.InfoDictFactory(city=city, stations=['foo'], station_num=1),
+            invalid,
+            duplicate,
+            duplicate,
+        ]
+
+        results = create_city_records(info_dicts)
+        self.assertEqual(
+            [result.get('error_type') for result in results],
+            ['CityNotFound', 'UniquenessError', 'StationNotFound', 'ValueError', None, 'UniquenessError']
+        )
+        self.assertFalse(CityRecord.objects.filter(city=city, update_dtm=invalid['update_dtm']).exists())
+        self.assertTrue(CityRecord.objects.filter(city=city, update_dtm=duplicate['update_dtm']).exists())
+
+    def test_calculate_aqhi(self):
+        station = factories.StationFactory()
+        city = station.city
+        dtm = random_datetime()
+        factories.StationRecordFactory(
+            station=station,
+            city_record=factories.CityRecordFactory(city=city, update_dtm=dtm - timedelta(hours=1))
+        )
+        info_dicts = [
+            factories.InfoDictFactory(city=city, stations=[station], station_num=1, update_dtm=dtm),
+            factories.InfoDictFactory(city=city, stations=[station], station_num=1,
+                                      update_dtm=dtm + timedelta(hours=1)),
+        ]
+
+        create_city_records(info_dicts)
+        for city_record in CityRecord.objects.filter(update_dtm__gte=dtm):
+            self.assertIsNotNone(city_record.aqhi)
+            self.assertEqual(city_record.aqhi, city_record.calculate_aqhi_field())
+            station_record = city_record.station_records.get()
+            self.assertEqual(station_record.aqhi, station_record.calculate_aqhi_field())
+
+
+class TestCreateCityRecordsQueries(TransactionTestCase):
+
+    def setUp(self):
+        name_registry.clear()
+        self.addCleanup(name_registry.clear)
+
+    def test_constant_queries(self):
+        # Commit hooks run, so their queries are counted too. The large batch is small enough for SQLite not to
+        # split the bulk inserts of rollups, which have many columns, by its limit of query parameters.
+        small_batch_dicts = build_info_dicts(1)
+        large_batch_dicts = build_info_dicts(3)
+        name_registry.load()
+        with CaptureQueriesContext(connection) as small_batch:
+            create_city_records(small_batch_dicts)
+        with CaptureQueriesContext(connection) as large_batch:
+            create_city_records(large_batch_dicts)
+        self.assertEqual(len(small_batch), len(large_batch))
+
+
+class TestNameRegistry(TransactionTestCase):
+
+    def setUp(self):
+        name_registry.clear()
+        self.addCleanup(name_registry.clear)
+
+    def test_lookup_without_queries(self):
+        station = factories.StationFactory()
+        city = station.city
+        name_registry.load()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(name_registry.city_pk(city.name_en), city.pk)
+            self.assertEqual(name_registry.city_pks_by_name_cn(city.name_cn), [city.pk])
+            self.assertEqual(name_registry.station_pk(city.pk, station.name_cn), station.pk)
+
+    def test_update_by_signals(self):
+        name_registry.load()
+        station = factories.StationFactory()
+        city = station.city
+        old_name = station.name_cn
+        with self.assertNumQueries(0):
+            self.assertEqual(name_registry.station_pks(city.pk, [old_name]), {old_name: station.pk})
+
+        station.name_cn = 'foo'
+        station.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(name_registry.station_pks(city.pk, ['foo']), {'foo': station.pk})
+        self.assertEqual(name_registry.station_pks(city.pk, [old_name]), {})
+
+        city.delete()
+        self.assertIsNone(name_registry.city_pk(city.pk))
+        self.assertIsNone(name_registry.station_pk(city.pk, 'foo'))
+
+    def test_not_updated_by_rollback(self):
+        name_registry.load()
+        try:
+            with transaction.atomic():
+                city = factories.CityFactory()
+                self.assertEqual(name_registry.city_pk(city.pk), city.pk)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertIsNone(name_registry.city_pk(city.pk))
+
+class TestAqhiWindowCache(TransactionTestCase):
+
+    def setUp(self):
+        name_registry.clear()
+        aqhi_window_cache.clear()
+        self.addCleanup(name_registry.clear)
+        self.addCleanup(aqhi_window_cache.clear)
+
+        self.station = factories.StationFactory()
+        self.city = self.station.city
+        self.dtm = random_datetime()
+        for hours in [2, 1]:
+            factories.StationRecordFactory(
+                station=self.station,
+                city_record=factories.CityRecordFactory(city=self.city, update_dtm=self.dtm - timedelta(hours=hours))
+            )
+
+    def build_info_dict(self, hours):
+        return factories.InfoDictFactory(city=self.city, stations=[self.station], station_num=1,
+                                         update_dtm=self.dtm + timedelta(hours=hours))
+
+    def assert_aqhi_calculated(self):
+        for city_record in CityRecord.objects.filter(update_dtm__gte=self.dtm):
+            self.assertEqual(city_record.aqhi, city_record.calculate_aqhi_field())
+            station_record = city_record.station_records.get()
+            self.assertEqual(station_record.aqhi, station_record.calculate_aqhi_field())
+
+    @staticmethod
+    def count_history_queries(captured):
+        # Only history queries select pollutant values of records
+        return len([query for query in captured if query['sql'].startswith('SELECT') and '"pm10"' in query['sql']])
+
+    def test_create_city_record_without_history_queries(self):
+        name_registry.load()
+        with CaptureQueriesContext(connection) as captured:
+            create_city_record(self.build_info_dict(0))
+        self.assertEqual(self.count_history_queries(captured), 2)
+
+        aqhi_window_cache.load()
+        # The cache is updated by each record, so the next hour needs no query of history either
+        with CaptureQueriesContext(connection) as captured:
+            create_city_record(self.build_info_dict(1))
+            create_city_record(self.build_info_dict(2))
+        self.assertEqual(self.count_history_queries(captured), 0)
+        self.assert_aqhi_calculated()
+
+    def test_create_city_records_without_history_queries(self):
+        name_registry.load()
+        aqhi_window_cache.load()
+        with CaptureQueriesContext(connection) as captured:
+            create_city_records([self.build_info_dict(0), self.build_info_dict(1)])
+            create_city_records([self.build_info_dict(2)])
+        self.assertEqual(self.count_history_queries(captured), 0)
+        self.assert_aqhi_calculated()
+
+    def test_not_updated_by_rollback(self):
+        aqhi_window_cache.load()
+        try:
+            with transaction.atomic():
+                create_city_record(self.build_info_dict(0))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(len(aqhi_window_cache.get_rows('city', [self.city.pk])), 2)
+
+    def test_keep_recent_hours(self):
+        aqhi_window_cache.load()
+        create_city_record(self.build_info_dict(aqhi_window_cache.hours - 2))
+        rows = aqhi_window_cache.get_rows('station', [self.station.pk])
+        self.assertEqual(sorted(row[1] for row in rows), [self.dtm - timedelta(hours=1),
+                                                          self.dtm + timedelta(hours=aqhi_window_cache.hours - 2)])
+
+
+class TestTimeSeriesStore(TransactionTestCase):
+
+    def setUp(self):
+        self.station = factories.StationFactory()
+        self.city = self.station.city
+        self.dtm = random_datetime().replace(minute=0, second=0, microsecond=0)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def build_info_dict(self, hours):
+        return factories.InfoDictFactory(city=self.city, stations=[self.station], station_num=1,
+                                         update_dtm=self.dtm + timedelta(hours=hours))
+
+    def test_create_city_records_without_history_queries(self):
+        create_city_records([self.build_info_dict(0), self.build_info_dict(1)])
+        with self.settings(AIRQUALITY_TIMESERIES_DIR=self.root):
+            call_command('build_timeseries', stdout=io.StringIO())
+            store = models.get_timeseries_store()
+            self.assertEqual(store.get('city', self.city.pk, 'pm10', self.dtm),
+                             float(CityRecord.objects.get(update_dtm=self.dtm).pm10))
+
+            # History of these records is all in the store
+            with CaptureQueriesContext(connection) as captured:
+                create_city_record(self.build_info_dict(2))
+                create_city_records([self.build_info_dict(3)])
+            self.assertEqual(TestAqhiWindowCache.count_history_queries(captured), 0)
+
+        for city_record in CityRecord.objects.all():
+            self.assertEqual(city_record.aqhi, city_record.calculate_aqhi_field())
+            self.assertEqual(store.get('city', self.city.pk, 'aqhi', city_record.update_dtm), float(city_record.aqhi))
+            station_record = city_record.station_records.get()
+            self.assertEqual(station_record.aqhi, station_record.calculate_aqhi_field())
+            self.assertEqual(store.get('station', self.station.pk, 'no2', station_record.update_dtm),
+                             float(station_record.no2))
+
+    def test_query_history_not_in_store(self):
+        create_city_records([self.build_info_dict(0), self.build_info_dict(1)])
+        with self.settings(AIRQUALITY_TIMESERIES_DIR=self.root):
+            # Records before the store is enabled are queried from database
+            with CaptureQueriesContext(connection) as captured:
+                create_city_records([self.build_info_dict(2)])
+            self.assertEqual(TestAqhiWindowCache.count_history_queries(captured), 2)
+            self.assertTrue(models.get_timeseries_store().covers('city', self.city.pk, self.dtm + timedelta(hours=2)))
+
+        for city_record in CityRecord.objects.all():
+            self.assertEqual(city_record.aqhi, city_record.calculate_aqhi_field())
+            station_record = city_record.station_records.get()
+            self.assertEqual(station_record.aqhi, station_record.calculate_aqhi_field())
+
+
+    def test_follow_updates_and_deletes(self):
+        create_city_records([self.build_info_dict(i) for i in range(3)], calculate_aqhi=False)
+        with self.settings(AIRQUALITY_TIMESERIES_DIR=self.root):
+            call_command('build_timeseries', stdout=io.StringIO())
+            call_command('update_aqhi', stdout=io.StringIO())
+            CityRecord.objects.get(update_dtm=self.dtm + timedelta(hours=1)).delete()
+            store = models.get_timeseries_store()
+
+        self.assertIsNotNone(store.get('city', self.city.pk, 'aqhi', self.dtm))
+        for i in range(3):
+            dtm = self.dtm + timedelta(hours=i)
+            city_record = CityRecord.objects.filter(update_dtm=dtm).first()
+            self.assertEqual(store.get('city', self.city.pk, 'aqhi', dtm),
+                             float(city_record.aqhi) if city_record else None)
+            self.assertTrue(store.covers('city', self.city.pk, dtm))
+        self.assertEqual(len(store.get_records('station', self.station.pk, self.dtm, self.dtm + timedelta(hours=3))), 2)
+
+
+class TestRollups(TestCase):
+
+    def setUp(self):
+        self.station = factories.StationFactory()
+        self.city = self.station.city
+        # 2016-05-31 20:00 to 2016-06-01 03:00 in local time, across days and months
+        self.dtms = [datetime(2016, 5, 31, 12, tzinfo=pytz.utc) + timedelta(hours=i) for i in range(8)]
+
+    def build_info_dict(self, dtm):
+        return factories.InfoDictFactory(city=self.city, stations=[self.station], station_num=1, update_dtm=dtm)
+
+    def assert_rollups_match_records(self):
+        for period in ['day', 'month']:
+            rollups = CityRollup.objects.filter(city=self.city, period=period)
+            self.assertEqual(rollups.count(), 2)
+            for rollup in rollups:
+                records = [r for r in CityRecord.objects.filter(city=self.city)
+                           if RollupFields.get_start_dtm(r.update_dtm, period) == rollup.start_dtm]
+                self.assertEqual(rollup.count, len(records))
+                for field in ['pm10', 'so2']:
+                    values = [getattr(r, field) for r in records if getattr(r, field) is not None]
+                    self.assertEqual(rollup.mean(field), round(sum(values) / len(values), 4))
+                    self.assertEqual(getattr(rollup, '{}_min'.format(field)), min(values))
+                    self.assertEqual(getattr(rollup, '{}_max'.format(field)), max(values))
+                self.assertEqual(
+                    sum(getattr(rollup, 'aqhi_{}'.format(level)) for level in AQHI_LEVELS),
+                    len([r for r in records if r.aqhi is not None])
+                )
+
+            station_rollups = StationRollup.objects.filter(station=self.station, period=period)
+            self.assertEqual(sorted(r.count for r in station_rollups), sorted(r.count for r in rollups))
+
+    def test_get_start_dtm(self):
+        dtm = datetime(2016, 5, 31, 16, 30, tzinfo=pytz.utc)
+        self.assertEqual(RollupFields.get_start_dtm(dtm, 'day'), datetime(2016, 5, 31, 16, tzinfo=pytz.utc))
+        self.assertEqual(RollupFields.get_start_dtm(dtm, 'month'), datetime(2016, 5, 31, 16, tzinfo=pytz.utc))
+        dtm = datetime(2016, 5, 31, 15, 30, tzinfo=pytz.utc)
+        self.assertEqual(RollupFields.get_start_dtm(dtm, 'day'), datetime(2016, 5, 30, 16, tzinfo=pytz.utc))
+        self.assertEqual(RollupFields.get_start_dtm(dtm, 'month'), datetime(2016, 4, 30, 16, tzinfo=pytz.utc))
+
+    def test_maintained_incrementally(self):
+        create_city_records([self.build_info_dict(dtm) for dtm in self.dtms[:5]])
+        for dtm in self.dtms[5:]:
+            create_city_record(self.build_info_dict(dtm))
+        self.assert_rollups_match_records()
+
+    def test_get_end_dtm(self):
+        start_dtm = datetime(2016, 5, 31, 16, tzinfo=pytz.utc)
+        self.assertEqual(RollupFields.get_end_dtm(start_dtm, 'day'), datetime(2016, 6, 1, 16, tzinfo=pytz.utc))
+        self.assertEqual(RollupFields.get_end_dtm(start_dtm, 'month'), datetime(2016, 6, 30, 16, tzinfo=pytz.utc))
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    def test_refreshed_on_delete(self, mock_on_commit):
+        create_city_records([self.build_info_dict(dtm) for dtm in self.dtms])
+        CityRecord.objects.filter(update_dtm=self.dtms[-1]).delete()
+        CityRecord.objects.filter(update_dtm__in=self.dtms[:2]).delete()
+        self.assert_rollups_match_records()
+
+        CityRecord.objects.filter(update_dtm__lt=self.dtms[4]).delete()
+        for model in [CityRollup, StationRollup]:
+            self.assertFalse(model.objects.filter(period='day', start_dtm=RollupFields.get_start_dtm(self.dtms[0], 'day'))
+                             .exists())
+            self.assertEqual(model.objects.get(period='day').count, 3)
+
+    def test_refresh_in_constant_queries(self):
+        create_city_records([self.build_info_dict(dtm) for dtm in self.dtms])
+        query_counts = []
+        for dtms in [self.dtms[:1], self.dtms]:
+            keys = [(self.city.pk, dtm) for dtm in dtms]
+            with CaptureQueriesContext(connection) as captured:
+                refresh_rollups(keys, [(self.station.pk, dtm) for dtm in dtms])
+            query_counts.append(len(captured))
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assert_rollups_match_records()
+
+    def test_rebuild(self):
+        create_city_records([self.build_info_dict(dtm) for dtm in self.dtms])
+        CityRollup.objects.update(count=0)
+        call_command('rebuild_rollups', batch_size=3, stdout=io.StringIO())
+        self.assert_rollups_match_records()
+
+
+class TestLatestRecords(TestCase):
+
+    def setUp(self):
+        self.station = factories.StationFactory()
+        self.city = self.station.city
+        self.dtms = [datetime(2016, 6, 1, tzinfo=pytz.utc) + timedelta(hours=i) for i in range(4)]
+
+    def build_info_dict(self, dtm):
+        return factories.InfoDictFactory(city=self.city, stations=[self.station], station_num=1, update_dtm=dtm)
+
+    def assert_latest(self, dtm):
+        city_record = CityRecord.objects.get(city=self.city, update_dtm=dtm)
+        self.assertEqual(list(CityRecord.objects.current()), [city_record])
+        self.assertEqual(LatestCityRecord.objects.get(city=self.city).update_dtm, dtm)
+        self.assertEqual(list(StationRecord.objects.current()), list(city_record.station_records.all()))
+        self.assertEqual(LatestStationRecord.objects.get(station=self.station).city, self.city)
+
+    def test_maintained_at_ingest(self):
+        create_city_records([self.build_info_dict(dtm) for dtm in self.dtms[1:3]])
+        self.assert_latest(self.dtms[2])
+
+        # Older records do not replace newer ones
+        create_city_record(self.build_info_dict(self.dtms[0]))
+        self.assert_latest(self.dtms[2])
+
+        create_city_record(self.build_info_dict(self.dtms[3]))
+        self.assert_latest(self.dtms[3])
+
+    def test_maintained_on_save(self):
+        records = [factories.CityRecordFactory(city=self.city, update_dtm=dtm) for dtm in self.dtms[:2]]
+        self.assertEqual(list(CityRecord.objects.current()), [records[1]])
+
+        # A changed record moved back in time is replaced by the newest one
+        records[1].update_dtm = self.dtms[0] - timedelta(hours=1)
+        records[1].save()
+        self.assertEqual(list(CityRecord.objects.current()), [records[0]])
+
+    @mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func())
+    def test_refreshed_on_delete(self, mock_on_commit):
+        create_city_records([self.build_info_dict(dtm) for dtm in self.dtms[:3]])
+        CityRecord.objects.get(update_dtm=self.dtms[2]).delete()
+        self.assert_latest(self.dtms[1])
+
+        CityRecord.objects.filter(update_dtm=self.dtms[0]).delete()
+        self.assert_latest(self.dtms[1])
+
+        CityRecord.objects.all().delete()
+        self.assertFalse(LatestCityRecord.objects.exists())
+        self.assertFalse(LatestStationRecord.objects.exists())
+
+    def test_latest_record_in(self):
+        create_city_record(self.build_info_dict(self.dtms[1]))
+        self.assertEqual(CityRecord.objects.latest_record_in(self.city.name_en).update_dtm, self.dtms[1])
+
+        # Cities without a latest record fall back to a latest() query
+        record = factories.CityRecordFactory(city=self.city, update_dtm=self.dtms[2])
+        LatestCityRecord.objects.all().delete()
+        self.assertEqual(CityRecord.objects.latest_record_in(self.city.name_en), record)
+
+
+class TestQueryPlans(TestCase):
+    """
+    Query plans of API requests made by home.js must use indexes instead of scanning whole tables.
+    Tables are tiny in tests, so sequential scans are disabled on PostgreSQL to see which indexes can be used.
+    """
+    def explain(self, queryset):
+        """Return whether the query scans a whole table and whether it sorts rows, from EXPLAIN of the queryset."""
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = [row[-1] for row in cursor.fetchall()]
+                full_scan = any(line.startswith('SCAN') and 'USING' not in line for line in plan)
+                sorted_rows = any('TEMP B-TREE' in line for line in plan)
+            elif connection.vendor == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql, params)
+                plan = [row[0] for row in cursor.fetchall()]
+                full_scan = any('Seq Scan' in line for line in plan)
+                sorted_rows = any(line.strip(' ->').startswith('Sort') for line in plan)
+            else:
+                self.skipTest('EXPLAIN is not checked on {}.'.format(connection.vendor))
+        return full_scan, sorted_rows, plan
+
+    def assert_index_scan(self, queryset, sorted_rows=False):
+        full_scan, is_sorted, plan = self.explain(queryset)
+        self.assertFalse(full_scan, plan)
+        if not sorted_rows:
+            self.assertFalse(is_sorted, plan)
+
+    def test_rank_by_aqhi(self):
+        queryset = filters.CityRecordFilter(
+            {'update_dtm': random_datetime().isoformat(), 'ordering': '-aqhi'},
+            queryset=CityRecord.objects.all()
+        ).qs[:50]
+        self.assert_index_scan(queryset)
+
+    def test_latest_record_of_city(self):
+        self.assert_index_scan(CityRecord.objects.filter(city='beijing').order_by('-update_dtm')[:1])
+
+    def test_city_records_in_range(self):
+        dtm = random_datetime()
+        queryset = filters.CityRecordFilter(
+            {'city': 'beijing', 'start_dtm': (dtm - timedelta(days=1)).isoformat(), 'end_dtm': dtm.isoformat(),
+             'ordering': '-update_dtm'},
+            queryset=CityRecord.objects.all()
+        ).qs[:30]
+        self.assert_index_scan(queryset)
+
+    def test_station_records(self):
+        dtm = random_datetime()
+        self.assert_index_scan(filters.StationRecordFilter(
+            {'city_record': factories.CityRecordFactory().pk}, queryset=StationRecord.objects.all()
+        ).qs, sorted_rows=True)
+        for params in [{'city': 'beijing'}, {'station': 1}]:
+            with self.subTest(params=params):
+                queryset = StationRecord.objects.filter(update_dtm__gte=dtm - timedelta(days=1), **params)
+                self.assert_index_scan(queryset.order_by('-update_dtm'))
+
+
+class TestCompactPollutantsCheck(TestCase):
+
+    def test_check(self):
+        # The test database is migrated with the setting off
+        self.assertIs(checks.get_compact_pollutants_in_db(), False)
+        self.assertEqual(checks.check_compact_pollutants(None), [])
+        with self.settings(AIRQUALITY_COMPACT_POLLUTANTS=True):
+            errors = checks.check_compact_pollutants(None)
+        self.assertEqual([error.id for error in errors], ['airquality.E001'])
@@ -0,0 +1,98 @@
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from .utils import random_datetime
+from ..timeseries import TimeSeriesStore
+from ..utils import reduce_to_average_in_hours
+
+
+class TestTimeSeriesStore(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.store = TimeSeriesStore(self.root, ['pm10', 'so2'], growth=4)
+        self.dtm = random_datetime().replace(minute=0, second=0, microsecond=0)
+
+    def test_add_and_get(self):
+        self.store.add('city', 'beijing', self.dtm, {'pm10': Decimal('1.5'), 'so2': None})
+        # Beyond the end of the file and before its start
+        self.store.add('city', 'beijing', self.dtm + timedelta(hours=10), {'pm10': 2, 'so2': 3})
+        self.store.add('city', 'beijing', self.dtm - timedelta(hours=3), {'pm10': 4, 'so2': 5})
+        self.store.flush()
+
+        # Files are read back by another store
+        store = TimeSeriesStore(self.root, ['pm10', 'so2'])
+        self.assertEqual(store.get('city', 'beijing', 'pm10', self.dtm), 1.5)
+        self.assertIsNone(store.get('city', 'beijing', 'so2', self.dtm))
+        self.assertEqual(store.get('city', 'beijing', 'so2', self.dtm + timedelta(hours=10)), 3)
+        self.assertEqual(store.get('city', 'beijing', 'pm10', self.dtm - timedelta(hours=3)), 4)
+        self.assertIsNone(store.get('city', 'beijing', 'pm10', self.dtm + timedelta(hours=1)))
+        self.assertIsNone(store.get('city', 'shanghai', 'pm10', self.dtm))
+
+        array = store.get_array('city', 'beijing', 'pm10', self.dtm - timedelta(hours=5), self.dtm + timedelta(hours=1))
+        np.testing.assert_array_equal(array, [np.nan, np.nan, 4, np.nan, np.nan, 1.5])
+
+    def test_shared_by_processes(self):
+        # Another store of the same directory, like one of another process
+        other = TimeSeriesStore(self.root, ['pm10', 'so2'], growth=4)
+        self.store.add('city', 'beijing', self.dtm, {'pm10': 1})
+        self.assertEqual(other.get('city', 'beijing', 'pm10', self.dtm), 1)
+
+        # Hours beyond the file mapped by the other store
+        self.store.add('city', 'beijing', self.dtm + timedelta(hours=10), {'pm10': 2})
+        self.assertEqual(other.get('city', 'beijing', 'pm10', self.dtm + timedelta(hours=10)), 2)
+
+        # The file replaced to add an older hour is mapped again before the other store writes to it
+        self.store.add('city', 'beijing', self.dtm - timedelta(hours=3), {'pm10': 3})
+        other.add('city', 'beijing', self.dtm + timedelta(hours=1), {'pm10': 4})
+        self.assertEqual(self.store.get('city', 'beijing', 'pm10', self.dtm + timedelta(hours=1)), 4)
+        self.assertEqual(other.get('city', 'beijing', 'pm10', self.dtm - timedelta(hours=3)), 3)
+
+        self.assertTrue(other.covers('city', 'beijing', self.dtm - timedelta(hours=3)))
+        self.assertFalse(other.covers('city', 'beijing', self.dtm - timedelta(hours=4)))
+        self.assertFalse(other.covers('city', 'shanghai', self.dtm))
+
+    def test_cover_hours_written(self):
+        self.store.add('city', 'beijing', self.dtm, {'pm10': 1})
+        self.store.add('city', 'beijing', self.dtm + timedelta(hours=2), {'pm10': 2})
+        self.assertTrue(self.store.covers('city', 'beijing', self.dtm + timedelta(hours=1)))
+        # The file grows ahead of the hours written, which are still unknown
+        self.assertFalse(self.store.covers('city', 'beijing', self.dtm + timedelta(hours=3)))
+
+    def test_update_and_remove(self):
+        self.store.add('city', 'beijing', self.dtm, {'pm10': 1, 'so2': 2})
+        self.store.add('city', 'beijing', self.dtm + timedelta(hours=1), {'pm10': 3})
+        self.store.update_values('city', 'so2', [('beijing', self.dtm, 4), ('beijing', self.dtm - timedelta(hours=1), 5)])
+        self.store.remove_records('city', [('beijing', self.dtm + timedelta(hours=1))])
+
+        self.assertEqual(self.store.get('city', 'beijing', 'so2', self.dtm), 4)
+        # Hours without a record are not updated
+        self.assertIsNone(self.store.get('city', 'beijing', 'so2', self.dtm - timedelta(hours=1)))
+        self.assertIsNone(self.store.get('city', 'beijing', 'pm10', self.dtm + timedelta(hours=1)))
+        self.assertEqual(self.store.get_rows('city', ['beijing'], [self.dtm + timedelta(hours=i) for i in range(2)],
+                                             ['pm10']), [('beijing', self.dtm, 1)])
+        self.assertTrue(self.store.covers('city', 'beijing', self.dtm + timedelta(hours=1)))
+
+    def test_get_rows(self):
+        self.store.add('station', 1, self.dtm, {'pm10': 1, 'so2': 2})
+        self.store.add('station', 1, self.dtm + timedelta(hours=1), {'pm10': None, 'so2': None})
+        self.store.add('station', 2, self.dtm, {'pm10': 3, 'so2': 4})
+        rows = self.store.get_rows('station', [1, 2], [self.dtm + timedelta(hours=i) for i in range(-1, 3)], ['so2'])
+        self.assertEqual(sorted(rows), [(1, self.dtm, 2), (1, self.dtm + timedelta(hours=1), None),
+                                        (2, self.dtm, 4)])
+
+    def test_reduce_records(self):
+        for i in range(6):
+            self.store.add('city', 'beijing', self.dtm + timedelta(hours=i), {'pm10': i, 'so2': None})
+        records = self.store.get_records('city', 'beijing', self.dtm, self.dtm + timedelta(hours=24))
+        self.assertEqual([record.update_dtm for record in records], [self.dtm + timedelta(hours=i) for i in range(6)])
+
+        reduced = reduce_to_average_in_hours(records, 3, fields=['pm10', 'so2'])
+        self.assertEqual([r['pm10'] for r in reduced], [4, 1])
+        self.assertEqual([r['so2'] for r in reduced], [None, None])
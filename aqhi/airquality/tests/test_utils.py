@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from decimal import Decimal
+import math
 import random
 from statistics import mean
 
@@ -7,7 +8,8 @@ from django.test import TestCase, SimpleTestCase
 
 from . import factories
 from ..utils import (
-    calculate_aqhi, reduce_to_average_in_hours, reduce_to_one_record_dict
+    calculate_aqhi, reduce_to_average_in_hours, reduce_to_one_record_dict,
+    calculate_aqhi_array, calculate_aqhi_by_entity, aqhi_pollutants
 )
 from .. import models
 from . import utils as test_utils
@@ -56,6 +58,43 @@ class TestCalcAqhi(TestCase):
             self.assertEqual(self.get_aqhi_from_data_lists(row[:-1]), row[-1])
 
 
+class TestCalcAqhiArray(SimpleTestCase):
+
+    def test_same_as_calculate_aqhi(self):
+        rows = [[random.uniform(0, 600) for _ in range(5)] for _ in range(200)]
+        expected = [calculate_aqhi(*row) for row in rows]
+        self.assertEqual(list(calculate_aqhi_array(*zip(*rows))), expected)
+
+    def test_missing_values(self):
+        aqhi = calculate_aqhi_array([10, None], [10, 10], [10, 10], [10, 10], [10, float('nan')])
+        self.assertEqual(aqhi[0], calculate_aqhi(10, 10, 10, 10, 10))
+        self.assertTrue(all(map(math.isnan, aqhi[1:])))
+
+
+class TestCalcAqhiByEntity(TestCase):
+
+    def test_same_as_calculate_aqhi_field(self):
+        cities = [factories.CityFactory() for _ in range(3)]
+        for city in cities:
+            # Leave gaps between hours so that some windows are incomplete
+            for hour in [0, 1, 2, 3, 5, 7, 8, 20]:
+                fields = {field: Decimal(random.randint(0, 300)) for field in aqhi_pollutants}
+                if random.random() < 0.2:
+                    fields[random.choice(aqhi_pollutants)] = None
+                factories.CityRecordFactory(city=city, update_dtm=test_utils.random_datetime(hour), **fields)
+
+        aqhi = calculate_aqhi_by_entity(
+            models.CityRecord.objects.values_list('city', 'update_dtm', *aqhi_pollutants)
+        )
+
+        self.assertEqual(len(aqhi), 3 * 8)
+        for record in models.CityRecord.objects.all():
+            self.assertEqual(aqhi[(record.city_id, record.update_dtm)], record.calculate_aqhi_field())
+
+    def test_empty(self):
+        self.assertEqual(calculate_aqhi_by_entity([]), {})
+
+
 class ReduceToAverageTestCase(TestCase):
 
     def setUp(self):
@@ -1,14 +1,29 @@
 # -*- coding: utf-8 -*-
+import io
 import json
 import collections
-
+import urllib.parse
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+import numpy
+from django.core.cache import cache
+from django.db import connection
 from django.test import SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
-from rest_framework.test import APITestCase, APIRequestFactory
+from django.utils import dateparse
+from rest_framework.test import APITestCase, APITransactionTestCase, APIRequestFactory
 from rest_framework import status
+from rest_framework import serializers as drf_serializers
 
 from . import factories
-from .. import serializers, views
+from .utils import random_datetime
+from .. import models, querysets, serializers, views, caching
+from ..models import create_city_records
+from ..utils import reduce_to_one_record_dict
 
 
 def get_formatted_json(data):
@@ -70,6 +85,9 @@ class APITestUtilsMixin(object):
 
 class CityRecordAPITest(APITestUtilsMixin, APITestCase):
 
+    def setUp(self):
+        cache.clear()
+
     def get_city_record_list(self, params=None):
         if params is None:
             params = {}
@@ -124,6 +142,80 @@ class CityRecordAPITest(APITestUtilsMixin, APITestCase):
         response = self.get_city_record_detail(city_record)
         self.assertIn('primary_pollutants', response.data)
 
+    def test_sparse_fields_in_query(self):
+        dtm = random_datetime()
+        for _ in range(3):
+            factories.CityRecordFactory(update_dtm=dtm)
+        params = {'update_dtm': urllib.parse.quote(dtm.isoformat()), 'ordering': '-aqhi'}
+        with CaptureQueriesContext(connection) as full_queries:
+            full = self.get_city_record_list(params=dict(params)).data['results']
+        self.assertEqual(len(full), 3)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_city_record_list(params=dict(params, fields='aqhi,city__name_cn'))
+        # Primary pollutants are not prefetched, and deferred fields are not queried
+        self.assertEqual(len(queries), len(full_queries) - 1)
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('pm10', sql)
+        self.assertNotIn('longitude', sql)
+        self.assertNotIn('primary', sql)
+        self.assertEqual(
+            response.data['results'],
+            [{'url': r['url'], 'id': r['id'], 'aqhi': r['aqhi'], 'city': {'url': r['city']['url'],
+                                                                           'name_cn': r['city']['name_cn']}}
+             for r in full]
+        )
+
+    def test_sparse_fields_of_station_records(self):
+        station_record = factories.StationRecordFactory()
+        response = self.client.get(reverse('api:station-record-list'), {'fields': 'update_dtm,pm10,station__name_cn'})
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertTrue(has_fields(response.data['results'][0],
+                                   {'url', 'id', 'update_dtm', 'pm10', ('station', 'url', 'id', 'name_cn')}))
+        self.assertEqual(dateparse.parse_datetime(response.data['results'][0]['update_dtm']),
+                         station_record.update_dtm)
+
+
+class StationRecordAPITest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def get_station_record_list(self, params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:station-record-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_constant_queries(self):
+        city_record = factories.CityRecordFactory()
+        factories.StationRecordFactory.create_batch(2, city_record=city_record)
+        response, query_count = self.get_station_record_list({'city_record': city_record.pk})
+        self.assertEqual(len(response.data['results']), 2)
+
+        factories.StationRecordFactory.create_batch(8, city_record=city_record)
+        response, more_query_count = self.get_station_record_list({'city_record': city_record.pk})
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(more_query_count, query_count)
+
+        response, sparse_query_count = self.get_station_record_list({'city_record': city_record.pk,
+                                                                     'fields': 'update_dtm,pm10,station__name_cn'})
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(sparse_query_count, query_count)
+
+    def test_filter_without_joining_city_records(self):
+        city_record = factories.CityRecordFactory()
+        station_record = factories.StationRecordFactory(city_record=city_record)
+        factories.StationRecordFactory()
+
+        response, _ = self.get_station_record_list({
+            'city': city_record.city_id, 'start_dtm': city_record.update_dtm.isoformat(), 'ordering': '-update_dtm'
+        })
+        self.assertEqual([r['id'] for r in response.data['results']], [station_record.pk])
+        with CaptureQueriesContext(connection) as queries:
+            self.get_station_record_list({'city': city_record.city_id, 'ordering': '-update_dtm'})
+        count_sql = [query['sql'] for query in queries.captured_queries if 'COUNT' in query['sql']][0]
+        self.assertNotIn('JOIN', count_sql)
+
 
 class FilterFieldsSerializerMixinTest(SimpleTestCase):
 
@@ -159,22 +251,50 @@ class FilterFieldsSerializerMixinTest(SimpleTestCase):
             {'a': None, 'b': None}
         )
 
-    def test_filter_instance(self):
+    def test_restrict_fields(self):
+        class NestedSerializer(serializers.SparseFieldsetMixin, drf_serializers.Serializer):
+            url = drf_serializers.CharField()
+            id = drf_serializers.IntegerField()
+            a = drf_serializers.CharField()
+            b = drf_serializers.CharField()
+            c = drf_serializers.CharField()
+
+        class InstanceSerializer(NestedSerializer):
+            b = NestedSerializer()
+
         instance = {'url': 'url_a',
                     'id': 12,
                     'a': 'a',
                     'b': {'url': 'foo', 'id': 10, 'a': 'ba', 'b': 'bb', 'c': 'bc'},
                     'c': 'c'}
         filter_dict = {'a': None, 'b': {'a': None, 'b': None}, 'c': None}
-        res = {}
-        views.FilterFieldsMixin._filter_instance(instance, filter_dict, res)
+        res = InstanceSerializer(instance, sparse_fields=filter_dict).data
         self.assertEqual(res, {'url': 'url_a', 'id': 12, 'a': 'a', 'c': 'c', 'b': {'url': 'foo', 'id': 10, 'a': 'ba', 'b': 'bb'}})
 
         filter_dict = {'a': None, 'b': None}
-        res = {}
-        views.FilterFieldsMixin._filter_instance(instance, filter_dict, res)
+        res = InstanceSerializer(instance, sparse_fields=filter_dict).data
         self.assertEqual(res, {'url': 'url_a', 'id': 12, 'a': 'a', 'b': {'url': 'foo', 'id': 10, 'a': 'ba', 'b': 'bb', 'c': 'bc'}})
 
+    def test_get_queryset_fields(self):
+        sparse_fields = views.FilterFieldsMixin._generate_structure(['aqhi', 'city__name_cn'])
+        serializer = serializers.CityRecordSerializer(sparse_fields=sparse_fields)
+        only, select_related, prefetch_related = serializer.get_queryset_fields()
+        self.assertEqual(set(only), {'id', 'update_dtm', 'aqhi', 'city', 'city__name_cn'})
+        self.assertEqual(set(select_related), {'city'})
+        self.assertEqual(prefetch_related, [])
+
+        sparse_fields = views.FilterFieldsMixin._generate_structure(['city', 'primary_pollutants'])
+        serializer = serializers.CityRecordSerializer(sparse_fields=sparse_fields)
+        only, select_related, prefetch_related = serializer.get_queryset_fields()
+        self.assertEqual(set(select_related), {'city'})
+        self.assertEqual(prefetch_related, ['primary_pollutants'])
+
+        sparse_fields = views.FilterFieldsMixin._generate_structure(['update_dtm'])
+        serializer = serializers.StationRecordSerializer(sparse_fields=sparse_fields)
+        only, select_related, prefetch_related = serializer.get_queryset_fields()
+        self.assertEqual(set(only), {'id', 'station__name_cn', 'station__city', 'update_dtm'})
+        self.assertEqual(set(select_related), {'station', 'station__city'})
+
 
 class LatestCityRecordTestCase(APITestCase):
 
@@ -218,3 +338,282 @@ class LatestCityRecordTestCase(APITestCase):
         record2 = factories.CityRecordFactory(city=city)
 
         self.assertLess(record1.update_dtm, record2.update_dtm)
+
+
+class LatestCityRecordListTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def create_records(self, city_num, dtm):
+        info_dicts = []
+        for _ in range(city_num):
+            city = factories.CityFactory()
+            info_dicts.append(factories.InfoDictFactory(city=city, stations=[factories.StationFactory(city=city)],
+                                                        station_num=1, update_dtm=dtm))
+        create_city_records(info_dicts)
+        return [info_dict['city']['area_en'] for info_dict in info_dicts]
+
+    def get_latest_city_records(self, params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:latest-city-records'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_latest_records(self):
+        dtm = random_datetime()
+        cities = self.create_records(2, dtm - timedelta(hours=1))
+        self.create_records(1, dtm)
+        create_city_records([factories.InfoDictFactory(city=models.City.objects.get(name_en=cities[0]),
+                                                       station_num=0, update_dtm=dtm)])
+
+        response, _ = self.get_latest_city_records({'city': ','.join(cities)})
+        self.assertEqual(
+            [(r['city']['name_en'], dateparse.parse_datetime(r['update_dtm'])) for r in response.data['results']],
+            sorted([(cities[0], dtm), (cities[1], dtm - timedelta(hours=1))])
+        )
+
+        response, _ = self.get_latest_city_records({})
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_constant_queries(self):
+        cities = self.create_records(2, random_datetime())
+        _, query_count = self.get_latest_city_records({'city': ','.join(cities)})
+        cities += self.create_records(8, random_datetime())
+        response, more_query_count = self.get_latest_city_records({'city': ','.join(cities)})
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(more_query_count, query_count)
+
+
+class AverageCityRecordTestCase(APITestCase):
+
+    def setUp(self):
+        self.city = factories.CityFactory()
+        self.start_dtm = random_datetime(0)
+        self.records = [
+            factories.CityRecordFactory(city=self.city, update_dtm=self.start_dtm + timedelta(hours=i))
+            for i in range(48)
+        ]
+        # Records of other cities are not averaged
+        factories.CityRecordFactory(update_dtm=self.start_dtm)
+
+    def get_average_city_record(self, params):
+        return self.client.get(patch_params_to_url(reverse('api:avg-city-record'), params))
+
+    def test_average(self):
+        resp = self.get_average_city_record({'city': self.city.name_en, 'hours': 24, 'avg_field': 'pm10,aqi'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.data), 2)
+        for i, data in enumerate(resp.data):
+            expected = reduce_to_one_record_dict(self.records[i * 24:(i + 1) * 24], ['pm10', 'aqi'])
+            self.assertEqual(set(data), {'datetime', 'pm10', 'aqi'})
+            self.assertEqual(Decimal(data['pm10']), expected['pm10'])
+            self.assertEqual(Decimal(data['aqi']), expected['aqi'])
+            self.assertEqual(dateparse.parse_datetime(data['datetime']), self.start_dtm + timedelta(hours=24 * i))
+
+    def test_range(self):
+        start_dtm = self.start_dtm + timedelta(hours=10)
+        end_dtm = self.start_dtm + timedelta(hours=29)
+        # One aggregation query, in a savepoint of ATOMIC_REQUESTS
+        with self.assertNumQueries(3):
+            resp = self.get_average_city_record({
+                'city_cn': urllib.parse.quote(self.city.name_cn), 'hours': 8, 'avg_field': 'so2',
+                'start_dtm': start_dtm.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'end_dtm': end_dtm.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            })
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [Decimal(data['so2']) for data in resp.data],
+            [reduce_to_one_record_dict(self.records[i:min(i + 8, 30)], ['so2'])['so2'] for i in [10, 18, 26]]
+        )
+
+    def test_average_without_hour_bucket(self):
+        params = {'city': self.city.name_en, 'hours': 10, 'avg_field': 'pm10,aqi'}
+        expected = self.get_average_city_record(dict(params)).data
+        with mock.patch.object(querysets.HourBucket, 'supports', return_value=False):
+            resp = self.get_average_city_record(dict(params))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # Including the partial last bucket
+        self.assertEqual(len(resp.data), 5)
+        self.assertEqual(resp.data, expected)
+
+    def test_invalid_params(self):
+        for params in [
+            {},
+            {'city': self.city.name_en, 'hours': 'foo'},
+            {'city': self.city.name_en, 'hours': 0},
+            {'city': self.city.name_en, 'avg_field': 'foo'},
+            {'city': self.city.name_en, 'start_dtm': 'foo'},
+        ]:
+            with self.subTest(params=params):
+                resp = self.get_average_city_record(params)
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_without_records(self):
+        resp = self.get_average_city_record({'city': 'foo'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data, [])
+
+
+class RecordArchiveTestCase(APITestCase):
+
+    def setUp(self):
+        self.city = factories.CityFactory()
+        self.start_dtm = random_datetime(0)
+        self.records = [
+            factories.StationRecordFactory(
+                city_record=factories.CityRecordFactory(city=self.city, update_dtm=self.start_dtm + timedelta(hours=i))
+            )
+            for i in range(5)
+        ]
+        factories.StationRecordFactory()
+
+    def get_archive(self, url_name, params):
+        resp = self.client.get(patch_params_to_url(reverse(url_name), params))
+        if resp.status_code != status.HTTP_200_OK:
+            return resp, None
+        self.assertTrue(resp['Content-Disposition'].endswith('.npz"'))
+        return resp, numpy.load(io.BytesIO(b''.join(resp.streaming_content)))
+
+    def test_city_record_archive(self):
+        resp, arrays = self.get_archive('api:city-record-archive', {
+            'city': self.city.name_en,
+            'start_dtm': urllib.parse.quote((self.start_dtm + timedelta(hours=1)).isoformat()),
+        })
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(arrays.files), {'update_dtm', 'city'} | set(models.DECIMAL_FIELDS))
+        city_records = [record.city_record for record in self.records[1:]]
+        self.assertEqual(list(arrays['city']), [self.city.name_en] * 4)
+        self.assertEqual(list(arrays['update_dtm'].astype('int64')),
+                         [int(record.update_dtm.timestamp()) for record in city_records])
+        for field in models.DECIMAL_FIELDS:
+            self.assertEqual(list(arrays[field]), [float(getattr(record, field)) for record in city_records])
+
+    def test_station_record_archive(self):
+        resp, arrays = self.get_archive('api:station-record-archive', {'city': self.city.name_en, 'fields': 'pm10'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(arrays.files), {'update_dtm', 'city', 'station', 'pm10'})
+        self.assertEqual(list(arrays['station']), [record.station.name_cn for record in self.records])
+        self.assertEqual(list(arrays['pm10']), [float(record.pm10) for record in self.records])
+
+    def test_missing_values(self):
+        models.CityRecord.objects.update(pm10=None)
+        resp, arrays = self.get_archive('api:city-record-archive', {'city': 'foo'})
+        self.assertEqual(len(arrays['pm10']), 0)
+        resp, arrays = self.get_archive('api:city-record-archive', {'city': self.city.name_en})
+        self.assertTrue(numpy.isnan(arrays['pm10']).all())
+
+    def test_invalid_fields(self):
+        resp, _ = self.get_archive('api:city-record-archive', {'fields': 'foo'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RollupAPITest(APITestCase):
+
+    def test_get_city_rollups(self):
+        city_record = factories.CityRecordFactory(pm10=Decimal(10))
+        factories.CityRecordFactory(city=city_record.city, update_dtm=city_record.update_dtm + timedelta(hours=1),
+                                    pm10=Decimal(20))
+        call_command('rebuild_rollups', stdout=io.StringIO())
+
+        resp = self.client.get(patch_params_to_url(reverse('api:city-rollup-list'), {
+            'city': city_record.city.name_en, 'period': 'month'
+        }))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.data['results']), 1)
+        data = resp.data['results'][0]
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['mean']['pm10'], Decimal(15))
+        self.assertEqual(data['pm10_max'], '20.0000')
+
+
+class CacheTest(APITransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, url_name, params=None, **kwargs):
+        with CaptureQueriesContext(connection) as captured:
+            resp = self.client.get(patch_params_to_url(reverse(url_name, **kwargs), params or {}))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return resp, len([query for query in captured if query['sql'].startswith('SELECT')])
+
+    def test_cached_until_changed(self):
+        for url_name, factory in [
+            ('api:city-list', factories.CityFactory),
+            ('api:station-list', factories.StationFactory),
+            ('api:city-record-list', factories.CityRecordFactory),
+            ('api:station-record-list', factories.StationRecordFactory),
+        ]:
+            with self.subTest(url_name=url_name):
+                factory()
+                resp, query_count = self.get(url_name)
+                self.assertGreater(query_count, 0)
+                self.assertEqual(self.get(url_name)[1], 0)
+
+                factory()
+                resp, query_count = self.get(url_name)
+                self.assertGreater(query_count, 0)
+                self.assertEqual(resp.data['count'], 2)
+
+    def test_query_params_in_key(self):
+        record = factories.CityRecordFactory()
+        resp, _ = self.get('api:city-record-detail', {'fields': 'o3'}, kwargs={'pk': record.pk})
+        self.assertNotIn('pm10', resp.data)
+        resp, _ = self.get('api:city-record-detail', kwargs={'pk': record.pk})
+        self.assertIn('pm10', resp.data)
+        resp, query_count = self.get('api:city-record-detail', {'fields': 'o3'}, kwargs={'pk': record.pk})
+        self.assertNotIn('pm10', resp.data)
+        self.assertEqual(query_count, 0)
+
+    def test_latest_city_record(self):
+        record = factories.CityRecordFactory()
+        params = {'city': record.city.name_en}
+        self.get('api:latest-city-record', dict(params))
+        resp, query_count = self.get('api:latest-city-record', dict(params))
+        self.assertEqual(query_count, 0)
+        self.assertEqual(resp.data['id'], record.pk)
+
+        new_record = factories.CityRecordFactory(city=record.city,
+                                                 update_dtm=record.update_dtm + timedelta(hours=1))
+        resp, _ = self.get('api:latest-city-record', dict(params))
+        self.assertEqual(resp.data['id'], new_record.pk)
+
+    def test_invalidated_by_bulk_creation(self):
+        city = factories.CityFactory()
+        station = factories.StationFactory(city=city)
+        self.get('api:city-record-list')
+        create_city_records([factories.InfoDictFactory(city=city, stations=[station], station_num=1)])
+        resp, _ = self.get('api:city-record-list')
+        self.assertEqual(resp.data['count'], 1)
+
+    def test_scoped_by_city_and_hour(self):
+        record_a = factories.CityRecordFactory()
+        record_b = factories.CityRecordFactory()
+        hour_a = {'update_dtm': record_a.update_dtm.strftime('%Y-%m-%dT%H:%M:%SZ')}
+        for params in [{'city': record_a.city.name_en}, hour_a, {}]:
+            self.get('api:city-record-list', dict(params))
+
+        factories.CityRecordFactory(city=record_b.city, update_dtm=record_b.update_dtm + timedelta(hours=1))
+        self.assertEqual(self.get('api:city-record-list', {'city': record_a.city.name_en})[1], 0)
+        self.assertEqual(self.get('api:city-record-list', dict(hour_a))[1], 0)
+        resp, query_count = self.get('api:city-record-list')
+        self.assertGreater(query_count, 0)
+        self.assertEqual(resp.data['count'], 3)
+
+        resp, query_count = self.get('api:city-record-list', {'city': record_b.city.name_en})
+        self.assertEqual(resp.data['count'], 2)
+
+    def test_batch_mode(self):
+        record = factories.CityRecordFactory()
+        params = {'city': record.city.name_en}
+        self.get('api:city-record-list', dict(params))
+
+        with caching.batch():
+            factories.CityRecordFactory(city=record.city, update_dtm=record.update_dtm + timedelta(hours=1))
+            factories.CityRecordFactory(city=record.city, update_dtm=record.update_dtm + timedelta(hours=2))
+            resp, query_count = self.get('api:city-record-list', dict(params))
+            self.assertEqual((resp.data['count'], query_count), (1, 0))
+
+        resp, _ = self.get('api:city-record-list', dict(params))
+        self.assertEqual(resp.data['count'], 3)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+import collections
+import contextlib
+import fcntl
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+
+
+# ===================================================================
+# Memory-mapped Time Series
+# ===================================================================
+# Hourly values of every city and station are kept on disk with one file per field per entity, as
+# <root>/<kind>/<entity>/<field>.f8, where kind is 'city' or 'station' and entity is the primary key.
+#
+# A file is a header of two little-endian int64, the first hour of the series and one past the last hour written,
+# counted in hours since EPOCH, followed by float64 values of consecutive hours, with NaN for missing values.
+# Files grow ahead of the hours written, which are NaN until written. The hours with a record are marked by 1.0
+# in the PRESENT series, so a record with no value at all is still there, and an hour from the first to the last
+# written one without the mark is known to have no record.
+#
+# The store follows records added by create_city_record(s), AQHI updated by update_aqhi and records deleted,
+# after their transactions are committed. Records written in any other way, or by a process without
+# AIRQUALITY_TIMESERIES_DIR, are only added by build_timeseries, so run it after them.
+#
+# Files are memory-mapped, so reading any hour of an entity is an index into an array paged in by the OS.
+#
+# Several processes may share a store, e.g. the crawler and collect_records. A file is mapped again when it has
+# been grown or replaced since it was mapped, which is checked every time a store method uses it, and writes to
+# the files of an entity hold an exclusive lock on its .lock file, so no write goes to a file replaced meanwhile.
+EPOCH = datetime(2010, 1, 1, tzinfo=pytz.utc)
+HEADER_DTYPE = np.dtype('<i8')
+HEADER_SIZE = 2 * HEADER_DTYPE.itemsize
+VALUE_DTYPE = np.dtype('<f8')
+PRESENT = '_present'
+
+
+def hour_index(dtm):
+    """Return hours from EPOCH to the hour of an aware datetime, which is floored to the hour."""
+    return int((dtm - EPOCH).total_seconds() // 3600)
+
+
+def hour_dtm(index):
+    return EPOCH + timedelta(hours=index)
+
+
+class Series(object):
+    """Values of one field of one entity in a memory-mapped file, see above."""
+
+    def __init__(self, path):
+        self.path = path
+        self.start = None
+        self.header = None
+        self.values = None
+        # Inode and size of the mapped file
+        self._stat = None
+        self.refresh()
+
+    def refresh(self):
+        """Map the file again if it has been created, grown or replaced, e.g. by another process, since mapped."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_size) != self._stat:
+            self._map()
+
+    def _map(self):
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+        self._stat = (stat.st_ino, stat.st_size)
+        # The header is mapped as well, so the end written by another process is seen at once
+        self.header = np.memmap(self.path, dtype=HEADER_DTYPE, mode='r+', shape=(2, ))
+        self.start = int(self.header[0])
+        count = (stat.st_size - HEADER_SIZE) // VALUE_DTYPE.itemsize
+        self.values = np.memmap(self.path, dtype=VALUE_DTYPE, mode='r+', offset=HEADER_SIZE, shape=(count, )) \
+            if count else np.empty(0, dtype=VALUE_DTYPE)
+
+    @property
+    def end(self):
+        """One past the last hour written."""
+        return int(self.header[1]) if self.header is not None else None
+
+    def covers(self, index):
+        """
+        Return whether the hour is from the first to the last written one, so a NaN of it means a missing value
+        rather than an unknown one.
+        """
+        return self.values is not None and self.start <= index < self.end
+
+    def get(self, index):
+        if not self.covers(index):
+            return np.nan
+        return self.values[index - self.start]
+
+    def get_range(self, start, end):
+        """Return values of hours from start to end exclusive, with NaN outside of the file."""
+        res = np.full(max(end - start, 0), np.nan, dtype=VALUE_DTYPE)
+        if self.values is not None:
+            lo, hi = max(start, self.start), min(end, self.start + len(self.values))
+            if lo < hi:
+                res[lo - start:hi - start] = self.values[lo - self.start:hi - self.start]
+        return res
+
+    def set(self, index, value, growth):
+        """Set the value of an hour, growing the file by at least `growth` hours if the hour is beyond its end."""
+        if self.values is None:
+            self._write(index, index, np.full(growth, np.nan, dtype=VALUE_DTYPE))
+        elif index < self.start:
+            # Records older than the series are rare, so the file is just written again
+            values = np.full(self.start - index + len(self.values), np.nan, dtype=VALUE_DTYPE)
+            values[self.start - index:] = self.values
+            self._write(index, self.end, values)
+        elif index >= self.start + len(self.values):
+            size = max(index - self.start + 1, len(self.values) + growth)
+            with open(self.path, 'ab') as f:
+                f.write(np.full(size - len(self.values), np.nan, dtype=VALUE_DTYPE).tobytes())
+            self._map()
+        self.values[index - self.start] = value
+        if index >= self.end:
+            self.header[1] = index + 1
+
+    def flush(self):
+        if isinstance(self.values, np.memmap):
+            self.values.flush()
+        if self.header is not None:
+            self.header.flush()
+
+    def _write(self, start, end, values):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.header = self.values = None
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(np.array([start, end], dtype=HEADER_DTYPE).tobytes())
+            f.write(values.astype(VALUE_DTYPE).tobytes())
+        os.replace(tmp_path, self.path)
+        self._map()
+
+
+class TimeSeriesStore(object):
+    """
+    An on-disk store of hourly values of records, see above. Reading and writing an hour of an entity is O(1),
+    and memory of files is paged by the OS, so multi-year history can be read without querying database.
+
+    Records are added by create_city_record and create_city_records after being committed when the store is
+    enabled by AIRQUALITY_TIMESERIES_DIR, and the build_timeseries command adds existing records.
+    """
+
+    def __init__(self, root, fields, growth=24 * 30):
+        """
+        :param root: directory of the store, created if missing
+        :param fields: names of fields to store
+        :param growth: minimum number of hours a file grows by, so that it is not remapped every hour
+        """
+        self.root = root
+        self.fields = list(fields)
+        self.growth = growth
+        self._series = {}
+        self._lock = threading.RLock()
+
+    def _get_series(self, kind, entity, field):
+        key = (kind, str(entity), field)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = Series(os.path.join(self.root, kind, str(entity), field + '.f8'))
+        else:
+            series.refresh()
+        return series
+
+    @contextlib.contextmanager
+    def _lock_entity(self, kind, entity):
+        """Hold an exclusive lock on the files of an entity against other processes."""
+        directory = os.path.join(self.root, kind, str(entity))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add(self, kind, entity, update_dtm, values):
+        """
+        Set values of the hour of update_dtm of an entity.
+
+        :param kind: 'city' or 'station'
+        :param entity: primary key of a city or station
+        :param values: a dict or a record with fields of the store as keys or attributes, None for missing values
+        """
+        get = values.get if isinstance(values, dict) else lambda field: getattr(values, field, None)
+        index = hour_index(update_dtm)
+        # Series are refreshed after the lock is taken, so they are up to date while written
+        with self._lock, self._lock_entity(kind, entity):
+            for field in self.fields:
+                value = get(field)
+                self._get_series(kind, entity, field).set(index, np.nan if value is None else float(value),
+                                                          self.growth)
+            self._get_series(kind, entity, PRESENT).set(index, 1.0, self.growth)
+
+    def update(self, kind, entity, update_dtm, values):
+        """Set values of some fields of the hour of update_dtm of an entity, if the hour has a record."""
+        index = hour_index(update_dtm)
+        with self._lock, self._lock_entity(kind, entity):
+            if np.isnan(self._get_series(kind, entity, PRESENT).get(index)):
+                return
+            for field, value in values.items():
+                self._get_series(kind, entity, field).set(index, np.nan if value is None else float(value),
+                                                          self.growth)
+
+    def remove(self, kind, entity, update_dtm):
+        """Mark the hour of update_dtm of an entity as having no record, e.g. after its record is deleted."""
+        index = hour_index(update_dtm)
+        with self._lock, self._lock_entity(kind, entity):
+            present = self._get_series(kind, entity, PRESENT)
+            if np.isnan(present.get(index)):
+                return
+            for field in self.fields:
+                self._get_series(kind, entity, field).set(index, np.nan, self.growth)
+            present.set(index, np.nan, self.growth)
+
+    def add_records(self, city_records, station_records):
+        """Add saved CityRecords and StationRecords and flush them to disk."""
+        with self._lock:
+            for kind, entity_attr, records in [('city', 'city_id', city_records),
+                                               ('station', 'station_id', station_records)]:
+                for record in records:
+                    self.add(kind, getattr(record, entity_attr), record.update_dtm, record)
+            self.flush()
+
+    def update_values(self, kind, field, items):
+        """Set a field of (entity, update_dtm, value) items by update and flush them to disk."""
+        with self._lock:
+            for entity, update_dtm, value in items:
+                self.update(kind, entity, update_dtm, {field: value})
+            self.flush()
+
+    def remove_records(self, kind, keys):
+        """Remove records of (entity, update_dtm) keys by remove and flush them to disk."""
+        with self._lock:
+            for entity, update_dtm in keys:
+                self.remove(kind, entity, update_dtm)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            for series in self._series.values():
+                series.flush()
+
+    def get(self, kind, entity, field, update_dtm):
+        """Return the value of a field of an entity at the hour of update_dtm, or None if missing."""
+        with self._lock:
+            value = self._get_series(kind, entity, field).get(hour_index(update_dtm))
+        return None if np.isnan(value) else float(value)
+
+    def covers(self, kind, entity, update_dtm):
+        """
+        Return whether the store knows if an entity has a record at the hour of update_dtm, which is false for
+        hours before the first or after the last hour added for the entity.
+        """
+        with self._lock:
+            return self._get_series(kind, entity, PRESENT).covers(hour_index(update_dtm))
+
+    def get_array(self, kind, entity, field, start_dtm, end_dtm):
+        """Return a float64 array of a field of an entity in hours from start_dtm to end_dtm exclusive."""
+        with self._lock:
+            return self._get_series(kind, entity, field).get_range(hour_index(start_dtm), hour_index(end_dtm))
+
+    def get_rows(self, kind, entities, dtms, fields):
+        """
+        Return rows of (entity, update_dtm, *values of fields) of hours with a record, with None for missing values.
+        Rows are like those of values_list(entity, 'update_dtm', *fields), so that they can replace database
+        queries, e.g. of history in calculate_new_aqhi.
+
+        :param dtms: datetimes on the hour to read
+        """
+        rows = []
+        with self._lock:
+            for entity in entities:
+                present = self._get_series(kind, entity, PRESENT)
+                series = [self._get_series(kind, entity, field) for field in fields]
+                for dtm in dtms:
+                    index = hour_index(dtm)
+                    if np.isnan(present.get(index)):
+                        continue
+                    values = [s.get(index) for s in series]
+                    rows.append((entity, dtm) + tuple(None if np.isnan(v) else float(v) for v in values))
+        return rows
+
+    def get_records(self, kind, entity, start_dtm, end_dtm, fields=None):
+        """
+        Return records of an entity in hours from start_dtm to end_dtm exclusive, in ascending order.
+        Records are TimeSeriesRecords with update_dtm and fields as attributes in floats or None, so they can be
+        given to functions expecting CityRecords, like utils.reduce_to_average_in_hours.
+        """
+        if fields is None:
+            fields = self.fields
+        start, end = hour_index(start_dtm), hour_index(end_dtm)
+        with self._lock:
+            present = self._get_series(kind, entity, PRESENT).get_range(start, end)
+            arrays = [self._get_series(kind, entity, field).get_range(start, end) for field in fields]
+        record_class = get_record_class(tuple(fields))
+        return [
+            record_class(hour_dtm(start + int(i)), *(None if np.isnan(a[i]) else float(a[i]) for a in arrays))
+            for i in np.flatnonzero(~np.isnan(present))
+        ]
+
+
+_record_classes = {}
+
+
+def get_record_class(fields):
+    if fields not in _record_classes:
+        _record_classes[fields] = collections.namedtuple('TimeSeriesRecord', ('update_dtm', ) + fields)
+    return _record_classes[fields]
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(root, fields):
+    """Return the store of a directory, which is opened once per process. None root means no store."""
+    if not root:
+        return None
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = TimeSeriesStore(root, fields)
+        return _stores[root]
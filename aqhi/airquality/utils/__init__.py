@@ -1,25 +1,33 @@
 # -*- coding: utf-8 -*-
+import json
 import math
+import os
 import socket
 import subprocess
 from decimal import Decimal
 from statistics import mean, StatisticsError
 
+import numpy as np
 import paramiko
+from django.utils import dateparse
 
 from .. import extractors
 from .. import models
 from . import buptnet
 
 
-def parse_and_create_records_from_html(html_string, city_name_en):
-    info_dict = extractors.process_parsed_dict(extractors.parse_info_dict(extractors.extract_info(html_string)))
+def parse_records_from_html(html_string, city_name_en):
+    """Parse a city page to an info dict as models.create_city_record(s) expects."""
+    info_dict = extractors.process_parsed_dict(
+        extractors.parse_info_dict(extractors.extract_info_in_one_pass(html_string))
+    )
     info_dict['city']['area_en'] = city_name_en
+    return info_dict
+
+
+def parse_and_create_records_from_html(html_string, city_name_en):
+    info_dict = parse_records_from_html(html_string, city_name_en)
     create_status = models.create_city_record(info_dict)
-    if create_status['success'] == 1:
-        record = create_status['info']
-        record.aqhi = record.calculate_aqhi_field()
-        record.save()
     return info_dict, create_status
 
 
@@ -34,6 +42,7 @@ pollutant_coeffs = dict(
 ar_breakpoints = [
     1.88, 3.76, 5.64, 7.52, 9.41, 11.29, 12.91, 15.07, 17.22, 19.37, float('inf')
 ]
+_ar_breakpoints_array = np.array(ar_breakpoints)
 
 
 def calculate_pollutant_ar(avg_3h, coeff):
@@ -60,6 +69,219 @@ def calculate_aqhi_in_decimal(pm10_3h_dec, pm25_3h_dec, no2_3h_dec, so2_3h_dec,
     ))
 
 
+# Pollutants needed by AQHI, in the order of the value columns used by calculate_aqhi_by_entity
+aqhi_pollutants = ['pm10', 'pm2_5', 'so2', 'no2', 'o3']
+
+
+def calculate_aqhi_array(pm10_3h, pm25_3h, no2_3h, so2_3h, o3_3h):
+    """
+    Vectorized version of calculate_aqhi.
+
+    :param pm10_3h: an array-like of 3-hour averages, and so are the other arguments with the same shape
+    :return: a float array of AQHI, which is nan wherever any of the averages is missing (None or nan)
+    """
+    def pollutant_ar(avg_3h, coeff):
+        return (np.exp(coeff * np.asarray(avg_3h, dtype=float)) - 1) * 100
+
+    pm_ar = np.maximum(pollutant_ar(pm10_3h, pollutant_coeffs['pm10']),
+                       pollutant_ar(pm25_3h, pollutant_coeffs['pm2_5']))
+    ar = (pollutant_ar(no2_3h, pollutant_coeffs['no2']) + pollutant_ar(so2_3h, pollutant_coeffs['so2']) +
+          pollutant_ar(o3_3h, pollutant_coeffs['o3']) + pm_ar)
+
+    aqhi = (np.searchsorted(_ar_breakpoints_array, ar) + 1).astype(float)
+    aqhi[np.isnan(ar)] = np.nan
+    return aqhi
+
+
+def calculate_rolling_aqhi_array(hours, pollutant_values):
+    """
+    Calculate AQHI for a series of hourly records at once.
+
+    The 3-hour average of the record at hour h is the mean of the values of the records at hour h - 2, h - 1 and h
+    that exist, ignoring missing values, which is the same as CalculateAQHIFieldRecordMixin.calculate_aqhi_field.
+
+    :param hours: an int array of strictly ascending hour numbers of the records. Records of different cities or
+        stations can be calculated together if their hours are far enough from each other.
+    :param pollutant_values: a dict mapping each of aqhi_pollutants to a float array aligned with hours, with nan
+        for missing values
+    :return: a float array of AQHI aligned with hours, nan when it can not be calculated
+    """
+    hours = np.asarray(hours, dtype=np.int64)
+    if len(hours) == 0:
+        return np.array([], dtype=float)
+
+    # Positions of the records one and two hours before, if any
+    previous = []
+    for lag in (2, 1):
+        positions = np.minimum(np.searchsorted(hours, hours - lag), len(hours) - 1)
+        previous.append((positions, hours[positions] == hours - lag))
+
+    averages = {}
+    for field in aqhi_pollutants:
+        values = np.asarray(pollutant_values[field], dtype=float)
+        window = np.vstack([np.where(found, values[positions], np.nan) for positions, found in previous] + [values])
+        counts = np.sum(~np.isnan(window), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            average = np.nansum(window, axis=0) / counts
+        # Averages are rounded like reduce_to_one_record_dict does
+        averages[field] = np.where(counts > 0, np.round(average, models.POLL_DECIMAL_PLACES), np.nan)
+
+    return calculate_aqhi_array(
+        pm10_3h=averages['pm10'],
+        pm25_3h=averages['pm2_5'],
+        no2_3h=averages['no2'],
+        so2_3h=averages['so2'],
+        o3_3h=averages['o3'],
+    )
+
+
+# Hour numbers of different entities are shifted by this in calculate_aqhi_by_entity
+_entity_hour_span = 2 ** 32
+
+
+def calculate_aqhi_by_entity(rows):
+    """
+    Calculate AQHI for hourly records of many cities or stations at once.
+
+    :param rows: an iterable of tuples of (entity, update_dtm, pm10, pm2_5, so2, no2, o3), where entity is any
+        hashable identifying a city or station and values can be None. Entity and update_dtm pairs must be unique.
+    :return: a dict mapping (entity, update_dtm) to AQHI in Decimal, or None when it can not be calculated
+    """
+    rows = list(rows)
+    if not rows:
+        return {}
+
+    entity_indexes = {}
+    for row in rows:
+        entity_indexes.setdefault(row[0], len(entity_indexes))
+    # Keep hours of different entities far apart so that one series never looks into another
+    keys = np.array([
+        entity_indexes[row[0]] * _entity_hour_span + int(row[1].timestamp() // 3600)
+        for row in rows
+    ], dtype=np.int64)
+    order = np.argsort(keys, kind='mergesort')
+
+    values = np.array([row[2:] for row in rows], dtype=float)[order]
+    aqhi = calculate_rolling_aqhi_array(
+        keys[order],
+        {field: values[:, i] for i, field in enumerate(aqhi_pollutants)}
+    )
+
+    return {
+        (rows[i][0], rows[i][1]): None if np.isnan(value) else Decimal(int(value))
+        for i, value in zip(order, aqhi)
+    }
+
+
+class RollingAqhiCalculator(object):
+    """
+    Calculate AQHI of hourly records fed in chunks, keeping the last two records of every city or station
+    as the 3-hour window of the next chunk. Records of each city or station must be fed in time order,
+    while records of different ones can interleave.
+    """
+
+    def __init__(self):
+        self.windows = {}
+
+    def calculate(self, rows):
+        """
+        :param rows: an iterable of tuples of (pk, aqhi, entity, update_dtm, pm10, pm2_5, so2, no2, o3)
+        :return: a list of (pk, old aqhi, new aqhi)
+        """
+        rows = list(rows)
+        carried = [row for entity in {row[2] for row in rows} for row in self.windows.get(entity, [])]
+        aqhi = calculate_aqhi_by_entity(row[2:] for row in carried + rows)
+        for row in rows:
+            self.windows[row[2]] = (self.windows.get(row[2], []) + [row])[-2:]
+        return [(row[0], row[1], aqhi[(row[2], row[3])]) for row in rows]
+
+
+class ScanCheckpoint(object):
+    """
+    A JSON file saving the (update_dtm, pk) key of the last processed row of named scans,
+    which can be passed to the scan queryset method as `after` to resume.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.keys = json.load(f)
+
+    def get(self, name):
+        if name not in self.keys:
+            return None
+        dtm, pk = self.keys[name]
+        return dateparse.parse_datetime(dtm), pk
+
+    def set(self, name, key):
+        self.keys[name] = [key[0].isoformat(), key[1]]
+        # Write to a temporary file first so that a crash never leaves a broken checkpoint
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.keys, f)
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        """Delete the file after all scans are done, so that the next run starts over."""
+        self.keys = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class CrawlState(object):
+    """
+    A JSON file saving the update datetime and the ETag and Last-Modified headers of every crawled page, so that the
+    next crawl sends conditional requests and skips pages not updated since.
+    Nothing is saved without a path, and the file is only written by save().
+    """
+
+    def __init__(self, path=None, load=True):
+        self.path = path
+        self.pages = {}
+        if load and path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.pages = json.load(f)
+
+    def get_update_dtm(self, name):
+        dtm = self.pages.get(name, {}).get('update_dtm')
+        return dateparse.parse_datetime(dtm) if dtm else None
+
+    def get_headers(self, name):
+        """Return headers of a conditional request of a page."""
+        page = self.pages.get(name, {})
+        headers = {}
+        if page.get('etag'):
+            headers['If-None-Match'] = page['etag']
+        if page.get('last_modified'):
+            headers['If-Modified-Since'] = page['last_modified']
+        return headers
+
+    def update(self, name, update_dtm=None, etag=None, last_modified=None):
+        page = self.pages.setdefault(name, {})
+        if update_dtm is not None:
+            page['update_dtm'] = update_dtm.isoformat()
+        page['etag'] = etag
+        page['last_modified'] = last_modified
+
+    def get_delays(self, name):
+        """Return the recent delays in seconds between update datetimes of a page and when they were first seen."""
+        return self.pages.get(name, {}).get('delays', [])
+
+    def add_delay(self, name, seconds, keep=24):
+        page = self.pages.setdefault(name, {})
+        page['delays'] = (page.get('delays', []) + [seconds])[-keep:]
+
+    def save(self):
+        if self.path is None:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.pages, f)
+        os.replace(temp_path, self.path)
+
+
 def get_ssh_client(hostname, username, password=None, port=22, timeout=5, log_file=None):
     """
     Use paramiko to create ssh session and return the ssh client.
@@ -167,7 +389,8 @@ def reduce_to_average_in_hours(city_records, hours=24, fields=None, default=None
     If there is any none value, it will be ignored when calculating average. Only if all values of a field is none,
     the field in the result is none.
 
-    :param city_records: CityRecords iterable
+    :param city_records: CityRecords iterable, or records read from the time series store by
+        TimeSeriesStore.get_records without querying database
     :param hours: designate how many hours of average, defaults to 24
     :param fields: a list or a single field name to count
         This defaults to models.DECIMAL_FIELDS, if one of the fields do not exist, exception will be raised
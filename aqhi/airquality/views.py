@@ -1,71 +1,62 @@
-import copy
-import datetime
+import tempfile
 
-from django.http import Http404
-from django.core.cache import cache
+from django.http import FileResponse, Http404
+from django.utils import dateparse, timezone
 from django.utils.encoding import force_text
+from django.db.models import Min
 from django.db.models.signals import post_save, post_delete
 
 from rest_framework import viewsets, generics
 from rest_framework import filters as drf_filters
 from rest_framework.views import APIView
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
-from rest_framework.utils.serializer_helpers import ReturnDict
-from rest_framework_extensions.cache.mixins import RetrieveCacheResponseMixin
+from rest_framework_extensions.cache.mixins import (
+    CacheResponseMixin, ListCacheResponseMixin, RetrieveCacheResponseMixin
+)
 from rest_framework_extensions.key_constructor.constructors import (
-    DefaultObjectKeyConstructor, DefaultListKeyConstructor
+    DefaultKeyConstructor, DefaultObjectKeyConstructor, DefaultListKeyConstructor
 )
 from rest_framework_extensions.key_constructor import bits
 
-from . import models, serializers, filters
+from . import archive, models, serializers, filters, caching
 
 
 # ===================================================================
 # Mixins
 # ===================================================================
 class FilterFieldsMixin(object):
-    def finalize_response(self, request, response, *args, **kwargs):
-        res = super(FilterFieldsMixin, self).finalize_response(request, response, *args, **kwargs)
-        params = request.query_params
-        if 'fields' in params:
-            if "count" in res.data and "previous" in res.data and "next" in res.data and "results" in res.data:
-                data_type = 'paged'
-            elif isinstance(res.data, list):
-                data_type = 'list'
-            else:
-                data_type = 'object'
-
-            if data_type == 'list':
-                data = res.data
-                for i, obj in enumerate(data):
-                    filtered_obj = type(obj)()
-                    self._filter_instance(
-                        obj,
-                        self._generate_structure(params['fields'].split(',')),
-                        filtered_obj
-                    )
-                    data[i] = filtered_obj
-                res.data = data
-            elif data_type == 'object':
-                filtered_data = ReturnDict(serializer=res.data.serializer)
-                self._filter_instance(
-                    res.data,
-                    self._generate_structure(params['fields'].split(',')),
-                    filtered_data
-                )
-                res.data = filtered_data
-            else:
-                data = res.data['results']
-                for i, obj in enumerate(data):
-                    filtered_obj = type(obj)()
-                    self._filter_instance(
-                        obj,
-                        self._generate_structure(params['fields'].split(',')),
-                        filtered_obj
-                    )
-                    data[i] = filtered_obj
-
-        return res
+    """
+    Only serialize fields in the comma separated `fields` query parameter, where `__` selects fields of nested objects,
+    e.g. `fields=aqhi,city__name_cn`. Fields are removed from the serializer and the queryset only loads columns and
+    relations the remaining fields need.
+    """
+    def get_sparse_fields(self):
+        if not hasattr(self, '_sparse_fields'):
+            fields = self.request.query_params.get('fields', None)
+            self._sparse_fields = self._generate_structure(fields.split(',')) if fields else None
+        return self._sparse_fields
+
+    def get_serializer(self, *args, **kwargs):
+        sparse_fields = self.get_sparse_fields()
+        if sparse_fields is not None:
+            kwargs['sparse_fields'] = sparse_fields
+        return super(FilterFieldsMixin, self).get_serializer(*args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        queryset = super(FilterFieldsMixin, self).filter_queryset(queryset)
+        if self.get_sparse_fields() is None:
+            return queryset
+
+        only, select_related, prefetch_related = self.get_serializer().get_queryset_fields()
+        queryset = queryset.select_related(None).prefetch_related(None)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        if only is not None:
+            queryset = queryset.only(*only)
+        return queryset
 
     @classmethod
     def _generate_structure(cls, field_list):
@@ -81,21 +72,6 @@ class FilterFieldsMixin(object):
                 struct[field].update(cls._generate_structure([subfield]))
         return struct
 
-    @classmethod
-    def _filter_instance(cls, instance_dict, filter_dict, result_dict, preserved_fields=('url', 'id')):
-        for name, field in instance_dict.items():
-            if not isinstance(field, dict):
-                if name in filter_dict:
-                    result_dict[name] = instance_dict[name]
-                elif name in preserved_fields:
-                    result_dict[name] = instance_dict[name]
-            elif name in filter_dict:
-                if isinstance(filter_dict[name], dict):
-                    result_dict[name] = {}
-                    cls._filter_instance(field, filter_dict[name], result_dict[name])
-                else:
-                    result_dict[name] = copy.deepcopy(field)
-
 
 # ===================================================================
 # Caching
@@ -103,34 +79,66 @@ class FilterFieldsMixin(object):
 # Custom Cache Key Constructor
 # -------------------------------------------------------------------
 class UpdateAtKeyBit(bits.KeyBitBase):
-    def __init__(self, update_name, *args, **kwargs):
+    def __init__(self, update_name, scoped=False, *args, **kwargs):
         super(UpdateAtKeyBit, self).__init__(*args, **kwargs)
-        self.cache_key = '{}_updated_at_timestamp'.format(update_name)
+        self.update_name = update_name
+        self.scoped = scoped
 
     def get_data(self, params, view_instance, view_method, request, args, kwargs):
-        value = cache.get(self.cache_key, None)
-        if not value:
-            value = datetime.datetime.utcnow()
-            cache.set(self.cache_key, value)
-        return force_text(value)
+        scopes = get_update_scopes(request.query_params) if self.scoped else [None]
+        return ','.join(force_text(caching.get_updated_at(self.update_name, scope)) for scope in scopes)
+
+
+def get_update_scopes(query_params):
+    """
+    Return scopes of updated-at timestamps of records shown by a list of records filtered by query parameters.
+    Records of the cities in `city` or of the hour of `update_dtm` are scoped, while others use the global one.
+    """
+    cities = [city for city in query_params.get('city', '').split(',') if city]
+    if cities:
+        return [caching.city_scope(city) for city in cities]
+
+    update_dtm = query_params.get('update_dtm', None)
+    if update_dtm:
+        try:
+            dtm = dateparse.parse_datetime(update_dtm)
+        except ValueError:
+            dtm = None
+        if dtm is not None:
+            return [caching.hour_scope(dtm if timezone.is_aware(dtm) else timezone.make_aware(dtm))]
+
+    return [None]
+
 
+class UpdateAtKeyConstructorMixin(object):
+    """
+    Add an UpdateAtKeyBit for each of the update names, which are model names of the models shown in responses.
+    Query parameters are part of keys too, as `fields` does not change SQL queries.
+    With `scoped`, timestamps of records are scoped by the query parameters, see get_update_scopes.
+    """
+    query_params = bits.QueryParamsKeyBit()
+    scoped = False
 
-class UpdateAtObjectKeyConstructor(DefaultObjectKeyConstructor):
-    def __init__(self, update_name, *args, **kwargs):
-        super(UpdateAtObjectKeyConstructor, self).__init__(*args, **kwargs)
-        self.bits['update_at'] = UpdateAtKeyBit(update_name)
+    def __init__(self, update_name, *other_update_names, **kwargs):
+        super(UpdateAtKeyConstructorMixin, self).__init__(**kwargs)
+        for name in (update_name, ) + other_update_names:
+            self.bits['update_at_{}'.format(name)] = UpdateAtKeyBit(
+                name, scoped=self.scoped and name in caching.SCOPED_UPDATE_NAMES
+            )
 
 
-class UpdateAtListKeyConstructor(DefaultListKeyConstructor):
-    def __init__(self, update_name, *args, **kwargs):
-        super(UpdateAtListKeyConstructor, self).__init__(*args, **kwargs)
-        self.bits['update_at'] = UpdateAtKeyBit(update_name)
+class UpdateAtObjectKeyConstructor(UpdateAtKeyConstructorMixin, DefaultObjectKeyConstructor):
+    pass
+
+
+class UpdateAtListKeyConstructor(UpdateAtKeyConstructorMixin, DefaultListKeyConstructor):
+    scoped = True
 
 
 # Latest CityRecord Key Constructor
 # -------------------------------------------------------------------
-class LatestCityRecordKeyConstructor(UpdateAtObjectKeyConstructor):
-    city = bits.QueryParamsKeyBit(['city'])
+class LatestCityRecordKeyConstructor(UpdateAtKeyConstructorMixin, DefaultKeyConstructor):
+    scoped = True
 
 
 # ===================================================================
@@ -138,15 +146,19 @@ class LatestCityRecordKeyConstructor(UpdateAtObjectKeyConstructor):
 # ===================================================================
 # City and Station ViewSets
 # -------------------------------------------------------------------
-class CityViewSet(FilterFieldsMixin, viewsets.ReadOnlyModelViewSet):
+class CityViewSet(FilterFieldsMixin, CacheResponseMixin, viewsets.ReadOnlyModelViewSet):
     queryset = models.City.objects.all()
+    object_cache_key_func = UpdateAtObjectKeyConstructor('city')
+    list_cache_key_func = UpdateAtListKeyConstructor('city')
     serializer_class = serializers.CitySerializer
     filter_backends = (drf_filters.DjangoFilterBackend,)
     filter_class = filters.CityFilter
 
 
-class StationViewSet(FilterFieldsMixin, viewsets.ReadOnlyModelViewSet):
+class StationViewSet(FilterFieldsMixin, CacheResponseMixin, viewsets.ReadOnlyModelViewSet):
     queryset = models.Station.objects.all()
+    object_cache_key_func = UpdateAtObjectKeyConstructor('station')
+    list_cache_key_func = UpdateAtListKeyConstructor('station')
     serializer_class = serializers.StationSerializer
     filter_backends = (drf_filters.DjangoFilterBackend,)
     filter_class = filters.StationFilter
@@ -154,8 +166,10 @@ class StationViewSet(FilterFieldsMixin, viewsets.ReadOnlyModelViewSet):
 
 # CityRecord ViewSet
 # -------------------------------------------------------------------
-class CityRecordViewSet(FilterFieldsMixin, viewsets.ReadOnlyModelViewSet):
+class CityRecordViewSet(FilterFieldsMixin, CacheResponseMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.CityRecordSerializer
+    object_cache_key_func = UpdateAtObjectKeyConstructor('cityrecord', 'city')
+    list_cache_key_func = UpdateAtListKeyConstructor('cityrecord', 'city')
     filter_backends = (drf_filters.DjangoFilterBackend,)
     filter_class = filters.CityRecordFilter
 
@@ -167,13 +181,14 @@ class CityRecordViewSet(FilterFieldsMixin, viewsets.ReadOnlyModelViewSet):
 # Latest city record view
 # -------------------------------------------------------------------
 class LatestCityRecordView(FilterFieldsMixin,
+                           RetrieveCacheResponseMixin,
                            generics.RetrieveAPIView):
     queryset = models.CityRecord.objects.all()
     serializer_class = serializers.CityRecordSerializer
-    #object_cache_key_func = LatestCityRecordKeyConstructor(update_name='city')
+    object_cache_key_func = LatestCityRecordKeyConstructor('cityrecord', 'city')
 
     def get_object(self):
-        queryset = self.get_queryset()
+        queryset = self.filter_queryset(self.get_queryset())
 
         city_en = self.request.query_params.get('city', None)
         if city_en is None:
@@ -188,40 +203,183 @@ class LatestCityRecordView(FilterFieldsMixin,
         return obj
 
 
+class LatestCityRecordListView(FilterFieldsMixin,
+                               ListCacheResponseMixin,
+                               generics.ListAPIView):
+    """
+    Latest records of the cities in comma separated `city`, or of all cities without it, ordered by city.
+    Records are read from LatestCityRecord, so the number of queries does not depend on the number of cities.
+    """
+    serializer_class = serializers.CityRecordSerializer
+    list_cache_key_func = UpdateAtListKeyConstructor('cityrecord', 'city')
+
+    def get_queryset(self):
+        queryset = models.CityRecord.objects.current().select_related('city').prefetch_related('primary_pollutants')
+        cities = [city for city in self.request.query_params.get('city', '').split(',') if city]
+        if cities:
+            queryset = queryset.filter(city__in=cities)
+        return queryset.order_by('city')
+
+
 # Average city record view
 # -------------------------------------------------------------------
 class AverageCityRecordView(APIView):
+    """
+    Averages of city records of a city in buckets of `hours` hours (defaults to 24) from `start_dtm` to `end_dtm`.
+    `start_dtm` defaults to the earliest record. Only fields in comma separated `avg_field` are averaged,
+    defaulting to all decimal fields.
+    """
     def get(self, request, *args, **kwargs):
         params = request.query_params
         city = params.get('city', None)
         city_cn = params.get('city_cn', None)
-        start_dtm = params.get('start_dtm', None)
-        end_dtm = params.get('end_dtm', None)
-        hours = params.get('hours', None)
+        start_dtm = self._parse_datetime(params, 'start_dtm')
+        end_dtm = self._parse_datetime(params, 'end_dtm')
+        hours = params.get('hours', '24')
         avg_field = params.get('avg_field', None)
 
-        return Response()
+        queryset = models.CityRecord.objects.all()
+        if city is not None:
+            queryset = queryset.recorded_in(name_en=city)
+        elif city_cn is not None:
+            queryset = queryset.recorded_in(name_cn=city_cn)
+        else:
+            raise ParseError('Either city or city_cn is required.')
+
+        try:
+            hours = int(hours)
+        except ValueError:
+            raise ParseError('hours must be an integer.')
+        if hours < 1:
+            raise ParseError('hours must be positive.')
+
+        if avg_field is None:
+            fields = models.DECIMAL_FIELDS
+        else:
+            fields = [f for f in avg_field.split(',') if f]
+            invalid_fields = [f for f in fields if f not in models.DECIMAL_FIELDS]
+            if not fields or invalid_fields:
+                raise ParseError('Invalid avg_field: {}.'.format(avg_field))
+
+        if end_dtm is not None:
+            queryset = queryset.filter(update_dtm__lte=end_dtm)
+        if start_dtm is None:
+            start_dtm = queryset.aggregate(start_dtm=Min('update_dtm'))['start_dtm']
+            if start_dtm is None:
+                return Response([])
+
+        records = queryset.average_in_hours(start_dtm, hours, fields)
+        return Response(serializers.AverageCityRecordSerializer(records, many=True).data)
+
+    @staticmethod
+    def _parse_datetime(params, name):
+        value = params.get(name, None)
+        if value is None:
+            return None
+        try:
+            dtm = dateparse.parse_datetime(value)
+        except ValueError:
+            dtm = None
+        if dtm is None:
+            raise ParseError('Invalid {}: {}.'.format(name, value))
+        if timezone.is_naive(dtm):
+            dtm = timezone.make_aware(dtm)
+        return dtm
 
 
 # StationRecord ViewSet
 # -------------------------------------------------------------------
-class StationRecordViewSet(FilterFieldsMixin, viewsets.ReadOnlyModelViewSet):
-    queryset = models.StationRecord.objects.all()
+class StationRecordViewSet(FilterFieldsMixin, CacheResponseMixin, viewsets.ReadOnlyModelViewSet):
+    object_cache_key_func = UpdateAtObjectKeyConstructor('stationrecord', 'station')
+    list_cache_key_func = UpdateAtListKeyConstructor('stationrecord', 'station')
     serializer_class = serializers.StationRecordSerializer
     filter_backends = (drf_filters.DjangoFilterBackend,)
     filter_class = filters.StationRecordFilter
 
+    def get_queryset(self):
+        # Hyperlinks are named after cities of stations and city records
+        return models.StationRecord.objects.select_related('station__city', 'city_record__city')
+
+
+# Rollup ViewSets
+# -------------------------------------------------------------------
+class CityRollupViewSet(FilterFieldsMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = models.CityRollup.objects.all()
+    serializer_class = serializers.CityRollupSerializer
+    filter_backends = (drf_filters.DjangoFilterBackend,)
+    filter_class = filters.CityRollupFilter
+
+
+class StationRollupViewSet(FilterFieldsMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = models.StationRollup.objects.all()
+    serializer_class = serializers.StationRollupSerializer
+    filter_backends = (drf_filters.DjangoFilterBackend,)
+    filter_class = filters.StationRollupFilter
+
+
+# Record archive views
+# -------------------------------------------------------------------
+class RecordArchiveView(generics.GenericAPIView):
+    """
+    Download filtered records as a compressed NumPy .npz file with one array per column, see archive.py.
+    Pollutant fields can be limited to comma separated `fields`.
+    """
+    filter_backends = (drf_filters.DjangoFilterBackend,)
+    archive_name = None
+
+    def get(self, request, *args, **kwargs):
+        fields = request.query_params.get('fields', None)
+        if fields is not None:
+            fields = [f for f in fields.split(',') if f]
+            invalid_fields = [f for f in fields if f not in models.DECIMAL_FIELDS]
+            if not fields or invalid_fields:
+                raise ParseError('Invalid fields: {}.'.format(', '.join(invalid_fields)))
+
+        # Archives may be large, so they are spooled to disk instead of being built in memory
+        file = tempfile.TemporaryFile()
+        archive.write_archive(self.filter_queryset(self.get_queryset()), file, fields=fields)
+        size = file.tell()
+        file.seek(0)
+        response = FileResponse(file, content_type='application/octet-stream')
+        response['Content-Length'] = size
+        response['Content-Disposition'] = 'attachment; filename="{}.npz"'.format(self.archive_name)
+        return response
+
+
+class CityRecordArchiveView(RecordArchiveView):
+    queryset = models.CityRecord.objects.all()
+    filter_class = filters.CityRecordFilter
+    archive_name = 'city_records'
+
+
+class StationRecordArchiveView(RecordArchiveView):
+    queryset = models.StationRecord.objects.all()
+    filter_class = filters.StationRecordFilter
+    archive_name = 'station_records'
+
 
 # Cache Key Invalidation
 # -------------------------------------------------------------------
 def get_change_update_at_function(update_name):
-    def change_api_updated_at(*args, **kwargs):
-        cache.set('{}_updated_at_timestamp'.format(update_name), datetime.datetime.utcnow())
+    def change_api_updated_at(sender, instance, **kwargs):
+        cities, dtms = get_record_city_and_dtm(instance)
+        caching.touch(update_name, cities=cities, dtms=dtms)
 
     return change_api_updated_at
 
 
-for model in [models.CityRecord]:
+def get_record_city_and_dtm(instance):
+    """Return lists of the city and update datetime of a changed record, which are empty for other models."""
+    if isinstance(instance, models.CityRecord):
+        return [instance.city_id], [instance.update_dtm]
+    elif isinstance(instance, models.StationRecord):
+        return [instance.city_id], [instance.update_dtm]
+    return [], []
+
+
+for model in [models.City, models.Station, models.CityRecord, models.StationRecord]:
     receiver = get_change_update_at_function(model._meta.model_name)
-    post_save.connect(sender=model, receiver=receiver)
-    post_delete.connect(sender=model, receiver=receiver)
+    post_save.connect(sender=model, receiver=receiver, weak=False,
+                      dispatch_uid='{}_updated_at'.format(model._meta.model_name))
+    post_delete.connect(sender=model, receiver=receiver, weak=False,
+                        dispatch_uid='{}_updated_at'.format(model._meta.model_name))
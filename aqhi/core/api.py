@@ -11,10 +11,18 @@ router.register(r'airquality/city', airquality_views.CityViewSet)
 router.register(r'airquality/station', airquality_views.StationViewSet)
 router.register(r'airquality/city_record', airquality_views.CityRecordViewSet, base_name='city-record')
 router.register(r'airquality/station_record', airquality_views.StationRecordViewSet, base_name='station-record')
+router.register(r'airquality/city_rollup', airquality_views.CityRollupViewSet, base_name='city-rollup')
+router.register(r'airquality/station_rollup', airquality_views.StationRollupViewSet, base_name='station-rollup')
 
 urlpatterns = [
     url(r'^', include(router.urls)),
+    url(r'^airquality/latest_city_records', airquality_views.LatestCityRecordListView.as_view(),
+        name='latest-city-records'),
     url(r'^airquality/latest_city_record', airquality_views.LatestCityRecordView.as_view(), name='latest-city-record'),
+    url(r'^airquality/city_record_archive', airquality_views.CityRecordArchiveView.as_view(),
+        name='city-record-archive'),
+    url(r'^airquality/station_record_archive', airquality_views.StationRecordArchiveView.as_view(),
+        name='station-record-archive'),
     url(r'^airquality/avg_city_record', airquality_views.AverageCityRecordView.as_view(), name='avg-city-record'),
     # get city panel html
     url(r'^core/city_panel_body/$', core_views.CityPanelView.as_view(), name='city-panel-body')
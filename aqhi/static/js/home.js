@@ -233,16 +233,42 @@ $(function() {
 
   });
 
+  // Fetch latest records of all city panels at once
+  var cityNames = $('.city-panel').map(function() {
+    return $(this).data('city');
+  }).get();
+  latestCityRecordsRequest = $.getJSON('api/airquality/latest_city_records', {
+    city: cityNames.join(','),
+    limit: cityNames.length
+  });
+
   var primaryCityPanel = $('.city-panel.primary-city-panel');
   var primaryCityName = primaryCityPanel.data('city');
   // Init primary city
   initCity(primaryCityName, primaryCityPanel)
 });
 
+var latestCityRecordsRequest;
+
+function getLatestCityRecord(cityName) {
+  return latestCityRecordsRequest.then(function(data) {
+    var records = data.results.filter(function(record) {
+      return record.city.name_en == cityName;
+    });
+    if (records.length > 0)
+      return records[0];
+    return $.getJSON('api/airquality/latest_city_record', {
+      city: cityName
+    });
+  }, function() {
+    return $.getJSON('api/airquality/latest_city_record', {
+      city: cityName
+    });
+  });
+}
+
 function initCity(cityName, cityPanel) {
-  $.getJSON('api/airquality/latest_city_record', {
-    city: cityName
-  }).done(function(latestCityRecord) {
+  getLatestCityRecord(cityName).done(function(latestCityRecord) {
     initRankChart(latestCityRecord.update_dtm);
     initCityAirCondition(latestCityRecord, cityPanel.find('.air-condition-card'));
     initCityWeather(latestCityRecord, cityPanel);
@@ -97,12 +97,13 @@ FIXTURE_DIRS = (
 
 # CACHING
 # ------------------------------------------------------------------------------
+# Local memory cache by default, which is only right for a single process. Cached API responses are invalidated
+# by the crawler and management commands in other processes, so set CACHE_URL to a backend shared by all of them,
+# e.g. memcache://127.0.0.1:11211, filecache:///var/tmp/aqhi_cache or rediscache://127.0.0.1:6379/1 (needs
+# django-redis). Production settings require it.
+# See: https://github.com/joke2k/django-environ#supported-types
 CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache'
-        # 'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-        # 'LOCATION': '127.0.0.1:11211'
-    }
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
 }
 
 # DATABASE CONFIGURATION
@@ -262,5 +263,21 @@ REST_FRAMEWORK = {
     'DEFAULT_CACHE_ERRORS': False
 }
 
+# Cached API responses are invalidated by the *_updated_at_timestamp keys, see aqhi.airquality.caching
+REST_FRAMEWORK_EXTENSIONS = {
+    'DEFAULT_CACHE_RESPONSE_TIMEOUT': 60 * 60,
+    'DEFAULT_CACHE_ERRORS': False,
+}
+
+# Store pollutant fields of records as scaled integers instead of decimals. Set it before migrating airquality to
+# 0008, which converts the columns. To switch it later, migrate airquality back to 0007 first. Management commands
+# refuse to run with a value different from the one 0008 was applied with, see aqhi.airquality.checks
+AIRQUALITY_COMPACT_POLLUTANTS = env.bool('AIRQUALITY_COMPACT_POLLUTANTS', False)
+
+# Directory of the memory-mapped time series store of records, disabled if empty. Run the build_timeseries command
+# before setting it, as AQHI of new records is calculated from history in the store instead of database, and
+# again after records are written by any process without it or other than by saving pages, update_aqhi or deletes.
+AIRQUALITY_TIMESERIES_DIR = env('AIRQUALITY_TIMESERIES_DIR', default='')
+
 # Scrapy setting
 os.environ[ENVVAR] = 'aqhi.airquality.crawler.pm25in.settings'
@@ -50,6 +50,12 @@ TEMPLATES[0]['OPTIONS']['loaders'] = [
 # Raises ImproperlyConfigured exception if DATABASE_URL not in os.environ
 DATABASES['default'] = env.db("DATABASE_URL")
 
+# CACHING
+# ------------------------------------------------------------------------------
+# Raises ImproperlyConfigured exception if CACHE_URL not in os.environ. A local memory cache would never see
+# the invalidations made by the crawler and management commands, e.g. CACHE_URL=memcache://127.0.0.1:11211
+CACHES['default'] = env.cache('CACHE_URL')
+
 # Custom Admin URL, use {% url 'admin:index' %}
 # ADMIN_URL = env('DJANGO_ADMIN_URL')
 